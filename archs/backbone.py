@@ -13,4 +13,9 @@ def create_timm_body(arch:str, pretrained=True, cut=None, n_in=3):
         cut = next(i for i,o in reversed(ll) if has_pool_type(o))
     if isinstance(cut, int): return nn.Sequential(*list(model.children())[:cut])
     elif callable(cut): return cut(model)
-    else: raise NameError("cut must be either integer or function")
\ No newline at end of file
+    else: raise NameError("cut must be either integer or function")
+
+def set_input_channels(model, n_in, pretrained=True):
+    "Swaps the first conv of `model` for one taking `n_in` channels (pretrained RGB weights are summed for 1 channel)."
+    _update_first_layer(model, n_in, pretrained)
+    return model
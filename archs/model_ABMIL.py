@@ -1,25 +1,26 @@
 from fastai.vision.all import *
 from torch import nn
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 from archs.linear_classifier import *
 torch.backends.cudnn.benchmark = True
 
 class Embeddingmodel(nn.Module):
     
-    def __init__(self, arch, pretrained_arch, num_classes=1):
+    def __init__(self, arch, pretrained_arch, num_classes=1, n_in=3):
         super(Embeddingmodel,self).__init__()
         # Get Head
         self.is_efficientnet = "efficientnet" in arch.lower()
         
         if self.is_efficientnet:
             self.encoder = efficientnet_b3(weights=EfficientNet_B3_Weights.DEFAULT)
+            set_input_channels(self.encoder, n_in)
             nf = 512
             # Replace the last fully connected layer with a new one
             num_features = self.encoder.classifier[1].in_features
             self.encoder.classifier[1] = nn.Linear(num_features, nf)
         else:
-            self.encoder = create_timm_body(arch, pretrained=pretrained_arch)
+            self.encoder = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             nf = num_features_model(nn.Sequential(*self.encoder.children()))
             
             
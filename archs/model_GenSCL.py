@@ -2,12 +2,12 @@ import torch
 import torch.nn as nn
 from fastai.vision.all import *
 import torch.nn.functional as F
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 from archs.linear_classifier import *
 
 class Embeddingmodel(nn.Module):
-    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128):
+    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, n_in=3):
         super(Embeddingmodel, self).__init__()
         
         # Get Head
@@ -15,12 +15,13 @@ class Embeddingmodel(nn.Module):
         
         if self.is_efficientnet:
             self.encoder = efficientnet_b3(weights=EfficientNet_B3_Weights.DEFAULT)
+            set_input_channels(self.encoder, n_in)
             nf = 512
             # Replace the last fully connected layer with a new one
             num_features = self.encoder.classifier[1].in_features
             self.encoder.classifier[1] = nn.Linear(num_features, nf)
         else:
-            base_encoder = create_timm_body(arch, pretrained=pretrained_arch)
+            base_encoder = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             self.encoder = nn.Sequential(
                 base_encoder,
                 nn.AdaptiveAvgPool2d((1, 1)),
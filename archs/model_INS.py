@@ -2,13 +2,13 @@ import torch
 import torch.nn as nn
 from fastai.vision.all import *
 import torch.nn.functional as F
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 from loss.IWSCL import *
 from archs.linear_classifier import *
 
 class Embeddingmodel(nn.Module):
-    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, momentum=0.999, queue_size=8192):
+    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, momentum=0.999, queue_size=8192, n_in=3):
         super(Embeddingmodel, self).__init__()
         
         self.num_classes = num_classes
@@ -20,15 +20,17 @@ class Embeddingmodel(nn.Module):
         if self.is_efficientnet:
             # Original encoder
             self.encoder_q = efficientnet_b0(weights=EfficientNet_B0_Weights.DEFAULT)
+            set_input_channels(self.encoder_q, n_in)
             num_features = self.encoder_q.classifier[1].in_features
             self.encoder_q.classifier[1] = nn.Linear(num_features, self.nf)
             
             # Momentum encoder
             self.encoder_k = efficientnet_b0(weights=EfficientNet_B0_Weights.DEFAULT)
+            set_input_channels(self.encoder_k, n_in)
             self.encoder_k.classifier[1] = nn.Linear(num_features, self.nf)
         else:
             # Original encoder
-            encoder_q = create_timm_body(arch, pretrained=pretrained_arch)
+            encoder_q = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             self.encoder_q = nn.Sequential(
                 encoder_q,
                 nn.AdaptiveAvgPool2d((1, 1)),
@@ -37,7 +39,7 @@ class Embeddingmodel(nn.Module):
             self.nf = num_features_model(encoder_q)
             
             # Momentum encoder
-            encoder_k = create_timm_body(arch, pretrained=pretrained_arch)
+            encoder_k = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             self.encoder_k = nn.Sequential(
                 encoder_k,
                 nn.AdaptiveAvgPool2d((1, 1)),
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 from fastai.vision.all import *
 import torch.nn.functional as F
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 from archs.linear_classifier import Linear_Classifier
 
@@ -46,7 +46,7 @@ class AttentionInstanceClassifier(nn.Module):
 
 
 class Embeddingmodel(nn.Module):
-    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128):
+    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, n_in=3):
         super(Embeddingmodel, self).__init__()
         
         # Get Head
@@ -54,6 +54,7 @@ class Embeddingmodel(nn.Module):
         
         if self.is_efficientnet:
             self.encoder = efficientnet_b3(weights=EfficientNet_B3_Weights.DEFAULT)
+            set_input_channels(self.encoder, n_in)
             nf = 512
             num_features = self.encoder.classifier[1].in_features
             self.encoder.classifier[1] = nn.Sequential(
@@ -61,7 +62,7 @@ class Embeddingmodel(nn.Module):
                 nn.Linear(num_features, nf)
             )
         else:
-            self.encoder = create_timm_body(arch, pretrained=pretrained_arch)
+            self.encoder = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             nf = num_features_model(nn.Sequential(*self.encoder.children()))
         
         self.num_classes = num_classes
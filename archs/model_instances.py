@@ -3,16 +3,17 @@ import torch.nn as nn
 from fastai.vision.all import *
 import torch.nn.functional as F
 import timm
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 
 class Embeddingmodel(nn.Module):
-    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128):
+    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, n_in=3):
         super(Embeddingmodel, self).__init__()
         
         # 1. Use EfficientNet-V2 instead of original EfficientNet
         if "efficientnet" in arch.lower():
             self.encoder = efficientnet_b3(weights=EfficientNet_B3_Weights.DEFAULT)
+            set_input_channels(self.encoder, n_in)
             nf = 512
             # Replace the last fully connected layer with a new one
             num_features = self.encoder.classifier[1].in_features
@@ -22,7 +23,7 @@ class Embeddingmodel(nn.Module):
                 nn.Linear(num_features, nf)
             )
         else:
-            self.encoder = create_timm_body(arch, pretrained=pretrained_arch)
+            self.encoder = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             nf = num_features_model(nn.Sequential(*self.encoder.children()))
             
         self.num_classes = num_classes
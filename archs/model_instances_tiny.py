@@ -1,14 +1,14 @@
 import torch
 import torch.nn as nn
 from fastai.vision.all import *
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 
 class Embeddingmodel(nn.Module):
-    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128):
+    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, n_in=3):
         super(Embeddingmodel, self).__init__()
         
 
-        self.encoder = create_timm_body('resnet10t', pretrained=False)
+        self.encoder = create_timm_body('resnet10t', pretrained=False, n_in=n_in)
         nf = num_features_model(nn.Sequential(*self.encoder.children()))
             
         self.num_classes = num_classes
@@ -2,12 +2,13 @@ import torch
 import torch.nn as nn
 from fastai.vision.all import *
 import torch.nn.functional as F
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 from archs.linear_classifier import *
+from util.profiling import span
 
 class Embeddingmodel(nn.Module):
-    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128):
+    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, n_in=3):
         super(Embeddingmodel, self).__init__()
         
         # Get Head
@@ -15,13 +16,14 @@ class Embeddingmodel(nn.Module):
         
         if self.is_efficientnet:
             self.encoder = efficientnet_b3(weights=EfficientNet_B3_Weights.DEFAULT)
+            set_input_channels(self.encoder, n_in)
             nf = 512
             # Replace the last fully connected layer with a new one
             num_features = self.encoder.classifier[1].in_features
             #self.encoder.classifier[1] = nn.Linear(num_features, nf)
             self.encoder.classifier[1] = nn.Sequential(nn.Linear(num_features, nf))
         else:
-            base_encoder = create_timm_body(arch, pretrained=pretrained_arch)
+            base_encoder = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             self.encoder = nn.Sequential(
                 base_encoder,
                 nn.AdaptiveAvgPool2d((1, 1)),
@@ -59,12 +61,14 @@ class Embeddingmodel(nn.Module):
     def forward(self, input, projector=False, pred_on = False):
         if pred_on:
             num_bags = len(input) # input = [bag #, image #, channel, height, width]
-            all_images = torch.cat(input, dim=0).cuda()  # Concatenate all bags into a single tensor for batch processing
+            with span('bag_concat'):
+                all_images = torch.cat(input, dim=0).to(self.ins_classifier[0].weight.device)  # Concatenate all bags into a single tensor for batch processing
         else:
             all_images = input
 
         # Calculate the embeddings for all images in one go
-        feat = self.encoder(all_images)
+        with span('encoder'):
+            feat = self.encoder(all_images)
         
         # INSTANCE CLASS
         instance_predictions = self.ins_classifier(feat)
@@ -72,22 +76,24 @@ class Embeddingmodel(nn.Module):
         bag_pred = None
         bag_instance_predictions = None
         if pred_on:
-            # Split the embeddings back into per-bag embeddings
-            split_sizes = [bag.size(0) for bag in input]
-            h_per_bag = torch.split(feat, split_sizes, dim=0)
-            y_hat_per_bag = torch.split(instance_predictions, split_sizes, dim=0)
-            bag_pred = torch.empty(num_bags, self.num_classes).cuda()
-            bag_instance_predictions = []
-            for i, (h, y_h) in enumerate(zip(h_per_bag, y_hat_per_bag)):
-                # Pass both h and y_hat to the aggregator
-                yhat_bag, yhat_ins = self.aggregator(h, y_h)
-                bag_pred[i] = yhat_bag
-                bag_instance_predictions.append(yhat_ins) 
+            with span('aggregator'):
+                # Split the embeddings back into per-bag embeddings
+                split_sizes = [bag.size(0) for bag in input]
+                h_per_bag = torch.split(feat, split_sizes, dim=0)
+                y_hat_per_bag = torch.split(instance_predictions, split_sizes, dim=0)
+                bag_pred = torch.empty(num_bags, self.num_classes, device=feat.device)
+                bag_instance_predictions = []
+                for i, (h, y_h) in enumerate(zip(h_per_bag, y_hat_per_bag)):
+                    # Pass both h and y_hat to the aggregator
+                    yhat_bag, yhat_ins = self.aggregator(h, y_h)
+                    bag_pred[i] = yhat_bag
+                    bag_instance_predictions.append(yhat_ins) 
         
         proj = None
         if projector:
-            proj = self.projector(feat)
-            proj = F.normalize(proj, dim=1)
+            with span('projector'):
+                proj = self.projector(feat)
+                proj = F.normalize(proj, dim=1)
         
         # Clean up large intermediate tensors
         del feat
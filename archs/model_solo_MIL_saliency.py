@@ -2,12 +2,12 @@ import torch
 import torch.nn as nn
 from fastai.vision.all import *
 import torch.nn.functional as F
-from archs.backbone import create_timm_body
+from archs.backbone import create_timm_body, set_input_channels
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 from archs.linear_classifier import *
 
 class Embeddingmodel(nn.Module):
-    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128):
+    def __init__(self, arch, pretrained_arch, num_classes=1, feat_dim=128, n_in=3):
         super(Embeddingmodel, self).__init__()
         
         # Get Head
@@ -15,11 +15,12 @@ class Embeddingmodel(nn.Module):
         
         if self.is_efficientnet:
             self.encoder = efficientnet_b3(weights=EfficientNet_B3_Weights.DEFAULT)
+            set_input_channels(self.encoder, n_in)
             nf = 1536  # EfficientNet-B3's feature map has 1536 channels
             # Remove the classifier to keep spatial dimensions
             self.encoder = nn.Sequential(*list(self.encoder.children())[:-2])
         else:
-            self.encoder = create_timm_body(arch, pretrained=pretrained_arch)
+            self.encoder = create_timm_body(arch, pretrained=pretrained_arch, n_in=n_in)
             nf = num_features_model(nn.Sequential(*self.encoder.children()))
             
         
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+import torch
+import torch.nn as nn
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from archs.model_solo_MIL import Embeddingmodel
+from data.bucketing import load_shape_index
+
+# Encoder cost of square padded inputs against aspect ratio buckets. Reads the shape
+# index of an aspect bucketed cache (prepare_all_data with aspect_buckets=True) and
+# compares conv/linear MACs and measured training throughput. Run from the repo root:
+#   python benchmarks/bucket_benchmark.py --cache "F:/Temp_SSD_Data/<dataset>_<size>_rect_images" --img_size 224
+
+
+def count_macs(model, shape):
+    """Multiply-accumulates of the Conv2d and Linear layers for one input of `shape` (C, H, W)"""
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kh, kw = module.kernel_size
+        macs.append(output.numel() * (module.in_channels // module.groups) * kh * kw)
+
+    def linear_hook(module, inputs, output):
+        macs.append(output.numel() * module.in_features)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        model(torch.zeros(1, *shape, device=device))
+    for hook in hooks:
+        hook.remove()
+    return sum(macs)
+
+
+def time_training(encoder, shapes, weights, batch_size, iters, channels, device):
+    """Images/sec of forward + backward over batches drawn from `shapes` with `weights`"""
+    optimizer = torch.optim.SGD(encoder.parameters(), lr=1e-3)
+    batches = torch.multinomial(torch.tensor(weights, dtype=torch.float), iters, replacement=True).tolist()
+
+    # Warm up every shape once (cudnn picks its algorithms per shape)
+    for h, w in shapes:
+        encoder(torch.randn(batch_size, channels, h, w, device=device)).sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    start = time.perf_counter()
+    for b in batches:
+        h, w = shapes[b]
+        optimizer.zero_grad()
+        encoder(torch.randn(batch_size, channels, h, w, device=device)).sum().backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return iters * batch_size / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Square padded vs aspect bucketed encoder cost')
+    parser.add_argument('--cache', required=True, help='Aspect bucketed image cache with a shapes.csv')
+    parser.add_argument('--img_size', type=int, default=224)
+    parser.add_argument('--arch', default='efficientnet')
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--iters', type=int, default=50)
+    args = parser.parse_args()
+
+    index = load_shape_index(args.cache)
+    if not index:
+        raise FileNotFoundError(f"No shape index in {args.cache}")
+    counts = Counter(index.values())
+    shapes = list(counts.keys())
+    weights = [counts[s] for s in shapes]
+    total = sum(weights)
+
+    print(f"{total} images in {len(shapes)} buckets:")
+    for shape, count in counts.most_common():
+        print(f"  {shape[0]:>4} x {shape[1]:<4} {count / total:6.1%}")
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.backends.cudnn.benchmark = True
+    encoder = Embeddingmodel(args.arch, False, n_in=args.channels).encoder.to(device)
+
+    # MACs scale with the pixels each image actually covers
+    square = (args.channels, args.img_size, args.img_size)
+    square_macs = count_macs(encoder, square)
+    bucket_macs = sum(count_macs(encoder, (args.channels, h, w)) * n for (h, w), n in counts.items()) / total
+    pixels = sum(h * w * n for (h, w), n in counts.items()) / total
+    print(f"\nPixels per image: square {args.img_size ** 2}, bucketed {pixels:.0f} ({pixels / args.img_size ** 2:.1%})")
+    print(f"Encoder GMACs per image: square {square_macs / 1e9:.3f}, bucketed {bucket_macs / 1e9:.3f} ({bucket_macs / square_macs:.1%})")
+
+    encoder.train()
+    square_ips = time_training(encoder, [square[1:]], [1], args.batch_size, args.iters, args.channels, device)
+    bucket_ips = time_training(encoder, shapes, weights, args.batch_size, args.iters, args.channels, device)
+    print(f"\nTraining throughput on {device}: square {square_ips:.1f} img/s, bucketed {bucket_ips:.1f} img/s ({bucket_ips / square_ips:.2f}x)")
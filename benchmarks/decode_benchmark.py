@@ -0,0 +1,91 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import torch
+import torchvision.transforms as T
+import cv2
+from PIL import Image
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from storage_adapter import read_image
+from data.transforms import decode_rgb, CLAHETransform, ToUint8Tensor, IMAGENET_MEAN, IMAGENET_STD
+
+# Per image CPU cost of the old PIL decode path against the uint8 path the
+# datasets use now. Run from the repo root:
+#   python benchmarks/decode_benchmark.py --images "F:/Temp_SSD_Data/<dataset>_<size>_images/*.png"
+
+
+def legacy_clahe(img):
+    # CLAHETransform before the uint8 pipeline: new CLAHE object and PIL round trip per image
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    img = np.array(img)
+    img = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
+    img[:, :, 0] = clahe.apply(img[:, :, 0])
+    img = cv2.cvtColor(img, cv2.COLOR_LAB2RGB)
+    return Image.fromarray(img)
+
+
+def legacy_pipeline():
+    transform = T.Compose([
+        legacy_clahe,
+        T.ToTensor(),
+        T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
+    ])
+    return lambda path: transform(read_image(path, use_pil=True).convert("RGB"))
+
+
+def uint8_pipeline():
+    transform = T.Compose([CLAHETransform(), ToUint8Tensor()])
+    return lambda path: transform(decode_rgb(path))
+
+
+def run(name, pipeline, paths, repeats):
+    # Warm up the file cache and the CLAHE object
+    sample = pipeline(paths[0])
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for path in paths:
+            pipeline(path)
+    elapsed = time.perf_counter() - start
+
+    per_image_ms = elapsed / (repeats * len(paths)) * 1000
+    sent_bytes = sample.numel() * sample.element_size()
+    print(f"{name:>8}: {per_image_ms:7.2f} ms/image, {sent_bytes / 1024:8.1f} KiB sent per image ({sample.dtype})")
+    return per_image_ms
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per image decode + transform cost')
+    parser.add_argument('--images', required=True, help='Glob of images to decode')
+    parser.add_argument('--n', type=int, default=200, help='Number of images to use')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.images))[:args.n]
+    if not paths:
+        raise FileNotFoundError(f"No images match {args.images}")
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+
+    print(f"{len(paths)} images, {args.repeats} repeats, single thread")
+    legacy_ms = run('legacy', legacy_pipeline(), paths, args.repeats)
+    uint8_ms = run('uint8', uint8_pipeline(), paths, args.repeats)
+
+    # The uint8 path leaves normalization to the main process, time it separately
+    batch = torch.stack([uint8_pipeline()(p) for p in paths[:32]])
+    mean = torch.tensor(IMAGENET_MEAN).view(-1, 1, 1)
+    std = torch.tensor(IMAGENET_STD).view(-1, 1, 1)
+    start = time.perf_counter()
+    for _ in range(10):
+        batch.float().div_(255).sub_(mean).div_(std)
+    normalize_ms = (time.perf_counter() - start) / (10 * len(batch)) * 1000
+
+    print(f"main process normalize: {normalize_ms:.3f} ms/image")
+    print(f"speedup: {legacy_ms / (uint8_ms + normalize_ms):.2f}x")
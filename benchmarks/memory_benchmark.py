@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import argparse
+import importlib
+import threading
+import numpy as np
+import torch
+import torch.nn as nn
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from config import *
+
+# Peak memory and throughput of one training step over a grid of instances per batch,
+# for the bag step (pred_on, every bag through the aggregator) and the instance step
+# (projector only). Fits peak = fixed + per_instance * instances to each and recommends
+# the largest instance budget that stays under a memory budget. Measures the CUDA
+# allocator when a GPU is present, the process RSS otherwise. Run from the repo root:
+#   python benchmarks/memory_benchmark.py --data_config LesionDataConfig --budget_gb 11
+#   python benchmarks/memory_benchmark.py --model model_solo_MIL --arch resnet18 --img_size 256 --grid 16,32,64,128
+
+# archs/ modules whose Embeddingmodel(arch, pretrained, num_classes, n_in) has
+# forward(x, projector=, pred_on=) -> (bag_pred, _, instance_pred, proj), and the steps they support
+STEP_MODES = {
+    'model_solo_MIL': ('bag', 'instance'),
+    'model_solo_MIL_saliency': ('bag', 'instance'),
+    'model_customMIL': ('bag', 'instance'),
+    'model_instances': ('instance',),
+    'model_instances_tiny': ('instance',),
+    'model_GenSCL': ('bag',),
+}
+CUDA_ONLY = ('model_GenSCL',)
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # Lifetime peak only (KB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RSSSampler:
+    """Peak resident memory of this process while the `with` block runs, polled from a thread"""
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = _current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+        return False
+
+
+def synthetic_bags(n_instances, bag_size, channels, img_size, device):
+    """Normalized float bags holding n_instances images, bag_size per bag (the last one may be smaller)"""
+    sizes = [bag_size] * (n_instances // bag_size)
+    if n_instances % bag_size:
+        sizes.append(n_instances % bag_size)
+    return [torch.randn(n, channels, img_size, img_size, device=device) for n in sizes]
+
+
+def train_step(model, optimizer, mode, bags):
+    optimizer.zero_grad()
+    if mode == 'bag':
+        pred, _, _, proj = model(bags, pred_on=True, projector=True)
+    else:
+        _, _, pred, proj = model(torch.cat(bags), projector=True)
+    loss = nn.functional.binary_cross_entropy(pred.clamp(1e-6, 1 - 1e-6), torch.ones_like(pred))
+    if proj is not None:
+        loss = loss + proj.pow(2).mean()
+    loss.backward()
+    optimizer.step()
+
+
+def _is_oom(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error).lower()
+
+
+def measure(model, optimizer, mode, n_instances, bag_size, channels, img_size, device, iters):
+    """(peak bytes, instances/sec) of a training step with n_instances per batch, None if it runs out of memory"""
+    bags = None
+    try:
+        bags = synthetic_bags(n_instances, bag_size, channels, img_size, device)
+        train_step(model, optimizer, mode, bags) # cudnn picks its algorithms, optimizer state is allocated
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(device)
+            train_step(model, optimizer, mode, bags)
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated(device)
+        else:
+            with RSSSampler() as sampler:
+                train_step(model, optimizer, mode, bags)
+            peak = sampler.peak
+
+        start = time.perf_counter()
+        for _ in range(iters):
+            train_step(model, optimizer, mode, bags)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return peak, iters * n_instances / (time.perf_counter() - start)
+    except (RuntimeError, MemoryError) as e:
+        if not _is_oom(e):
+            raise
+        return None
+    finally:
+        del bags
+        optimizer.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def fit_memory(points):
+    """(fixed bytes, bytes per instance) least squares fit of [(instances, peak bytes), ...]"""
+    if len(points) < 2:
+        raise ValueError("Need at least two grid points that fit in memory to fit the memory model")
+    n, peak = np.array(points, dtype=np.float64).T
+    per_instance, fixed = np.polyfit(n, peak, 1)
+    return fixed, max(per_instance, 1.0)
+
+
+def safe_instances(fixed, per_instance, budget, headroom):
+    """Largest instances per batch with a predicted peak under headroom * budget"""
+    return max(0, int((budget * headroom - fixed) // per_instance))
+
+
+def memory_budget(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory per batch and safe batch sizes')
+    parser.add_argument('--data_config', default='LesionDataConfig', help='Config class the defaults below come from')
+    parser.add_argument('--model', default='model_solo_MIL', choices=sorted(STEP_MODES), help='Module in archs/ with an Embeddingmodel')
+    parser.add_argument('--arch', default=None)
+    parser.add_argument('--img_size', type=int, default=None)
+    parser.add_argument('--max_bag_size', type=int, default=None)
+    parser.add_argument('--grayscale', action='store_true', default=None)
+    parser.add_argument('--grid', default='8,16,32,64,128,256', help='Comma separated instances per batch')
+    parser.add_argument('--modes', default='bag,instance')
+    parser.add_argument('--iters', type=int, default=5, help='Timed steps per grid point')
+    parser.add_argument('--budget_gb', type=float, default=None, help='Memory budget, defaults to the GPU (or system) memory')
+    parser.add_argument('--headroom', type=float, default=0.9, help='Fraction of the budget the prediction may use')
+    parser.add_argument('--output', default=None, help='CSV of the measurements')
+    args = parser.parse_args()
+
+    config = globals()[args.data_config]().to_dict()
+    arch = args.arch or config['arch']
+    img_size = args.img_size or config['img_size']
+    max_bag_size = args.max_bag_size or config['max_bag_size']
+    grayscale = config.get('grayscale', False) if args.grayscale is None else args.grayscale
+    channels = 1 if grayscale else 3
+    grid = sorted(int(n) for n in args.grid.split(','))
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.model in CUDA_ONLY and device.type != 'cuda':
+        parser.error(f"{args.model} moves its inputs to CUDA, it needs a GPU")
+    torch.backends.cudnn.benchmark = True
+    budget = args.budget_gb * 1024 ** 3 if args.budget_gb else memory_budget(device)
+    source = 'CUDA allocator' if device.type == 'cuda' else 'process RSS'
+
+    model_class = importlib.import_module(f"archs.{args.model}").Embeddingmodel
+    model = model_class(arch, False, num_classes=1, n_in=channels).to(device)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9, nesterov=True)
+    print(f"{args.model}.Embeddingmodel ({arch}), {img_size}px, {channels} channel(s), bags of {max_bag_size}, {device}, peak from the {source}")
+
+    rows = []
+    for mode in args.modes.split(','):
+        if mode not in STEP_MODES[args.model]:
+            print(f"\nSkipping the {mode} step, {args.model} only supports: {', '.join(STEP_MODES[args.model])}")
+            continue
+        print(f"\n{mode} step")
+        print(f"{'instances':>10}{'peak MB':>10}{'inst/s':>10}")
+        points = []
+        for n in grid:
+            result = measure(model, optimizer, mode, n, max_bag_size, channels, img_size, device, args.iters)
+            if result is None:
+                print(f"{n:>10}{'OOM':>10}")
+                rows.append((mode, n, None, None))
+                break # Larger batches won't fit either
+            peak, throughput = result
+            points.append((n, peak))
+            rows.append((mode, n, peak, throughput))
+            print(f"{n:>10}{peak / 1024 ** 2:>10.0f}{throughput:>10.1f}")
+
+        fixed, per_instance = fit_memory(points)
+        limit = safe_instances(fixed, per_instance, budget, args.headroom)
+        print(f"Memory model: {fixed / 1024 ** 2:.0f} MB + {per_instance / 1024 ** 2:.2f} MB per instance")
+        print(f"Largest safe instances per batch under {args.headroom:.0%} of {budget / 1024 ** 3:.1f} GB: {limit}")
+        if limit > grid[-1]:
+            print(f"  (extrapolated past the largest measured batch of {grid[-1]}, add it to --grid to confirm)")
+        if mode == 'bag':
+            # Every bag could be full, so budget for max_bag_size instances per bag
+            print(f"  -> bag_batch_size <= {limit // max_bag_size} with max_bag_size {max_bag_size}")
+        else:
+            print(f"  -> instance_batch_size <= {limit}")
+
+    if args.output:
+        import pandas as pd
+        pd.DataFrame(rows, columns=['mode', 'instances', 'peak_bytes', 'instances_per_sec']).to_csv(args.output, index=False)
+        print(f"\nMeasurements in {args.output}")
@@ -0,0 +1,321 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from config import train_transform
+from data.format_data import create_bags, preprocess_and_save_images
+from data.bag_loader import BagOfImagesDataset, BalancedBagSampler
+from data.instance_loader import Instance_Dataset, InstanceSampler
+from data.sudo_labels import create_selection_mask
+from archs.model_solo_MIL import Embeddingmodel
+from loss.palm import PALM
+from loss.genSCL import GenSupConLossv2
+from loss.IWSCL import IWSCL
+from util.eval_util import evaluate_model_performance
+
+# CPU benchmarks of the data, model and loss hot paths on a synthetic export (random
+# images in bags shaped like a real export, written to a temporary folder). Everything
+# is seeded and runs on a fixed number of threads, results go to JSON. With --baseline
+# every benchmark is compared against an earlier run and the script exits with 1 when
+# one got slower than the tolerance. Run from the repo root:
+#   python benchmarks/run_benchmarks.py --output benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json --tolerance 0.15
+#   python benchmarks/run_benchmarks.py --only palm,genscl --repeats 20
+
+LABEL_COLUMN = 'Has_Malignant'
+INSTANCE_COLUMN = 'Malignant Lesion Present'
+
+
+def make_synthetic_export(root, n_bags, min_images, max_images, height, width, seed=0):
+    """
+    Write random images to root/images and return (bag table, instance label table) in
+    the export's format. Odd bags are positive with their first image labelled malignant.
+    """
+    rng = np.random.default_rng(seed)
+    image_dir = os.path.join(root, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+
+    bags, instances = [], []
+    for bag_id in range(n_bags):
+        label = bag_id % 2
+        names = []
+        for i in range(int(rng.integers(min_images, max_images + 1))):
+            name = f"{bag_id}_{i}.png"
+            # Smooth background with noise, so the PNGs compress like ultrasound rather than pure noise
+            background = np.linspace(0, 160, width, dtype=np.float32)[None, :, None] + rng.normal(0, 20, (height, width, 1))
+            pixels = np.clip(np.repeat(background, 3, axis=2), 0, 255).astype(np.uint8)
+            Image.fromarray(pixels).save(os.path.join(image_dir, name))
+            names.append(name)
+            instances.append({'ImageName': name, INSTANCE_COLUMN: int(label == 1 and i == 0)})
+        bags.append({'ID': bag_id, 'Accession_Number': 100000 + bag_id, 'Images': str(names), LABEL_COLUMN: label})
+    return pd.DataFrame(bags), pd.DataFrame(instances)
+
+
+@contextlib.contextmanager
+def quiet():
+    # Progress bars and prints of the benchmarked code would end up in the timings' output
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def time_call(fn, repeats, warmup=1, setup=None):
+    """Seconds of every timed call of fn(), setup() runs untimed before each call"""
+    times = []
+    with quiet():
+        for i in range(warmup + repeats):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                times.append(elapsed)
+    return times
+
+
+class Context:
+    """Synthetic export plus the bags and datasets built from it, shared by the benchmarks"""
+    def __init__(self, workdir, args):
+        self.workdir = workdir
+        self.args = args
+        self.root = os.path.join(workdir, 'export')
+        self.cache = os.path.join(workdir, f'cache_{args.img_size}')
+        self.data, self.instance_data = make_synthetic_export(self.root, args.bags, 2, args.max_bag_size,
+                                                              args.source_height, args.source_width, args.seed)
+        self.config = {
+            'label_columns': [LABEL_COLUMN],
+            'instance_columns': [INSTANCE_COLUMN],
+            'min_bag_size': 1,
+            'max_bag_size': args.max_bag_size,
+            'use_videos': False,
+            'img_size': args.img_size,
+            'aspect_buckets': False,
+            'grayscale': False,
+        }
+        with quiet():
+            preprocess_and_save_images(self.config, self.data, self.root, self.cache)
+            self.bags = create_bags(self.config, self.data, self.cache, self.instance_data)
+            self.instance_dataset = Instance_Dataset(self.bags, [], transform=train_transform, warmup=True)
+        self.n_images = sum(len(bag['images']) for bag in self.bags.values())
+
+
+def bench_create_bags(ctx):
+    yield 'create_bags', lambda: create_bags(ctx.config, ctx.data, ctx.cache, ctx.instance_data), len(ctx.data), None
+
+
+def bench_preprocess(ctx):
+    output = os.path.join(ctx.workdir, 'preprocess')
+    fn = lambda: preprocess_and_save_images(ctx.config, ctx.data, ctx.root, output)
+    # Already cropped images are skipped, every call starts from an empty cache
+    yield 'preprocess_and_save_images', fn, ctx.n_images, lambda: shutil.rmtree(output, ignore_errors=True)
+
+
+def bench_datasets(ctx):
+    bag_dataset = BagOfImagesDataset(ctx.bags, transform=train_transform)
+    yield 'bag_dataset_getitem', lambda: [bag_dataset[i] for i in range(len(bag_dataset))], len(bag_dataset), None
+    instances = ctx.instance_dataset
+    yield 'instance_dataset_getitem', lambda: [instances[i] for i in range(len(instances))], len(instances), None
+
+
+def bench_samplers(ctx):
+    args = ctx.args
+    instance_sampler = InstanceSampler(ctx.instance_dataset, args.instance_batch_size, strategy=1)
+    yield 'instance_sampler_epoch', lambda: list(instance_sampler), max(1, len(instance_sampler)), None
+    bag_sampler = BalancedBagSampler(BagOfImagesDataset(ctx.bags), batch_size=args.bag_batch_size)
+    yield 'bag_sampler_epoch', lambda: list(bag_sampler), max(1, len(bag_sampler)), None
+
+
+def bench_model(ctx):
+    args = ctx.args
+    model = Embeddingmodel(args.arch, False, num_classes=1).eval()
+    for bag_size in args.bag_sizes:
+        bags = [torch.randn(bag_size, 3, args.img_size, args.img_size) for _ in range(args.bag_batch_size)]
+
+        def forward(bags=bags):
+            with torch.no_grad():
+                model(bags, pred_on=True)
+        yield f'embeddingmodel_forward_bag{bag_size}', forward, bag_size * args.bag_batch_size, None
+
+
+def _features(n, dim=128):
+    return F.normalize(torch.randn(n, dim), dim=1)
+
+
+def bench_losses(ctx):
+    n = ctx.args.instance_batch_size
+    targets = torch.randint(0, 2, (n,))
+
+    palm = PALM(nviews=1, num_classes=2, n_protos=100, k=0, lambda_pcon=1)
+    features = _features(n)
+    yield 'palm_forward', lambda: palm(features, targets), n, None
+
+    genscl = GenSupConLossv2(temperature=0.07, base_temperature=0.07)
+    zk, zq = _features(n), _features(n)
+    one_hot = F.one_hot(targets, 2).float()
+    yield 'genscl_forward', lambda: genscl([zk, zq], [one_hot, one_hot], None), n, None
+
+    iwscl = IWSCL(feat_dim=128)
+    queue_size = 1024
+    queue = F.normalize(torch.randn(128, queue_size), dim=0)
+    queue_labels = torch.randint(0, 2, (queue_size,))
+    predictions = torch.rand(n)
+    labels = torch.where(torch.rand(n) < 0.5, targets, torch.full_like(targets, -1))
+    yield 'iwscl_forward', lambda: iwscl(features, predictions, labels, queue, queue_labels), n, None
+
+
+def bench_selection_mask(ctx):
+    rng = np.random.default_rng(ctx.args.seed)
+    # Real training sets have thousands of bags, the mask works on all their instances at once
+    logits = {bag_id: rng.random(int(rng.integers(2, ctx.args.max_bag_size + 1))).astype(np.float32)
+              for bag_id in range(ctx.args.selection_bags)}
+    n = sum(len(v) for v in logits.values())
+    yield 'create_selection_mask', lambda: create_selection_mask(logits, 0.5), n, None
+
+
+def bench_evaluation(ctx):
+    rng = np.random.default_rng(ctx.args.seed)
+    n = ctx.args.eval_samples
+    targets = rng.integers(0, 2, n)
+    predictions = np.clip(targets * 0.3 + rng.random(n) * 0.7, 0, 1)
+    output = os.path.join(ctx.workdir, 'evaluation')
+    os.makedirs(output, exist_ok=True)
+    yield 'evaluate_model_performance', lambda: evaluate_model_performance(targets, predictions, 0.8, output), n, None
+
+
+BENCHMARKS = [bench_create_bags, bench_preprocess, bench_datasets, bench_samplers, bench_model,
+              bench_losses, bench_selection_mask, bench_evaluation]
+
+
+def environment(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=parent_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'threads': args.threads,
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'only', 'tolerance')},
+    }
+
+
+def run(args, workdir):
+    results = {}
+    torch.manual_seed(args.seed)
+    ctx = Context(workdir, args)
+    only = [name for name in args.only.split(',') if name] if args.only else None
+    for make in BENCHMARKS:
+        for name, fn, items, setup in make(ctx):
+            if only and not any(o in name for o in only):
+                continue
+            torch.manual_seed(args.seed)
+            np.random.seed(args.seed)
+            random.seed(args.seed)
+            times = time_call(fn, args.repeats, args.warmup, setup)
+            median = float(np.median(times))
+            results[name] = {
+                'median_s': median,
+                'min_s': float(np.min(times)),
+                'per_item_us': 1e6 * median / items,
+                'items': items,
+                'repeats': len(times),
+            }
+            print(f"{name:<36}{1000 * median:>12.2f} ms{results[name]['per_item_us']:>14.1f} us/item  ({items} items)")
+    return results
+
+
+def compare(results, baseline, env, tolerance):
+    """Print every benchmark against the baseline, returns the names that got slower than the tolerance"""
+    base = baseline['results']
+    if baseline['environment'].get('settings') != env['settings']:
+        print("Warning: the baseline was run with different settings, timings may not be comparable")
+    for key in ('platform', 'processor', 'threads', 'torch'):
+        if baseline['environment'].get(key) != env.get(key):
+            print(f"Warning: baseline {key} {baseline['environment'].get(key)} != {env.get(key)}")
+
+    regressions = []
+    print(f"\n{'benchmark':<36}{'baseline ms':>12}{'now ms':>10}{'ratio':>8}")
+    for name, result in results.items():
+        if name not in base:
+            print(f"{name:<36}{'':>12}{1000 * result['median_s']:>10.2f}{'new':>8}")
+            continue
+        ratio = result['median_s'] / base[name]['median_s']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            flag = '  faster'
+        print(f"{name:<36}{1000 * base[name]['median_s']:>12.2f}{1000 * result['median_s']:>10.2f}{ratio:>8.2f}{flag}")
+    for name in base:
+        if name not in results:
+            print(f"{name:<36}{1000 * base[name]['median_s']:>12.2f}{'':>10}{'missing':>8}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU benchmarks of the data, model and loss hot paths')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='Results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Slowdown ratio above 1 + tolerance counts as a regression')
+    parser.add_argument('--only', default=None, help='Comma separated substrings of the benchmarks to run')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4, help='torch intra-op threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bags', type=int, default=48, help='Bags in the synthetic export')
+    parser.add_argument('--max_bag_size', type=int, default=8)
+    parser.add_argument('--source_height', type=int, default=480)
+    parser.add_argument('--source_width', type=int, default=640)
+    parser.add_argument('--img_size', type=int, default=128)
+    parser.add_argument('--arch', default='resnet18')
+    parser.add_argument('--bag_sizes', default='2,4,8,16', help='Bag sizes for the Embeddingmodel forward')
+    parser.add_argument('--bag_batch_size', type=int, default=2)
+    parser.add_argument('--instance_batch_size', type=int, default=64)
+    parser.add_argument('--selection_bags', type=int, default=5000)
+    parser.add_argument('--eval_samples', type=int, default=2000)
+    args = parser.parse_args()
+    args.bag_sizes = [int(n) for n in args.bag_sizes.split(',')]
+
+    torch.set_num_threads(args.threads)
+    current_environment = environment(args)
+
+    with tempfile.TemporaryDirectory(prefix='casbusi_bench_') as workdir:
+        print(f"Synthetic export in {workdir}, {args.threads} threads, commit {current_environment['commit']}\n")
+        results = run(args, workdir)
+
+    report = {'environment': current_environment, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, current_environment, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nNo regressions over {args.tolerance:.0%}")
@@ -0,0 +1,44 @@
+import os
+import argparse
+import pandas as pd
+
+# Wall clock time to a target validation AUC for runs that logged time_to_auc.csv
+# (train_PALM2 writes it to the model folder). Put the fixed size run first, the
+# others are compared against it:
+#   python benchmarks/time_to_auc.py --target 0.85 models/<head>/fixed models/<head>/progressive
+
+
+def time_to_target(log, target):
+    """(seconds, epoch, img_size) of the first epoch reaching `target`, None if it never does"""
+    reached = log[log['val_auc'] >= target]
+    if reached.empty:
+        return None
+    first = reached.iloc[0]
+    return float(first['seconds']), int(first['epoch']), int(first['img_size'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare time to a target val AUC between runs')
+    parser.add_argument('runs', nargs='+', help='Model folders containing time_to_auc.csv, baseline first')
+    parser.add_argument('--target', type=float, default=0.85)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'run':<40} {'reached':>10} {'epoch':>6} {'size':>5} {'best AUC':>9} {'total':>10}")
+    for run in args.runs:
+        log = pd.read_csv(os.path.join(run, 'time_to_auc.csv'))
+        reached = time_to_target(log, args.target)
+        best = log['val_auc'].max()
+        total = log['seconds'].max() / 60
+
+        if reached is None:
+            print(f"{run:<40} {'never':>10} {'':>6} {'':>5} {best:9.4f} {total:8.1f} m")
+            continue
+
+        seconds, epoch, size = reached
+        line = f"{run:<40} {seconds / 60:8.1f} m {epoch:6d} {size:5d} {best:9.4f} {total:8.1f} m"
+        if run == args.runs[0]:
+            baseline = seconds
+        elif baseline is not None:
+            line += f"  ({baseline / seconds:.2f}x vs {args.runs[0]})"
+        print(line)
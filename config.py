@@ -1,5 +1,8 @@
+import os
+import json
 import torchvision.transforms as T
-from data.transforms import CLAHETransform
+from data.transforms import CLAHETransform, ToUint8Tensor, IMAGENET_MEAN, IMAGENET_STD
+from data.batch_augment import BatchAugment
 from storage_adapter import * 
 
 class BaseConfig:
@@ -21,6 +24,19 @@ class ITS2CLRConfig(BaseConfig):
         self.warmup_epochs = 10
         self.learning_rate = 0.001
         self.reset_aggregator = False
+        self.async_checkpoint = True # Write checkpoints/plots in the background
+        self.bootstrap_samples = 0 # Bootstrap replicates for metric confidence intervals, 0 to skip
+        self.progressive_resizing = [] # train_PALM2 only: [[first training epoch, img_size], ...] e.g. [[0, 128], [6, 160], [12, 224]], empty for fixed size
+        self.target_auc = 0.85 # train_PALM2 only: val AUC that time_to_auc.csv reports the wall clock time to reach
+        self.resume_every = 200 # train_PALM2 only: batches between mid-epoch resume snapshots (util/resume.py), 0 to only resume from saved models
+        self.profile = False # train_PALM2, train_PALM2_DDP and train_lockstep only: time the training hot path per epoch (util/profiling.py): profile.csv and Chrome traces in the model folder
+        self.profile_cuda_sync = True # Synchronize CUDA around every profiled region so times are attributed correctly
+        self.profile_torch = False # Also run torch.profiler over a few steps per epoch
+        self.num_workers = 0 # DataLoader workers of make_bag_loaders, make_shard_loaders and the train_PALM2 instance loaders, util/loader_doctor.py recommends these four for a machine
+        self.prefetch_factor = 2 # Batches every worker loads ahead
+        self.pin_memory = False # Page locked batches for faster copies to the GPU (with workers only)
+        self.persistent_workers = False # Keep the workers alive between epochs
+        self.stream_shards = False # train_PALM2_DDP streams bags from the shards `python -m data.shards` exported
 
 class LesionDataConfig(BaseConfig):
     def __init__(self):
@@ -35,6 +51,9 @@ class LesionDataConfig(BaseConfig):
         self.arch = 'efficientnet'
         self.pretrained_arch = False
         self.use_videos = False
+        self.grayscale = False # Single channel cache, decode and model stem (ultrasound is gray), needs a new head
+        self.aspect_buckets = False # Keep the aspect ratio (longest side img_size) and batch images by shape instead of padding to square
+        self.extra_img_sizes = [] # Also crop these sizes (e.g. [160, 288]) from the same decode, each into its own cache
 
 class FishDataConfig(BaseConfig):
     def __init__(self):
@@ -49,6 +68,9 @@ class FishDataConfig(BaseConfig):
         self.arch = 'resnet18'
         self.pretrained_arch = False
         self.use_videos = False
+        self.grayscale = False
+        self.aspect_buckets = False
+        self.extra_img_sizes = []
         
 class DogDataConfig(BaseConfig):
     def __init__(self):
@@ -63,37 +85,63 @@ class DogDataConfig(BaseConfig):
         self.arch = 'resnet18'
         self.pretrained_arch = False
         self.use_videos = False
+        self.grayscale = False
+        self.aspect_buckets = False
+        self.extra_img_sizes = []
 
 class PathConfig(BaseConfig):
     def __init__(self):
         self.bucket = "" # optional - enables GCP
         self.export_location = "D:/DATA/CASBUSI/exports/"
         self.cropped_images = "F:/Temp_SSD_Data/"
+        self.bag_cache = None # Pickled bags from an earlier prepare_all_data, skips preprocessing (set by util/sweep.py)
+        self.cv_folds = None # Fold assignment from util/cross_validate.py, replaces the Valid split with `fold` as validation
+        self.fold = None
         
         
         
         
 # Augmentations 
+# Datasets decode to uint8 arrays and these return uint8 tensors, the
+# loaders are wrapped in NormalizedLoader to normalize in the main process.
+# The random augmentations run on whole batches there (train_augment),
+# followed by CLAHE on the augmented images.
 train_transform = T.Compose([
-            T.RandomHorizontalFlip(),
-            T.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0),
-            T.RandomAffine(degrees=(-90, 90), translate=(0.05, 0.05), scale=(1, 1.2),),
-            CLAHETransform(),
-            T.ToTensor(),
-            T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+            ToUint8Tensor(),
         ])
 
+train_augment = BatchAugment(
+            flip_p=0.5,
+            brightness=0.2, contrast=0.2, saturation=0.2,
+            degrees=(-90, 90), translate=(0.05, 0.05), scale=(1, 1.2),
+            equalize=CLAHETransform(),
+        )
+
 val_transform = T.Compose([
             CLAHETransform(),
-            T.ToTensor(),
-            T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+            ToUint8Tensor(),
         ])
 
 ##############
 
 
-def build_config(model_version, head_name, data_config_class):
-    """Combines configs into a single dictionary"""
+def input_channels(config):
+    """Image channels the model stem takes for this config"""
+    return 1 if config.get('grayscale', False) else 3
+
+
+def build_config(model_version, head_name, data_config_class, overrides=None):
+    """
+    Combines configs into a single dictionary. `overrides` (or the CONFIG_OVERRIDES
+    environment variable, JSON) replaces fields afterwards, "data_config" picks the data
+    config class by name. util/sweep.py launches its trials this way.
+    """
+    if overrides is None:
+        overrides = json.loads(os.environ.get('CONFIG_OVERRIDES', '{}'))
+    overrides = dict(overrides)
+    if 'data_config' in overrides:
+        data_config_class = globals()[overrides.pop('data_config')]
+    
     its2clr_config = ITS2CLRConfig().to_dict()
     data_config = data_config_class().to_dict()
     path_config = PathConfig().to_dict()
@@ -106,7 +154,25 @@ def build_config(model_version, head_name, data_config_class):
         **path_config
     }
     
+    unknown = set(overrides) - set(config)
+    if unknown:
+        raise KeyError(f"Unknown config overrides: {sorted(unknown)}")
+    config.update(overrides)
+    
     # Determine storage client
     StorageClient.get_instance(None, config['bucket'])
     
     return config
+
+
+# Fields only some trainers implement, the others warn and fall back to the defaults
+TRAIN_PALM2_ONLY = ('progressive_resizing', 'resume_every', 'profile')
+
+
+def drop_unsupported(config, script, supported=()):
+    """Reset the TRAIN_PALM2_ONLY fields (but `supported`) that are set away from their defaults, with a warning"""
+    defaults = ITS2CLRConfig().to_dict()
+    for field in TRAIN_PALM2_ONLY:
+        if field not in supported and config[field] != defaults[field]:
+            print(f"{field} is not supported by {script}, using {defaults[field]!r}")
+            config[field] = defaults[field]
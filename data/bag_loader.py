@@ -1,11 +1,13 @@
 from fastai.vision.all import *
 import torch.utils.data as TUD
 from storage_adapter import * 
+from data.transforms import decode_image, fit_to_shape
 
 class BagOfImagesDataset(TUD.Dataset):
 
-    def __init__(self, bags_dict, transform=None, save_processed=False):
+    def __init__(self, bags_dict, transform=None, save_processed=False, grayscale=False):
         self.bags_dict = bags_dict
+        self.grayscale = grayscale
         self.unique_bag_ids = list(bags_dict.keys())
         self.save_processed = save_processed
         self.transform = transform
@@ -21,12 +23,17 @@ class BagOfImagesDataset(TUD.Dataset):
         instance_labels = bag_info['image_labels'].copy() # Make a copy of instance labels to avoid modifying the original
         accession_number = actual_id #bag_info['Accession_Number']  # Accession number is not unique!!! :C
 
+        # Aspect bucketed bags resize the odd images out to the bag's shape so they stack
+        bucket = bag_info.get('bucket')
+        load = (lambda fn: fit_to_shape(decode_image(fn, self.grayscale), bucket)) if bucket else \
+            (lambda fn: decode_image(fn, self.grayscale))
+
         # Process regular images
-        image_data = [self.transform(read_image(fn, use_pil=True).convert("RGB")) for fn in images_this_bag]
+        image_data = [self.transform(load(fn)) for fn in images_this_bag]
         
         # Process video images if they exist
         if videos_this_bag:
-            video_data = [self.transform(read_image(fn, use_pil=True).convert("RGB")) for fn in videos_this_bag]
+            video_data = [self.transform(load(fn)) for fn in videos_this_bag]
             # Add video frames to image data
             image_data.extend(video_data)
             # Add None labels for video frames (same length as video_data)
@@ -67,10 +74,12 @@ def collate_bag(batch):
         batch_ids.append(bag_id)
 
     # Use torch.stack for bag labels to handle multiple labels per bag
-    out_bag_labels = torch.stack(batch_bag_labels).cuda()
+    # Workers can't use CUDA, their batches stay on the CPU until NormalizedLoader moves them
+    device = 'cuda' if torch.cuda.is_available() and TUD.get_worker_info() is None else 'cpu'
+    out_bag_labels = torch.stack(batch_bag_labels).to(device)
 
     # Converting to a tensor
-    out_ids = torch.tensor(batch_ids, dtype=torch.long).cuda()
+    out_ids = torch.tensor(batch_ids, dtype=torch.long, device=device)
 
     return batch_data, out_bag_labels, batch_instance_labels, out_ids
 
@@ -141,8 +150,9 @@ class BalancedBagSampler(torch.utils.data.Sampler):
     
 
 class SyntheticBagDataset(TUD.Dataset):
-    def __init__(self, bags_dict, transform=None, min_bag_size=3, max_bag_size=20):
+    def __init__(self, bags_dict, transform=None, min_bag_size=3, max_bag_size=20, grayscale=False):
         self.transform = transform
+        self.grayscale = grayscale
         self.min_bag_size = min_bag_size
         self.max_bag_size = max_bag_size
         self.num_bags = len(bags_dict)
@@ -182,7 +192,7 @@ class SyntheticBagDataset(TUD.Dataset):
             bag_label = [0]
             instance_labels = [[0] for _ in range(bag_size)]
         
-        image_data = torch.stack([self.transform(read_image(fn, use_pil=True).convert("RGB")) 
+        image_data = torch.stack([self.transform(decode_image(fn, self.grayscale)) 
                                 for fn in bag_images])
         
         bag_labels_tensor = torch.tensor(bag_label, dtype=torch.float32)
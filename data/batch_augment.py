@@ -0,0 +1,113 @@
+import math
+import torch
+import torch.nn.functional as F
+
+# Batched replacement for the per image RandomHorizontalFlip / ColorJitter /
+# RandomAffine in train_transform. Every sample still draws its own parameters
+# from the same distributions as torchvision, but the work is a handful of
+# tensor ops over the whole (N, C, H, W) batch on whatever device it lives on.
+# `equalize` (CLAHE in train_augment) runs per image after the augmentations,
+# in the same order the per image pipeline used.
+
+
+def _grayscale(images):
+    if images.shape[1] == 1:
+        return images
+    r, g, b = images.unbind(1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _blend(images, other, factor):
+    return (factor * images + (1 - factor) * other).clamp_(0, 1)
+
+
+class BatchAugment(object):
+    """
+    Per sample random flip, color jitter and affine warp for float images in [0, 1].
+
+    flip_p:      probability of a horizontal flip
+    brightness, contrast, saturation: jitter factors drawn from [1 - x, 1 + x], applied in a random order per sample
+    degrees:     rotation range, translate: max fraction of width/height, scale: scale range
+    equalize:    optional CxHxW uint8 tensor transform (e.g. CLAHETransform) applied to every augmented image
+    """
+    def __init__(self, flip_p=0.5, brightness=0.2, contrast=0.2, saturation=0.2,
+                 degrees=(-90, 90), translate=(0.05, 0.05), scale=(1, 1.2), equalize=None, generator=None):
+        self.flip_p = flip_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.degrees = degrees
+        self.translate = translate
+        self.scale = scale
+        self.equalize = equalize
+        self.generator = generator
+
+    def _uniform(self, n, low, high, device):
+        return torch.rand(n, generator=self.generator).to(device) * (high - low) + low
+
+    def flip(self, images):
+        flip = torch.rand(images.shape[0], generator=self.generator).to(images.device) < self.flip_p
+        return torch.where(flip.view(-1, 1, 1, 1), images.flip(-1), images)
+
+    def color_jitter(self, images):
+        n, device = images.shape[0], images.device
+        ops = []
+        if self.brightness:
+            f = self._uniform(n, 1 - self.brightness, 1 + self.brightness, device).view(-1, 1, 1, 1)
+            ops.append(lambda x, f=f: _blend(x, torch.zeros_like(x), f))
+        if self.contrast:
+            f = self._uniform(n, 1 - self.contrast, 1 + self.contrast, device).view(-1, 1, 1, 1)
+            ops.append(lambda x, f=f: _blend(x, _grayscale(x).mean(dim=(1, 2, 3), keepdim=True), f))
+        if self.saturation and images.shape[1] == 3:
+            f = self._uniform(n, 1 - self.saturation, 1 + self.saturation, device).view(-1, 1, 1, 1)
+            ops.append(lambda x, f=f: _blend(x, _grayscale(x), f))
+        if not ops:
+            return images
+
+        # Each sample applies the ops in its own random order (like ColorJitter's randperm)
+        order = torch.argsort(torch.rand(n, len(ops), generator=self.generator), dim=1).to(device)
+        for step in range(len(ops)):
+            out = images
+            for i, op in enumerate(ops):
+                selected = (order[:, step] == i).view(-1, 1, 1, 1)
+                out = torch.where(selected, op(images), out)
+            images = out
+        return images
+
+    def affine(self, images):
+        n, _, h, w = images.shape
+        device = images.device
+
+        angle = self._uniform(n, self.degrees[0], self.degrees[1], 'cpu') * math.pi / 180
+        scale = self._uniform(n, self.scale[0], self.scale[1], 'cpu')
+        # Whole pixel translations, like RandomAffine
+        tx = torch.round(self._uniform(n, -self.translate[0] * w, self.translate[0] * w, 'cpu'))
+        ty = torch.round(self._uniform(n, -self.translate[1] * h, self.translate[1] * h, 'cpu'))
+
+        # Inverse map (output -> input) around the image center in pixels,
+        # then converted to the normalized coordinates affine_grid expects
+        cos, sin = torch.cos(angle) / scale, torch.sin(angle) / scale
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = cos
+        theta[:, 0, 1] = sin * h / w
+        theta[:, 1, 0] = -sin * w / h
+        theta[:, 1, 1] = cos
+        theta[:, 0, 2] = -(cos * tx + sin * ty) * 2 / w
+        theta[:, 1, 2] = -(-sin * tx + cos * ty) * 2 / h
+
+        grid = F.affine_grid(theta.to(device, images.dtype), list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    def equalize_images(self, images):
+        # Back to uint8 on the CPU for cv2, like the uint8 tensors the per image transforms worked on
+        batch = images.mul(255).round_().clamp_(0, 255).to('cpu', torch.uint8)
+        batch = torch.stack([self.equalize(x) for x in batch])
+        return batch.to(images.device, non_blocking=True).float().div_(255)
+
+    def __call__(self, images):
+        images = self.flip(images)
+        images = self.color_jitter(images)
+        images = self.affine(images)
+        if self.equalize is not None:
+            images = self.equalize_images(images)
+        return images
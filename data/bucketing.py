@@ -0,0 +1,160 @@
+import os
+import math
+import random
+from collections import Counter
+import pandas as pd
+import torch.utils.data as TUD
+from storage_adapter import *
+
+# Aspect ratio bucketing (config['aspect_buckets']). Preprocessing stores images with
+# ResizeLongest and records every image's (height, width) in a shape index next to
+# them. Batches are then grouped so each one holds a single shape, which lets the
+# encoders run on rectangular inputs instead of square padded ones.
+
+SHAPE_INDEX = "shapes.csv"
+
+
+def load_shape_index(output_dir):
+    """{file name: (height, width)} for an image cache, empty if there is no index yet"""
+    df = read_csv(f"{output_dir}/{SHAPE_INDEX}") if file_exists(f"{output_dir}/{SHAPE_INDEX}") else None
+    if df is None:
+        return {}
+    return {name: (int(h), int(w)) for name, h, w in zip(df['name'], df['height'], df['width'])}
+
+
+def save_shape_index(output_dir, shapes):
+    df = pd.DataFrame([(name, h, w) for name, (h, w) in shapes.items()], columns=['name', 'height', 'width'])
+    save_data(df, f"{output_dir}/{SHAPE_INDEX}")
+
+
+def attach_shapes(bags_dict, shapes):
+    """
+    Add 'shapes' (one (h, w) per image then video frame) and 'bucket' (the bag's most
+    common shape, which the bag dataset resizes its other images to) to every bag.
+    """
+    for bag_info in bags_dict.values():
+        files = list(bag_info['images']) + list(bag_info['videos'])
+        bag_info['shapes'] = [shapes[os.path.basename(f)] for f in files]
+        bag_info['bucket'] = Counter(bag_info['shapes']).most_common(1)[0][0] if files else None
+    return bags_dict
+
+
+def bucket_keys(dataset):
+    """Shape bucket of every item of an Instance_Dataset or BagOfImagesDataset"""
+    if hasattr(dataset, 'shapes'):
+        return dataset.shapes
+    return [dataset.bags_dict[bag_id].get('bucket') for bag_id in dataset.unique_bag_ids]
+
+
+def bucket_labels(dataset):
+    """1 for the positive items of an Instance_Dataset or BagOfImagesDataset, None for other datasets"""
+    if hasattr(dataset, 'output_image_labels'):
+        return [int(label == 1) for label in dataset.output_image_labels]
+    if hasattr(dataset, 'bags_dict'):
+        return [int(1 in dataset.bags_dict[bag_id]['bag_labels']) for bag_id in dataset.unique_bag_ids]
+    return None
+
+
+class BucketBatchSampler(TUD.Sampler):
+    """
+    Regroups the batches of another batch sampler so every batch has one shape bucket.
+
+    Training (train=True): every bucket gets a fixed share of the wrapped sampler's
+    batch count, in proportion to its size, so len() is exact. Each epoch the bucket's
+    batches are filled with the indices the wrapped sampler drew from it (repeating
+    some if it drew too few), batches missing a positive get one from their bucket,
+    and the batches are shuffled. Buckets with fewer than `min_batch` items are
+    skipped, a batch of one breaks BatchNorm in training mode.
+
+    Evaluation (train=False): every index once, batched in order within its bucket.
+    """
+    def __init__(self, batch_sampler, keys, batch_size=None, drop_last=False, train=True, labels=None, min_batch=2):
+        self.batch_sampler = batch_sampler
+        self.keys = keys
+        self.batch_size = batch_size or batch_sampler.batch_size
+        self.drop_last = drop_last
+        self.train = train
+        self.labels = labels
+        self.pools = {}
+        for idx, key in enumerate(keys):
+            self.pools.setdefault(key, []).append(idx)
+        self.positives = {key: [i for i in pool if labels[i] == 1] for key, pool in self.pools.items()} if labels is not None else {}
+        self.sizes = {key: min(self.batch_size, len(pool)) for key, pool in self.pools.items()}
+        self.quotas = self._quotas(min_batch) if train else {}
+
+    def _quotas(self, min_batch):
+        """Batches per bucket, largest remainder shares of the wrapped sampler's batch count"""
+        eligible = {key: len(pool) for key, pool in self.pools.items() if len(pool) >= min_batch}
+        if not eligible:
+            return {}
+        total = len(self.batch_sampler)
+        n = sum(eligible.values())
+        shares = {key: total * count / n for key, count in eligible.items()}
+        quotas = {key: int(share) for key, share in shares.items()}
+        for key in sorted(shares, key=lambda k: shares[k] - quotas[k], reverse=True)[:total - sum(quotas.values())]:
+            quotas[key] += 1
+        if not self.drop_last:
+            # Every shape gets trained on
+            quotas = {key: max(quota, 1) for key, quota in quotas.items()}
+        return quotas
+
+    def _train_batches(self):
+        drawn = {}
+        for batch in self.batch_sampler:
+            for idx in batch:
+                drawn.setdefault(self.keys[idx], []).append(idx)
+
+        batches = []
+        for key, quota in self.quotas.items():
+            size = self.sizes[key]
+            items = drawn.get(key, [])
+            need = quota * size
+            if len(items) < need:
+                items = items + random.choices(items or self.pools[key], k=need - len(items))
+            for i in range(quota):
+                batch = items[i * size:(i + 1) * size]
+                positives = self.positives.get(key)
+                if positives and not any(self.labels[idx] == 1 for idx in batch):
+                    batch[random.randrange(size)] = random.choice(positives)
+                batches.append(batch)
+        random.shuffle(batches)
+        return batches
+
+    def _eval_batches(self):
+        batches = []
+        pending = {}
+        for batch in self.batch_sampler:
+            for idx in batch:
+                bucket = pending.setdefault(self.keys[idx], [])
+                bucket.append(idx)
+                if len(bucket) == self.batch_size:
+                    batches.append(bucket)
+                    pending[self.keys[idx]] = []
+        if not self.drop_last:
+            batches.extend(bucket for bucket in pending.values() if bucket)
+        return batches
+
+    def __iter__(self):
+        return iter(self._train_batches() if self.train else self._eval_batches())
+
+    def __len__(self):
+        if self.train:
+            return sum(self.quotas.values())
+        # Evaluation batches cover the dataset once
+        rounding = (lambda n: n // self.batch_size) if self.drop_last else (lambda n: math.ceil(n / self.batch_size))
+        return sum(rounding(len(pool)) for pool in self.pools.values())
+
+
+def bucket_sampler(config, dataset, batch_sampler=None, batch_size=None, drop_last=False):
+    """
+    Batch sampler for a DataLoader over `dataset`. Takes an existing (training, randomly
+    drawn) batch sampler or makes sequential evaluation batches of `batch_size`, and
+    groups them by shape when config['aspect_buckets'] is set.
+    """
+    train = batch_sampler is not None
+    if batch_sampler is None:
+        batch_sampler = TUD.BatchSampler(TUD.SequentialSampler(dataset), batch_size, drop_last)
+    if not config.get('aspect_buckets', False):
+        return batch_sampler
+    return BucketBatchSampler(batch_sampler, bucket_keys(dataset), batch_size or batch_sampler.batch_size, drop_last,
+                              train=train, labels=bucket_labels(dataset) if train else None)
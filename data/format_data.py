@@ -5,12 +5,17 @@ from tqdm import tqdm
 import numpy as np
 import ast
 import json
+import pickle
 import pandas as pd
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from sklearn.utils import resample
+from sklearn.model_selection import StratifiedGroupKFold
 from data.transforms import *
 from storage_adapter import *
 from data.bag_loader import *
+from data.bucketing import *
+from util.distributed import DistributedBalancedBagSampler
+from util.resume import ResumableBatchSampler
 from config import *
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -117,31 +122,71 @@ def count_bag_labels(bags_dict):
         print(f"Label combination {label_combination}: {count} bags")
 
 
-def process_single_image(img_path, root_dir, output_dir, resize_and_pad, video_name = None):
+def process_single_image(img_path, root_dir, targets, video_name = None, grayscale = False):
+    """
+    Decode a source image once, trim it once and write one resized copy per target.
+    targets: list of (output_dir, resize, need_shape). Returns {output_dir: (file name, (height, width))}
+    for every copy that was written or whose shape was asked for.
+    """
+    results = {}
     try:
         if video_name:
             input_path = os.path.join(root_dir, 'videos', video_name, img_path)
         else:
             input_path = os.path.join(root_dir, 'images', img_path)
         
-        output_path = os.path.join(output_dir, os.path.basename(img_path))
-        
-        if file_exists(output_path):
-            return
+        name = os.path.basename(img_path)
+        pending = []
+        for output_dir, resize, need_shape in targets:
+            output_path = os.path.join(output_dir, name)
+            if file_exists(output_path):
+                if need_shape:
+                    w, h = read_image(output_path, use_pil=True).size
+                    results[output_dir] = (name, (h, w))
+                continue
+            pending.append((output_dir, output_path, resize))
+
+        if not pending:
+            return results
 
         image = read_image(input_path, use_pil=True)
         if image is None:
             raise ValueError(f"Failed to read image: {input_path}")
+        
+        if grayscale:
+            # Store single channel images, a third of the size to save and decode
+            image = image.convert("L")
             
-        image = resize_and_pad(image)
-        save_data(image, output_path)
+        # The 5% trim is shared by every size
+        image = trim_long_side(image)
+        for output_dir, output_path, resize in pending:
+            resized = resize(image)
+            save_data(resized, output_path)
+            results[output_dir] = (name, (resized.size[1], resized.size[0]))
     except Exception as e:
         print(f"Error processing image {img_path}: {e}")
-
-def preprocess_and_save_images(config, data, root_dir, output_dir, fill=0):
-    make_dirs(output_dir)
-
-    resize_and_pad = ResizeAndPad(config['img_size'], fill=fill)
+    return results
+
+def preprocess_and_save_images(config, data, root_dir, output_dirs, fill=0):
+    """
+    Crop the export into one cache per size from a single decode of every image.
+    output_dirs: {img_size: directory} (or a single directory for config['img_size']).
+    With aspect_buckets, returns the {file name: (h, w)} shape index of config['img_size'].
+    """
+    if isinstance(output_dirs, str):
+        output_dirs = {config['img_size']: output_dirs}
+
+    aspect_buckets = config.get('aspect_buckets', False)
+    resizers, shapes, known = {}, {}, {}
+    for size, output_dir in output_dirs.items():
+        make_dirs(output_dir)
+        if aspect_buckets:
+            resizers[output_dir] = ResizeLongest(size, trim=False)
+            shapes[output_dir] = load_shape_index(output_dir)
+        else:
+            resizers[output_dir] = ResizeAndPad(size, fill=fill, trim=False)
+            shapes[output_dir] = {}
+        known[output_dir] = len(shapes[output_dir])
 
     # Process regular images
     regular_images = [(img_name, False) for _, row in data.iterrows() 
@@ -169,18 +214,29 @@ def preprocess_and_save_images(config, data, root_dir, output_dir, fill=0):
                 process_single_image,
                 img_path,
                 root_dir,
-                output_dir,
-                resize_and_pad,
-                video_name
+                [(output_dir, resize, aspect_buckets and os.path.basename(img_path) not in shapes[output_dir])
+                 for output_dir, resize in resizers.items()],
+                video_name,
+                config['grayscale']
             ): img_path 
             for img_path, video_name in all_images
         }
         
         with tqdm(total=len(futures)) as pbar:
             for future in as_completed(futures):
-                future.result()
+                if aspect_buckets:
+                    for output_dir, (name, shape) in future.result().items():
+                        shapes[output_dir][name] = shape
+                else:
+                    future.result()
                 pbar.update()
 
+    if aspect_buckets:
+        for output_dir in output_dirs.values():
+            if len(shapes[output_dir]) != known[output_dir]:
+                save_shape_index(output_dir, shapes[output_dir])
+        return shapes[output_dirs[config['img_size']]]
+
 
 def upsample_minority_class(bags_dict, seed=0):
     np.random.seed(seed)  # for reproducibility
@@ -229,11 +285,81 @@ def save_bags_to_csv(bags_dict, file_path):
             writer.writerow([bag_id, labels_str, images_str, image_labels_str])
 
 
+def cropped_images_dir(config, img_size=None):
+    """Image cache for this config: {dataset}_{img_size}[_gray][_rect]_images"""
+    img_size = img_size or config['img_size']
+    suffix = ('_gray' if config.get('grayscale', False) else '') + ('_rect' if config.get('aspect_buckets', False) else '')
+    return f"{config['cropped_images']}/{config['dataset_name']}_{img_size}{suffix}_images"
+
+
+def preprocess_sizes(config):
+    """img_size first, then any extra or progressive resizing sizes to crop from the same decode"""
+    sizes = [config['img_size']]
+    extra = list(config.get('extra_img_sizes', [])) + [size for _, size in config.get('progressive_resizing', [])]
+    for size in extra:
+        if size not in sizes:
+            sizes.append(size)
+    return sizes
+
+
+def save_bag_cache(path, bags_train, bags_val):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        pickle.dump((bags_train, bags_val), f)
+
+
+def load_bag_cache(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def assign_folds(bags_dict, n_folds, seed=0):
+    """
+    Accession grouped k-fold, stratified by bag label. Returns (bag_ids, folds) arrays,
+    the fold of every bag is the one it is validated in.
+    """
+    bag_ids = np.array(list(bags_dict.keys()))
+    labels = [int(1 in bags_dict[b]['bag_labels']) for b in bag_ids]
+    groups = [bags_dict[b]['Accession_Number'] for b in bag_ids]
+    
+    folds = np.zeros(len(bag_ids), dtype=np.int64)
+    splitter = StratifiedGroupKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    for k, (_, val_index) in enumerate(splitter.split(bag_ids, labels, groups)):
+        folds[val_index] = k
+    return bag_ids, folds
+
+
+def split_fold(bags_dict, bag_ids, folds, fold):
+    """(train, val) bags for one fold, the fold assignment is applied as a mask over bag_ids"""
+    mask = folds == fold
+    bags_train = {b: bags_dict[b] for b in bag_ids[~mask] if b in bags_dict}
+    bags_val = {b: bags_dict[b] for b in bag_ids[mask] if b in bags_dict}
+    return bags_train, bags_val
+
+
+def apply_fold(config, bags_train, bags_val):
+    """Replace the Valid column split with config['fold'] of config['cv_folds']"""
+    if config.get('cv_folds') is None or config.get('fold') is None:
+        return bags_train, bags_val
+    with open(config['cv_folds'], 'rb') as f:
+        bag_ids, folds = pickle.load(f)
+    bags_train, bags_val = split_fold({**bags_train, **bags_val}, bag_ids, folds, config['fold'])
+    print(f"Fold {config['fold']}: {len(bags_train)} training and {len(bags_val)} validation bags")
+    return bags_train, bags_val
+
+
 def prepare_all_data(config):
+    
+    # Bags prepared once and shared between runs (config['bag_cache'])
+    if config.get('bag_cache') and os.path.exists(config['bag_cache']):
+        bags_train, bags_val = load_bag_cache(config['bag_cache'])
+        print(f"Loaded {len(bags_train)} training and {len(bags_val)} validation bags from {config['bag_cache']}")
+        bags_train, bags_val = apply_fold(config, bags_train, bags_val)
+        return (bags_train, bags_val) + make_bag_loaders(config, bags_train, bags_val)
 
     # Path to the config file
     export_location = f"{config['export_location']}/{config['dataset_name']}"
-    cropped_images = f"{config['cropped_images']}/{config['dataset_name']}_{config['img_size']}_images"
+    cropped_images = cropped_images_dir(config)
     
     print("Preprocessing Data...")
     data = read_csv(f'{export_location}/TrainData.csv')
@@ -245,8 +371,9 @@ def prepare_all_data(config):
     else:
         instance_data = None
        
-    #Cropping images
-    preprocess_and_save_images(config, data, export_location, cropped_images)
+    #Cropping images (every size in one pass over the export)
+    output_dirs = {size: cropped_images_dir(config, size) for size in preprocess_sizes(config)}
+    shapes = preprocess_and_save_images(config, data, export_location, output_dirs)
     
     # Split the data into training and validation sets
     train_patient_ids = data[data['Valid'] == 0]['Accession_Number']
@@ -256,6 +383,10 @@ def prepare_all_data(config):
     
     bags_train = create_bags(config, train_data, cropped_images, instance_data)
     bags_val = create_bags(config, val_data, cropped_images, instance_data)
+    if shapes is not None:
+        attach_shapes(bags_train, shapes)
+        attach_shapes(bags_val, shapes)
+    bags_train, bags_val = apply_fold(config, bags_train, bags_val)
     
     #bags_train = upsample_minority_class(bags_train)  # Upsample the minority class in the training set
     
@@ -269,13 +400,57 @@ def prepare_all_data(config):
     
     
     
-    # Create bag datasets
-    bag_dataset_train = BagOfImagesDataset(bags_train, transform=train_transform, save_processed=False)
-    bag_dataset_val = BagOfImagesDataset(bags_val, transform=val_transform)
-    train_sampler = BalancedBagSampler(bag_dataset_train, batch_size=config['bag_batch_size'])
-    val_sampler = BalancedBagSampler(bag_dataset_val, batch_size=config['bag_batch_size'])
-    bag_dataloader_train = TUD.DataLoader(bag_dataset_train, batch_sampler=train_sampler, collate_fn=collate_bag)
-    bag_dataloader_val = TUD.DataLoader(bag_dataset_val, batch_sampler=val_sampler, collate_fn=collate_bag)
+    bag_dataloader_train, bag_dataloader_val = make_bag_loaders(config, bags_train, bags_val)
+
 
+    return bags_train, bags_val, bag_dataloader_train, bag_dataloader_val
 
-    return bags_train, bags_val, bag_dataloader_train, bag_dataloader_val
\ No newline at end of file
+
+def loader_kwargs(config):
+    """DataLoader worker settings from the config"""
+    workers = config.get('num_workers', 0)
+    if workers == 0:
+        return {}
+    return {
+        'num_workers': workers,
+        'prefetch_factor': config.get('prefetch_factor', 2),
+        'pin_memory': config.get('pin_memory', False) and torch.cuda.is_available(),
+        'persistent_workers': config.get('persistent_workers', False),
+    }
+
+
+def make_bag_loaders(config, bags_train, bags_val, distributed=False):
+    # Create bag datasets
+    bag_dataset_train = BagOfImagesDataset(bags_train, transform=train_transform, save_processed=False, grayscale=config['grayscale'])
+    bag_dataset_val = BagOfImagesDataset(bags_val, transform=val_transform, grayscale=config['grayscale'])
+    if distributed:
+        # Every rank gets its own class balanced share of the bags, call set_epoch() on the train sampler
+        train_sampler = DistributedBalancedBagSampler(bag_dataset_train, batch_size=config['bag_batch_size'])
+        val_sampler = DistributedBalancedBagSampler(bag_dataset_val, batch_size=config['bag_batch_size'])
+    else:
+        train_sampler = BalancedBagSampler(bag_dataset_train, batch_size=config['bag_batch_size'])
+        val_sampler = BalancedBagSampler(bag_dataset_val, batch_size=config['bag_batch_size'])
+    # Resumable so util/resume.py can restart mid-epoch
+    train_sampler = ResumableBatchSampler(bucket_sampler(config, bag_dataset_train, train_sampler))
+    val_sampler = bucket_sampler(config, bag_dataset_val, val_sampler)
+    bag_dataloader_train = NormalizedLoader(TUD.DataLoader(bag_dataset_train, batch_sampler=train_sampler, collate_fn=collate_bag, **loader_kwargs(config)), augment=train_augment)
+    bag_dataloader_val = NormalizedLoader(TUD.DataLoader(bag_dataset_val, batch_sampler=val_sampler, collate_fn=collate_bag, **loader_kwargs(config)))
+    return bag_dataloader_train, bag_dataloader_val
+
+
+def bags_at_size(config, bags_dict, size):
+    """Copy of bags_dict reading its images from the `size` cache instead of img_size's"""
+    if size == config['img_size']:
+        return bags_dict
+    target = cropped_images_dir(config, size)
+    
+    resized = {}
+    for bag_id, bag_info in bags_dict.items():
+        bag_info = dict(bag_info)
+        bag_info['images'] = [os.path.join(target, os.path.basename(f)) for f in bag_info['images']]
+        bag_info['videos'] = [os.path.join(target, os.path.basename(f)) for f in bag_info['videos']]
+        resized[bag_id] = bag_info
+        
+    if config.get('aspect_buckets', False):
+        attach_shapes(resized, load_shape_index(target))
+    return resized
\ No newline at end of file
@@ -3,11 +3,14 @@ import torch.utils.data as TUD
 from torch.utils.data import Sampler
 import cv2
 from storage_adapter import *
+from data.instance_registry import INSTANCE_REGISTRY
+from data.transforms import decode_image
 
 class Instance_Dataset(TUD.Dataset):
     def __init__(self, bags_dict, selection_mask, transform=None, warmup=True, 
-                 dual_output=False, only_negative=False, max_positive=None):
+                 dual_output=False, only_negative=False, max_positive=None, grayscale=False):
         self.transform = transform
+        self.grayscale = grayscale
         self.warmup = warmup
         self.dual_output = dual_output
         self.only_negative = only_negative
@@ -39,6 +42,7 @@ class Instance_Dataset(TUD.Dataset):
             image_labels.extend([[None]] * len(videos))  # Add empty labels for videos
             
             acc_number_key = accession_number.item() if isinstance(accession_number, torch.Tensor) else accession_number
+            base_id = INSTANCE_REGISTRY.register_bag(bag_id, acc_number_key, bag_info['images'], videos)
             
             if bag_id in selection_mask:
                 selection_mask_labels, _ = selection_mask[bag_id]
@@ -81,7 +85,7 @@ class Instance_Dataset(TUD.Dataset):
                         image_label = -1
                 
                 if image_label is not None:
-                    unique_id = f"{acc_number_key}_{idx}_{'vid' if is_video else 'img'}"
+                    unique_id = base_id + idx
                     
                     if image_label == 1 and self.max_positive is not None and not is_video:
                         # Store positive instances temporarily (only for images)
@@ -104,6 +108,17 @@ class Instance_Dataset(TUD.Dataset):
             
             print(f"Selected {len(selected_positive)} positive instances out of {len(temp_positive_data)} total positive instances")
 
+        # Registry ids, resolve with resolve_instance_ids when writing reports
+        self.unique_ids = np.array(self.unique_ids, dtype=np.int64)
+
+        # Shape bucket of every instance when the bags come from an aspect bucketed cache
+        shape_of = {}
+        for bag_info in bags_dict.values():
+            if 'shapes' in bag_info:
+                shape_of.update(zip(list(bag_info['images']) + list(bag_info['videos']), bag_info['shapes']))
+        if shape_of:
+            self.shapes = [shape_of[img] for img in self.images]
+
         print(f"Dataset created with {len(self.images)} instances")
         if self.only_negative:
             print("Dataset contains only negative (label 0) instances")
@@ -117,13 +132,14 @@ class Instance_Dataset(TUD.Dataset):
         instance_label = self.output_image_labels[index]
         unique_id = self.unique_ids[index]
         
-        img = read_image(img_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(img)
+        img = decode_image(img_path, self.grayscale)
         
         if self.dual_output:
-            image_data_q = self.transform(img)
+            # CLAHE works in place and ToUint8Tensor returns a view, each view needs its own buffer
+            image_data_q = self.transform(img.copy())
             image_data_k = self.transform(img)
+            if image_data_q.data_ptr() == image_data_k.data_ptr():
+                raise ValueError("Instance_Dataset transform returned the same buffer for both views")
             return (image_data_q, image_data_k), instance_label, unique_id
         else:
             image_data = self.transform(img)
@@ -152,6 +168,7 @@ def collate_instance(batch):
         batch_data_q = torch.stack(batch_data_q)
         batch_data_k = torch.stack(batch_data_k)
         batch_labels = torch.tensor(batch_labels, dtype=torch.long)
+        batch_ids = torch.tensor(batch_ids, dtype=torch.long)
 
         return (batch_data_q, batch_data_k), batch_labels, batch_ids
     else:
@@ -166,6 +183,7 @@ def collate_instance(batch):
 
         batch_data = torch.stack(batch_data)
         batch_labels = torch.tensor(batch_labels, dtype=torch.long)
+        batch_ids = torch.tensor(batch_ids, dtype=torch.long)
 
         return batch_data, batch_labels, batch_ids
 
@@ -0,0 +1,89 @@
+import numpy as np
+import torch
+
+# Every instance (image or video frame) of every bag gets a compact int64 id.
+# Loaders, trackers and pseudo label stores carry these ids as tensors, they
+# are only turned back into the old '{accession}_{idx}_{img|vid}' strings when
+# a report is written. Ids depend on the registration order of this process,
+# anything saved to disk keys instances by (bag id, position) instead, see keys().
+
+
+class InstanceRegistry:
+    def __init__(self):
+        self._bag_base = {}  # bag_id -> (first instance id, instance count)
+        self.bag_ids = []
+        self.accessions = []
+        self.positions = []
+        self.is_video = []
+        self.paths = []
+
+    def __len__(self):
+        return len(self.bag_ids)
+
+    def register_bag(self, bag_id, accession, images, videos=()):
+        """
+        Register the instances of a bag (images first, then video frames) and return
+        the id of its first instance. Registering the same bag again is a no-op.
+        """
+        if isinstance(bag_id, torch.Tensor):
+            bag_id = bag_id.item()
+        if isinstance(accession, torch.Tensor):
+            accession = accession.item()
+
+        paths = list(images) + list(videos)
+        registered = self._bag_base.get(bag_id)
+        if registered is not None:
+            base, count = registered
+            if count == len(paths) and self.paths[base:base + count] == paths:
+                return base
+
+        # New bag, or a different dataset reusing the bag id
+        base = len(self.bag_ids)
+        self._bag_base[bag_id] = (base, len(paths))
+        for idx, path in enumerate(paths):
+            self.bag_ids.append(bag_id)
+            self.accessions.append(accession)
+            self.positions.append(idx)
+            self.is_video.append(idx >= len(images))
+            self.paths.append(path)
+        return base
+
+    def register_bags(self, bags_dict):
+        for bag_id, bag_info in bags_dict.items():
+            self.register_bag(bag_id, bag_info['Accession_Number'], bag_info['images'], bag_info['videos'])
+
+    def instance_id(self, bag_id, position):
+        if isinstance(bag_id, torch.Tensor):
+            bag_id = bag_id.item()
+        return self._bag_base[bag_id][0] + position
+
+    def lookup(self, bag_id, position):
+        """Current id of an instance, None if its bag isn't registered or is shorter"""
+        registered = self._bag_base.get(bag_id)
+        if registered is None or not 0 <= position < registered[1]:
+            return None
+        return registered[0] + position
+
+    def keys(self, count=None):
+        """(bag ids, positions) of the ids below `count`, stable across processes"""
+        count = len(self) if count is None else min(count, len(self))
+        return list(self.bag_ids[:count]), list(self.positions[:count])
+
+    def info(self, instance_id):
+        """(bag id, position, is video, path) of one instance"""
+        i = int(instance_id)
+        return self.bag_ids[i], self.positions[i], self.is_video[i], self.paths[i]
+
+    def resolve(self, ids):
+        """Report strings for a list/array/tensor of instance ids"""
+        if isinstance(ids, torch.Tensor):
+            ids = ids.cpu().numpy()
+        return [f"{self.accessions[i]}_{self.positions[i]}_{'vid' if self.is_video[i] else 'img'}"
+                for i in np.asarray(ids, dtype=np.int64).ravel().tolist()]
+
+
+INSTANCE_REGISTRY = InstanceRegistry()
+
+
+def resolve_instance_ids(ids):
+    return INSTANCE_REGISTRY.resolve(ids)
@@ -1,5 +1,8 @@
 import matplotlib.pyplot as plt
 from fastai.vision.all import *
+from util.tensor_io import *
+from util.checkpoint_writer import CheckpointWriter
+from data.sudo_labels import load_selection_mask
 import shutil
 
     
@@ -53,65 +56,85 @@ def save_accuracy_to_file(epoch, train_acc, val_acc, label_columns, file_path):
     
 
 
+def get_writer(state):
+    """Checkpoint writer for this run, falls back to writing inline"""
+    writer = state.get('writer')
+    if writer is None:
+        writer = CheckpointWriter(synchronous=True)
+    return writer
+
+
+def write_stats(stats_path, stats):
+    # Carry over fpr/tpr history from the previous stats
+    if os.path.exists(stats_path):
+        with open(stats_path, 'rb') as f:
+            previous = pickle.load(f)
+            stats['all_fpr'] = previous.get('all_fpr', [])
+            stats['all_tpr'] = previous.get('all_tpr', [])
+    else:
+        stats['all_fpr'] = []
+        stats['all_tpr'] = []
+
+    with atomic_write_path(stats_path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(stats, f)
+
+
+def copy_palm_state(model_folder):
+    # Duplicate head palm state
+    palm_state_source = resolve_checkpoint(os.path.dirname(model_folder), 'palm_state')
+    palm_state_destination = resolve_checkpoint(model_folder, 'palm_state')
+    
+    if palm_state_source and not palm_state_destination:
+        shutil.copy2(palm_state_source, os.path.join(model_folder, os.path.basename(palm_state_source)))
+    elif not palm_state_source:
+        print(f"Warning: palm_state not found in the parent directory of {model_folder}")
+    else:
+        print(f"palm_state already exists in {model_folder}")
+
+
 def save_state(state, config, train_acc, val_loss, val_acc, bagmodel, optimizer, classifier=None, palm = None):
     if state['warmup']:
         model_folder = state['head_folder']
     else:
         model_folder = state['model_folder']
         
-    model_path = f"{model_folder}/model.pth"
-    classifier_path = f"{model_folder}/classifier.pth"
-    optimizer_path = f"{model_folder}/optimizer.pth"
+    model_path = f"{model_folder}/model{TENSOR_FILE_EXT}"
+    classifier_path = f"{model_folder}/classifier{TENSOR_FILE_EXT}"
+    optimizer_path = f"{model_folder}/optimizer{TENSOR_FILE_EXT}"
     stats_path = f"{model_folder}/stats.pkl"
     
     label_columns = config['label_columns']
-    train_losses_over_epochs = state['train_losses']
-    valid_losses_over_epochs = state['valid_losses']
+    # Copy the histories, training keeps appending to them
+    train_losses_over_epochs = list(state['train_losses'])
+    valid_losses_over_epochs = list(state['valid_losses'])
+    
+    # Everything below is snapshotted now and written in order by the writer
+    writer = get_writer(state)
 
     # Save the model and optimizer
-    torch.save(bagmodel.state_dict(), model_path)
+    writer.save(save_nested_state, bagmodel.state_dict(), model_path)
     if classifier:
-        torch.save(classifier.state_dict(), classifier_path)
-    torch.save(optimizer.state_dict(), optimizer_path)
+        writer.save(save_nested_state, classifier.state_dict(), classifier_path)
+    writer.save(save_nested_state, optimizer.state_dict(), optimizer_path)
 
-    # Initialize or load previous metrics
-    if os.path.exists(stats_path):
-        with open(stats_path, 'rb') as f:
-            stats = pickle.load(f)
-            all_fpr = stats.get('all_fpr', [])
-            all_tpr = stats.get('all_tpr', [])
-    else:
-        all_fpr = []
-        all_tpr = []
-
-
-    # Save updated stats with all_fpr and all_tpr
-    with open(stats_path, 'wb') as f:
-        val_loss_key = 'val_loss_instance' if state['mode'] == 'instance' else 'val_loss_bag'
-        pickle.dump({
-            'epoch': state['epoch'] + 1,
-            'train_losses': train_losses_over_epochs,
-            'valid_losses': valid_losses_over_epochs,
-            val_loss_key: val_loss,
-            'all_fpr': all_fpr,
-            'all_tpr': all_tpr
-        }, f)
+    # Save updated stats
+    val_loss_key = 'val_loss_instance' if state['mode'] == 'instance' else 'val_loss_bag'
+    writer.submit(write_stats, stats_path, {
+        'epoch': state['epoch'] + 1,
+        'train_epochs': state.get('train_epochs', 0),
+        'train_seconds': state.get('train_seconds', 0.0),
+        'train_losses': train_losses_over_epochs,
+        'valid_losses': valid_losses_over_epochs,
+        val_loss_key: val_loss,
+    })
 
     if palm is not None:
-        # Duplicate head palm state
-        palm_state_source = os.path.join(os.path.dirname(model_folder), 'palm_state.pkl')
-        palm_state_destination = os.path.join(model_folder, 'palm_state.pkl')
-        
-        if os.path.exists(palm_state_source) and not os.path.exists(palm_state_destination):
-            shutil.copy2(palm_state_source, palm_state_destination)
-        elif not os.path.exists(palm_state_source):
-            print(f"Warning: palm_state.pkl not found in the parent directory of {model_folder}")
-        else:
-            print(f"palm_state.pkl already exists in {model_folder}")
+        writer.submit(copy_palm_state, model_folder)
             
     # Save the plots
-    plot_loss(train_losses_over_epochs, valid_losses_over_epochs, f"{model_folder}/loss.png")
-    save_accuracy_to_file(state['epoch'], train_acc, val_acc, label_columns, f"{model_folder}/{state['mode']}_accuracy.txt")
+    writer.plot(plot_loss, train_losses_over_epochs, valid_losses_over_epochs, f"{model_folder}/loss.png")
+    writer.submit(save_accuracy_to_file, state['epoch'], train_acc, val_acc, label_columns, f"{model_folder}/{state['mode']}_accuracy.txt")
         
         
 
@@ -133,10 +156,10 @@ def setup_model(model, config, optimizer = None):
     pretrained_name = f"{config['head_name']}"
     
     head_folder = os.path.join(parent_dir, "models", pretrained_name)
-    head_path = os.path.join(head_folder, f"model.pth")
+    head_path = resolve_checkpoint(head_folder, "model")
 
     model_folder = os.path.join(parent_dir, "models", pretrained_name, model_name)
-    model_path = os.path.join(model_folder, f"model.pth")
+    model_path = resolve_checkpoint(model_folder, "model")
     stats_path = os.path.join(model_folder, f"stats.pkl")
 
     state = {
@@ -154,28 +177,34 @@ def setup_model(model, config, optimizer = None):
         'val_loss_bag': 99999,
         'selection_mask': [],
         'warmup': False,
-        'pickup_warmup': False
+        'pickup_warmup': False,
+        'train_epochs': 0, # Passes over any training loader, drives progressive resizing
+        'train_seconds': 0.0,
+        'writer': CheckpointWriter(synchronous=not config.get('async_checkpoint', True))
     }
 
     def load_model(model, model_path):
-        state_dict = torch.load(model_path)
+        # Weights are memory mapped on the CPU, load_state_dict copies them to the model's device
+        state_dict = load_checkpoint(model_path, device='cpu')
         model.load_state_dict(state_dict)
         return model
     
-    if os.path.exists(model_path):
+    if model_path:
         print(f"Loaded pre-existing model from {model_name}")
         model = load_model(model, model_path)
         state['train_losses'], state['valid_losses'], state['epoch'], state['val_loss_bag'], state['val_loss_instance'], state['selection_mask'] = load_state(stats_path, model_folder)
-        state['palm_path'] = os.path.join(model_folder, "palm_state.pkl")
+        state['train_epochs'], state['train_seconds'] = load_progress(stats_path)
+        state['palm_path'] = resolve_checkpoint(model_folder, "palm_state") or os.path.join(model_folder, f"palm_state{TENSOR_FILE_EXT}")
     else:
         print(f"{model_name} does not exist, creating new instance")
         os.makedirs(model_folder, exist_ok=True)
-        state['palm_path'] = os.path.join(head_folder, "palm_state.pkl")
+        state['palm_path'] = resolve_checkpoint(head_folder, "palm_state") or os.path.join(head_folder, f"palm_state{TENSOR_FILE_EXT}")
         
-        if os.path.exists(head_path):
+        if head_path:
             state['pickup_warmup'] = True
             state['warmup'] = False
             model = load_model(model, head_path)
+            state['train_epochs'], state['train_seconds'] = load_progress(os.path.join(head_folder, "stats.pkl"))
             print(f"Loaded pre-trained model from {pretrained_name}")
         else:
             state['warmup'] = True
@@ -229,8 +258,17 @@ def load_state(stats_path, target_folder):
         val_loss_instance = saved_stats.get('val_loss_instance', 99999)
     
     # Load the selection_mask dictionary from the file
-    if os.path.exists(f'{target_folder}/selection_mask.pkl'):
-        with open(f'{target_folder}/selection_mask.pkl', 'rb') as file:
-            selection_mask = pickle.load(file)
+    selection_mask_path = resolve_checkpoint(target_folder, 'selection_mask')
+    if selection_mask_path:
+        selection_mask = load_selection_mask(selection_mask_path)
             
-    return train_losses, valid_losses, epoch, val_loss_bag, val_loss_instance, selection_mask
\ No newline at end of file
+    return train_losses, valid_losses, epoch, val_loss_bag, val_loss_instance, selection_mask
+
+
+def load_progress(stats_path):
+    """(training epochs, training seconds) saved with the stats, zeros for older checkpoints"""
+    if not os.path.exists(stats_path):
+        return 0, 0.0
+    with open(stats_path, 'rb') as f:
+        saved_stats = pickle.load(f)
+    return saved_stats.get('train_epochs', 0), saved_stats.get('train_seconds', 0.0)
@@ -0,0 +1,311 @@
+import os
+import io
+import json
+import heapq
+import random
+import tarfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import cv2
+import torch
+import torch.utils.data as TUD
+from storage_adapter import *
+from data.transforms import decode_image_bytes, fit_to_shape, NormalizedLoader
+from data.bag_loader import collate_bag
+from data.format_data import loader_kwargs
+from util.tensor_io import atomic_write_path
+from util.distributed import get_rank, get_world_size
+from config import *
+
+# Sharded bag storage for multi node training. export_shards() packs the bags of a
+# bags_dict into tar shards of about equal size (one JSON record per bag followed by
+# its PNG encoded images), each shard holding its share of both classes. The shards
+# are then read front to back by ShardedBagDataset, so a node only needs its own
+# shards instead of random access to the whole cropped image cache.
+#
+#   <shard_dir>/shards.json            index: file, bags, positive bags, bytes per shard
+#   <shard_dir>/shard-00000.tar ...    <bag_id>.json, <bag_id>.000.png, <bag_id>.001.png, ...
+
+SHARD_INDEX = "shards.json"
+
+
+def load_shard_index(shard_dir):
+    with open(os.path.join(shard_dir, SHARD_INDEX)) as f:
+        return json.load(f)
+
+
+def _bag_files(bag_info):
+    return list(bag_info['images']) + list(bag_info['videos'])
+
+
+def _is_positive(bag_info):
+    return 1 in bag_info['bag_labels']
+
+
+def _estimate_bytes(bag_info):
+    total = 0
+    for path in _bag_files(bag_info):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            total += 1 # Remote storage, fall back to counting images
+    return total
+
+
+def assign_shards(bags_dict, shard_size_mb=256, min_shards=1):
+    """
+    Split the bag ids into shards of about equal size. Each class is spread on its own,
+    largest bags first onto the smallest shard, so every shard also keeps about the
+    dataset's ratio of positive bags.
+    """
+    sizes = {bag_id: _estimate_bytes(bag_info) for bag_id, bag_info in bags_dict.items()}
+    n_shards = max(min_shards, -(-sum(sizes.values()) // (shard_size_mb * 2**20)))
+    n_shards = min(n_shards, max(1, len(bags_dict)))
+
+    shards = [[] for _ in range(n_shards)]
+    for positive in (True, False):
+        heap = [(0, i) for i in range(n_shards)]
+        bag_ids = [b for b, info in bags_dict.items() if _is_positive(info) == positive]
+        for bag_id in sorted(bag_ids, key=lambda b: sizes[b], reverse=True):
+            size, i = heapq.heappop(heap)
+            shards[i].append(bag_id)
+            heapq.heappush(heap, (size + sizes[bag_id], i))
+    return shards
+
+
+def _add_member(tar, name, data):
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    tar.addfile(member, io.BytesIO(data))
+
+
+def _write_shard(path, bag_ids, bags_dict):
+    n_positive = 0
+    with atomic_write_path(path) as tmp_path:
+        with tarfile.open(tmp_path, 'w') as tar:
+            for bag_id in bag_ids:
+                bag_info = bags_dict[bag_id]
+                files = _bag_files(bag_info)
+                record = {
+                    'bag_id': int(bag_id),
+                    'bag_labels': list(bag_info['bag_labels']),
+                    'image_labels': list(bag_info['image_labels']),
+                    'n_images': len(bag_info['images']),
+                    'n_videos': len(bag_info['videos']),
+                    'bucket': bag_info.get('bucket'),
+                }
+                _add_member(tar, f"{bag_id}.json", json.dumps(record, default=lambda v: v.item()).encode())
+
+                # PNG keeps the cached pixels exactly
+                for i, path_ in enumerate(files):
+                    ok, encoded = cv2.imencode('.png', read_image(path_))
+                    if not ok:
+                        raise ValueError(f"Could not encode {path_}")
+                    _add_member(tar, f"{bag_id}.{i:03d}.png", encoded.tobytes())
+                n_positive += _is_positive(bag_info)
+    return {'file': os.path.basename(path), 'bags': len(bag_ids), 'positive': n_positive, 'bytes': os.path.getsize(path)}
+
+
+def export_shards(bags_dict, shard_dir, shard_size_mb=256, min_shards=1):
+    """
+    Write `bags_dict` (as returned by prepare_all_data) to tar shards in `shard_dir`.
+    Set min_shards to at least ranks x loader workers so every reader gets its own shards.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    assignment = assign_shards(bags_dict, shard_size_mb, min_shards)
+
+    entries = [None] * len(assignment)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {
+            executor.submit(_write_shard, os.path.join(shard_dir, f"shard-{i:05d}.tar"), bag_ids, bags_dict): i
+            for i, bag_ids in enumerate(assignment)
+        }
+        for future in as_completed(futures):
+            entries[futures[future]] = future.result()
+
+    with atomic_write_path(os.path.join(shard_dir, SHARD_INDEX)) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump({'shards': entries}, f, indent=4)
+
+    total = sum(e['bytes'] for e in entries)
+    print(f"Exported {len(bags_dict)} bags to {len(entries)} shards ({total / 2**30:.2f} GB) in {shard_dir}")
+    return entries
+
+
+def read_shard(path):
+    """Yield (record, [encoded images]) for every bag of a shard, reading the file sequentially"""
+    with tarfile.open(path, 'r|') as tar:
+        record, images = None, []
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name.endswith('.json'):
+                if record is not None:
+                    yield record, images
+                record, images = json.loads(data), []
+            else:
+                images.append(data)
+        if record is not None:
+            yield record, images
+
+
+class ShardedBagDataset(TUD.IterableDataset):
+    """
+    Streams bags from export_shards() output and yields the same items as
+    BagOfImagesDataset, so it plugs into a DataLoader with collate_bag.
+
+    Shards are reshuffled every epoch (set_epoch) with a seed shared by all ranks and
+    dealt out to each (rank, loader worker). With fewer shards than readers, every
+    reader goes through all shards and keeps every n-th bag instead.
+
+    balanced=True interleaves positive and negative bags from two shuffle buffers and
+    stops after 2 x (minority class size) bags per epoch, split over the readers, which
+    is what BalancedBagSampler draws. A reader whose shards run short of a class reads
+    them again for more, so every rank yields the same number of bags.
+    """
+    def __init__(self, shard_dir, transform=None, grayscale=False, shuffle_buffer=64, balanced=True, seed=0, rank=None, world_size=None):
+        self.shard_dir = shard_dir
+        self.shards = load_shard_index(shard_dir)['shards']
+        self.transform = transform
+        self.grayscale = grayscale
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.balanced = balanced
+        self.seed = seed
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.epoch = 0
+
+        self.n_bags = sum(s['bags'] for s in self.shards)
+        self.n_positive = sum(s['positive'] for s in self.shards)
+        self.min_class_size = min(self.n_positive, self.n_bags - self.n_positive)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # Bags this rank yields per epoch
+        if self.balanced:
+            return 2 * (self.min_class_size // self.world_size)
+        return -(-self.n_bags // self.world_size)
+
+    def _reader(self):
+        worker = TUD.get_worker_info()
+        n_workers, worker_id = (worker.num_workers, worker.id) if worker else (1, 0)
+        return self.rank * n_workers + worker_id, self.world_size * n_workers, n_workers
+
+    def _my_shards(self, reader, n_readers, rng):
+        order = list(range(len(self.shards)))
+        rng.shuffle(order)
+        if len(order) >= n_readers:
+            return order[reader::n_readers], 1, 0
+        return order, n_readers, reader
+
+    def _records(self, shards, stride, offset, rng, passes):
+        """Bags of `shards` in order, one bag in `stride` starting at `offset`, reshuffling the shards each pass"""
+        for _ in passes:
+            count = 0
+            for i in shards:
+                for item in read_shard(os.path.join(self.shard_dir, self.shards[i]['file'])):
+                    if count % stride == offset:
+                        yield item
+                    count += 1
+            shards = rng.sample(shards, len(shards))
+
+    def _shuffled(self, records, rng):
+        buffer = []
+        for item in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], item = item, buffer[i]
+            yield item
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _interleaved(self, records, rng, quota, fill):
+        """Alternate positive and negative bags until `quota` bags have been yielded"""
+        buffers = ([], [])
+        yielded = 0
+        for item in records:
+            buffer = buffers[_is_positive(item[0])]
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+            else:
+                # The majority class overflows its buffer, overwriting bags is the downsampling
+                buffer[rng.randrange(len(buffer))] = item
+
+            while yielded < quota and all(len(b) >= f for b, f in zip(buffers, fill)):
+                for cls in rng.sample((0, 1), 2):
+                    buffer = buffers[cls]
+                    i = rng.randrange(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+                yielded += 2
+            if yielded >= quota:
+                return
+
+    def _load(self, record, images):
+        bucket = tuple(record['bucket']) if record.get('bucket') else None
+        image_data = []
+        for data in images:
+            img = decode_image_bytes(data, self.grayscale)
+            if bucket:
+                img = fit_to_shape(img, bucket)
+            image_data.append(self.transform(img) if self.transform else torch.from_numpy(img))
+        image_data = torch.stack(image_data)
+
+        # Same label handling as BagOfImagesDataset, video frames get -1
+        instance_labels = list(record['image_labels']) + [[None]] * record['n_videos']
+        bag_labels_tensor = torch.tensor(record['bag_labels'], dtype=torch.float32)
+        instance_labels_tensors = [torch.tensor(labels, dtype=torch.float32) if labels != [None] else torch.tensor([-1], dtype=torch.float32) for labels in instance_labels]
+        return image_data, bag_labels_tensor, instance_labels_tensors, record['bag_id']
+
+    def __iter__(self):
+        reader, n_readers, n_workers = self._reader()
+        shared_rng = random.Random(self.seed + self.epoch)
+        rng = random.Random((self.seed + self.epoch) * n_readers + reader + 1)
+        shards, stride, offset = self._my_shards(reader, n_readers, shared_rng)
+
+        if not self.balanced:
+            records = self._shuffled(self._records(shards, stride, offset, rng, range(1)), rng)
+        else:
+            positive = sum(self.shards[i]['positive'] for i in shards) // stride
+            negative = sum(self.shards[i]['bags'] - self.shards[i]['positive'] for i in shards) // stride
+            if positive == 0 or negative == 0:
+                raise ValueError(f"Reader {reader} has shards with only one class, export more balanced or fewer shards ({len(self.shards)} shards, {n_readers} readers)")
+
+            # This rank's quota, split over its loader workers
+            rank_quota = len(self) // 2
+            quota = 2 * (rank_quota // n_workers + (reader % n_workers < rank_quota % n_workers))
+            # Counts are per shard estimates when readers share shards, so only wait for half of them
+            fill = (min(self.shuffle_buffer, max(1, negative // 2)), min(self.shuffle_buffer, max(1, positive // 2)))
+            records = self._interleaved(self._records(shards, stride, offset, rng, itertools.count()), rng, quota, fill)
+
+        for record, images in records:
+            yield self._load(record, images)
+
+
+def shard_dirs(config):
+    """Train and val shard folders next to the image cache"""
+    root = f"{config['export_location']}/{config['dataset_name']}/shards_{config['img_size']}"
+    return f"{root}/train", f"{root}/val"
+
+
+def make_shard_loaders(config, train_dir, val_dir):
+    """make_bag_loaders over exported shards, batches of config['bag_batch_size'] bags with the config's worker settings"""
+    dataset_train = ShardedBagDataset(train_dir, transform=train_transform, grayscale=config['grayscale'])
+    dataset_val = ShardedBagDataset(val_dir, transform=val_transform, grayscale=config['grayscale'], shuffle_buffer=1)
+    bag_dataloader_train = NormalizedLoader(TUD.DataLoader(dataset_train, batch_size=config['bag_batch_size'], collate_fn=collate_bag, **loader_kwargs(config)), augment=train_augment)
+    bag_dataloader_val = NormalizedLoader(TUD.DataLoader(dataset_val, batch_size=config['bag_batch_size'], collate_fn=collate_bag, **loader_kwargs(config)))
+    return bag_dataloader_train, bag_dataloader_val
+
+
+if __name__ == '__main__':
+    from data.format_data import prepare_all_data
+
+    # Export the current dataset, e.g. for 2 nodes x 4 GPUs x 4 workers
+    config = build_config('1', 'TEST75', DogDataConfig)
+    bags_train, bags_val, _, _ = prepare_all_data(config)
+    train_dir, val_dir = shard_dirs(config)
+    export_shards(bags_train, train_dir, min_shards=32)
+    export_shards(bags_val, val_dir, min_shards=32)
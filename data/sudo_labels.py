@@ -1,4 +1,196 @@
 from fastai.vision.all import *
+import torch.distributed as dist
+from util.tensor_io import *
+
+
+class SelectionMask:
+    """
+    Flat pseudo label selection. `offsets[i]:offsets[i+1]` is the slice of bag_ids[i]
+    in `mask` (1/0 selected label, -1 not selected) and `probs`.
+
+    Lookups behave like the old {bag_id: [mask, probs]} dict, so Instance_Dataset
+    can use it directly.
+    """
+    def __init__(self, bag_ids, offsets, mask, probs):
+        self.bag_ids = np.asarray(bag_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.mask = np.asarray(mask, dtype=np.int64)
+        self.probs = np.asarray(probs)
+        self._index = {bag_id: i for i, bag_id in enumerate(self.bag_ids.tolist())}
+
+    def __len__(self):
+        return len(self.bag_ids)
+
+    def __contains__(self, bag_id):
+        if isinstance(bag_id, torch.Tensor):
+            bag_id = bag_id.item()
+        return bag_id in self._index
+
+    def __getitem__(self, bag_id):
+        if isinstance(bag_id, torch.Tensor):
+            bag_id = bag_id.item()
+        i = self._index[bag_id]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mask[start:end], self.probs[start:end]
+
+    def keys(self):
+        return self.bag_ids.tolist()
+
+    def items(self):
+        for bag_id in self.keys():
+            yield bag_id, self[bag_id]
+
+    @classmethod
+    def from_dict(cls, selection_mask):
+        """Convert a legacy {bag_id: [mask, probs]} dict"""
+        bag_ids = [k.item() if isinstance(k, torch.Tensor) else k for k in selection_mask.keys()]
+        sizes = [len(m) for m, _ in selection_mask.values()]
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        if bag_ids:
+            mask = np.concatenate([np.asarray(m, dtype=np.int64) for m, _ in selection_mask.values()])
+            probs = np.concatenate([np.asarray(p, dtype=np.float32) for _, p in selection_mask.values()])
+        else:
+            mask = np.zeros(0, dtype=np.int64)
+            probs = np.zeros(0, dtype=np.float32)
+        return cls(bag_ids, offsets, mask, probs)
+
+
+class BagLogitsBuffer:
+    """
+    Instance predictions of every training bag, kept on the device for the whole
+    bag phase. Each bag owns the slice offsets[i]:offsets[i+1] of one flat buffer,
+    so storing a batch is a single scatter and nothing is copied to the host until
+    to_host() (e.g. from create_selection_mask).
+    """
+    def __init__(self, bags_dict, device):
+        self.device = torch.device(device)
+        bag_ids = np.array(list(bags_dict.keys()), dtype=np.int64)
+        sizes = np.array([len(bag['images']) + len(bag.get('videos') or []) for bag in bags_dict.values()], dtype=np.int64)
+
+        self.bag_ids = bag_ids
+        self.offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(sizes)
+
+        # Sorted ids so batch ids can be looked up with searchsorted on the device
+        order = np.argsort(bag_ids, kind='stable')
+        self._sorted_ids = torch.from_numpy(bag_ids[order]).to(self.device)
+        self._order = torch.from_numpy(order).to(self.device)
+        self._offsets = torch.from_numpy(self.offsets).to(self.device)
+
+        self.values = torch.zeros(int(self.offsets[-1]), dtype=torch.float32, device=self.device)
+        self.seen = torch.zeros(len(bag_ids), dtype=torch.bool, device=self.device)
+        self._invalid = torch.zeros((), dtype=torch.bool, device=self.device)
+
+    def reset(self):
+        self.seen.zero_()
+        self._invalid.zero_()
+
+    def add(self, bag_ids, instance_pred):
+        """
+        Store the predictions of one batch. `instance_pred` holds the instances of
+        every bag in `bag_ids` back to back, in the same order.
+        """
+        bag_ids = torch.as_tensor(bag_ids, device=self.device).reshape(-1).long()
+        instance_pred = instance_pred.detach().reshape(-1)
+        n = instance_pred.numel()
+
+        pos = torch.searchsorted(self._sorted_ids, bag_ids).clamp_(max=len(self.bag_ids) - 1)
+        rows = self._order[pos]
+        starts = self._offsets[rows]
+        sizes = self._offsets[rows + 1] - starts
+
+        # Flat buffer index of every instance, without reading sizes back to the host
+        batch_starts = torch.cumsum(sizes, 0) - sizes
+        index = torch.repeat_interleave(starts - batch_starts, sizes, output_size=n) + torch.arange(n, device=self.device)
+
+        self.values[index] = instance_pred.to(self.values.dtype)
+        self.seen[rows] = True
+        # Unknown ids or bag sizes that don't match bags_dict, checked in to_host()
+        self._invalid |= (self._sorted_ids[pos] != bag_ids).any() | (sizes.sum() != n)
+
+    def add_bags(self, bag_ids, per_bag_pred):
+        """Store a batch given as one prediction tensor per bag"""
+        self.add(bag_ids, torch.cat([p.reshape(-1) for p in per_bag_pred]))
+
+    def synchronize(self):
+        """
+        Gather the bags every rank has seen under torch.distributed, so each rank holds
+        the full set before create_selection_mask. Bags seen by several ranks are averaged.
+        """
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return
+        sizes = self._offsets[1:] - self._offsets[:-1]
+        seen = torch.repeat_interleave(self.seen, sizes, output_size=self.values.numel()).to(self.values.dtype)
+
+        packed = torch.stack([self.values * seen, seen])
+        dist.all_reduce(packed)
+        self.values = packed[0] / packed[1].clamp(min=1)
+
+        bag_counts = self.seen.long()
+        dist.all_reduce(bag_counts)
+        self.seen = bag_counts > 0
+
+        invalid = self._invalid.to(torch.uint8)
+        dist.all_reduce(invalid, op=dist.ReduceOp.MAX)
+        self._invalid = invalid.bool()
+
+    def state_dict(self):
+        return {'values': self.values, 'seen': self.seen, 'invalid': self._invalid}
+
+    def load_state_dict(self, state):
+        self.values = torch.as_tensor(state['values'], dtype=torch.float32).to(self.device).clone()
+        self.seen = torch.as_tensor(state['seen'], dtype=torch.bool).to(self.device).clone()
+        self._invalid = torch.as_tensor(state['invalid'], dtype=torch.bool).to(self.device).clone()
+        return self
+
+    def to_host(self):
+        """Returns (bag_ids, offsets, flat predictions) as numpy arrays for the bags seen since reset()"""
+        if self._invalid.item():
+            raise ValueError("BagLogitsBuffer got bag ids or bag sizes that do not match the bags it was built from")
+        seen = self.seen.cpu().numpy()
+        values = self.values.cpu().numpy()
+
+        sizes = np.diff(self.offsets)
+        keep = np.repeat(seen, sizes)
+        offsets = np.zeros(int(seen.sum()) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes[seen])
+        return self.bag_ids[seen], offsets, values[keep]
+
+
+def _flatten_bag_logits(train_bag_logits):
+    """Returns (bag_ids, offsets, flat probabilities) for a BagLogitsBuffer or a {bag_id: probabilities} dict"""
+    if isinstance(train_bag_logits, BagLogitsBuffer):
+        return train_bag_logits.to_host()
+
+    bag_ids = [k.item() if isinstance(k, torch.Tensor) else k for k in train_bag_logits.keys()]
+    arrays = []
+    for probs in train_bag_logits.values():
+        if isinstance(probs, torch.Tensor):
+            probs = probs.detach().cpu().numpy()
+        arrays.append(np.asarray(probs).ravel())
+
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    flat = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.float32)
+    return np.asarray(bag_ids, dtype=np.int64), offsets, flat
+
+
+def top_k_confident(confidence_scores, k):
+    """
+    Indices of the k highest scores in O(N). Ties at the cutoff are broken by
+    position, so the result does not depend on the sort implementation.
+    """
+    n = len(confidence_scores)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k >= n:
+        return np.arange(n)
+
+    cutoff = np.partition(confidence_scores, n - k)[n - k]
+    above = np.flatnonzero(confidence_scores > cutoff)
+    ties = np.flatnonzero(confidence_scores == cutoff)[:k - len(above)]
+    return np.concatenate([above, ties])
 
 
 def create_selection_mask(train_bag_logits, include_ratio):
@@ -7,7 +199,7 @@ def create_selection_mask(train_bag_logits, include_ratio):
     Creates a selection mask for bag instances based on confidence scores.
 
     Parameters:
-    train_bag_logits (dict): A dictionary where keys are bag IDs and values are lists or tensors
+    train_bag_logits (BagLogitsBuffer or dict): A dictionary where keys are bag IDs and values are lists or tensors
                              of probabilities for each instance in the bag. Each probability
                              should be a float between 0 and 1, where values closer to 0 or 1
                              indicate higher confidence.
@@ -18,53 +210,163 @@ def create_selection_mask(train_bag_logits, include_ratio):
                            the top 50% most confident predictions.
 
     Returns:
-    dict: A dictionary where keys are bag IDs and values are lists containing two elements:
+    SelectionMask: Indexing it with a bag ID gives two elements:
           1. A numpy array mask where 1 indicates selected instances, 0 indicates
              unselected instances, and -1 indicates instances not considered for selection.
-          2. A list of the original probabilities for each instance.
+          2. The original probabilities for each instance.
 
     Note: The function assumes that probabilities closer to 0 or 1 indicate higher confidence,
           while probabilities closer to 0.5 indicate lower confidence.
     """
     
-    combined_probs = []
-    original_indices = []
-    predictions = []
-    
-    # Loop through train_bag_logits to process probabilities
-    for bag_id, probs in train_bag_logits.items():
-        # Convert tensor bag_id to integer if necessary
-        bag_id_int = bag_id.item() if isinstance(bag_id, torch.Tensor) else bag_id
-        for i, prob in enumerate(probs):
-            combined_probs.append(prob.item())
-            original_indices.append((bag_id_int, i))
-            predictions.append(prob.item())
-
-    total_predictions = len(combined_probs)
+    bag_ids, offsets, probs = _flatten_bag_logits(train_bag_logits)
+
+    total_predictions = len(probs)
     predictions_included = int(total_predictions * include_ratio)
     print(f'Including Predictions: {include_ratio:.2f} ({predictions_included})')
 
     # Rank instances based on their confidence (distance from 0.5)
-    confidence_scores = np.abs(np.array(combined_probs) - 0.5)
-    top_indices = np.argsort(-confidence_scores)[:predictions_included]
-
-    # Initialize combined_dict with all -1 for masks (not selected by default) and placeholders for predictions
-    combined_dict = {}
-    for bag_id, probs in train_bag_logits.items():
-        bag_id_int = bag_id.item() if isinstance(bag_id, torch.Tensor) else bag_id
-        mask = np.full(len(probs), -1, dtype=int)  # Initialize mask to -1 (not selected)
-        pred_list = [None] * len(probs)  # Initialize prediction list
-        combined_dict[bag_id_int] = [mask, pred_list]
-
-    # Update predictions in combined_dict for all instances
-    for idx, (bag_id_int, pos) in enumerate(original_indices):
-        combined_dict[bag_id_int][1][pos] = predictions[idx]  # Update prediction
-
-    # Set mask based on selection
-    for idx in top_indices:
-        original_bag_id, original_position = original_indices[idx]
-        prob = combined_probs[idx]
-        # Update mask based on probability: 0 if below 0.5, 1 if above 0.5
-        combined_dict[original_bag_id][0][original_position] = int(prob > 0.5)
-
-    return combined_dict
+    confidence_scores = np.abs(probs.astype(np.float64) - 0.5)
+    top_indices = top_k_confident(confidence_scores, predictions_included)
+
+    # -1 (not selected) by default, selected instances get 0 if below 0.5, 1 if above 0.5
+    mask = np.full(total_predictions, -1, dtype=np.int64)
+    mask[top_indices] = probs[top_indices] > 0.5
+
+    return SelectionMask(bag_ids, offsets, mask, probs)
+
+
+
+
+class PseudoLabelStore:
+    """
+    Soft labels for unlabeled instances, refined online with a confidence weighted EMA.
+    Labels live in one float tensor on the device, indexed by integer instance index
+    (registry instance ids, or indices from index() for any other keys).
+    Instances start at `initial`. With a `registry` the saved state keys every slot by
+    (bag id, position) and loading maps the labels onto this process's instance ids.
+    """
+    def __init__(self, momentum=0.9, device='cpu', initial=0.5, capacity=1024, registry=None):
+        self.momentum = momentum
+        self.registry = registry
+        self.initial = initial
+        self.device = torch.device(device)
+        self.labels = torch.full((capacity,), initial, dtype=torch.float32, device=self.device)
+        self.key_to_index = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def reserve(self, size):
+        """Make room for indices up to size - 1"""
+        if size <= len(self.labels):
+            return
+        capacity = max(size, 2 * len(self.labels))
+        labels = torch.full((capacity,), self.initial, dtype=torch.float32, device=self.device)
+        labels[:len(self.labels)] = self.labels
+        self.labels = labels
+
+    def index(self, keys):
+        """Integer indices for instance keys (e.g. unique ids), registering new ones"""
+        indices = []
+        for key in keys:
+            i = self.key_to_index.get(key)
+            if i is None:
+                i = len(self.keys)
+                self.key_to_index[key] = i
+                self.keys.append(key)
+            indices.append(i)
+        self.reserve(len(self.keys))
+        return torch.tensor(indices, dtype=torch.long, device=self.device)
+
+    def gather(self, indices):
+        return self.labels[indices]
+
+    def scatter(self, indices, values):
+        self.labels[indices] = values.to(self.labels.dtype)
+
+    def update(self, indices, new_labels, confidence):
+        """
+        EMA towards new_labels, higher confidence keeps more of the current label:
+        m = momentum * (1 - confidence) + confidence, label = m * label + (1 - m) * new_label
+        Returns the updated labels.
+        """
+        indices = indices.to(self.device)
+        confidence = confidence.to(self.labels.dtype)
+        adjusted_momentum = self.momentum * (1 - confidence) + confidence
+        updated = adjusted_momentum * self.gather(indices) + (1 - adjusted_momentum) * new_labels.to(self.labels.dtype)
+        updated = updated.clamp(0, 1)
+        self.scatter(indices, updated)
+        return updated
+
+    def state_dict(self):
+        state = {
+            'momentum': self.momentum,
+            'initial': self.initial,
+            'keys': list(self.keys),
+            'labels': self.labels,
+        }
+        if self.registry is not None:
+            bag_ids, positions = self.registry.keys(len(self.labels))
+            state['labels'] = self.labels[:len(bag_ids)]
+            # Integer bag ids go in the data block, other ids in the header
+            ids = np.asarray(bag_ids)
+            state['instance_bag_ids'] = ids if ids.dtype.kind in 'iu' else bag_ids
+            state['instance_positions'] = np.asarray(positions, dtype=np.int64)
+        return state
+
+    def load_state_dict(self, state):
+        """Registry keyed states need the bags registered first (INSTANCE_REGISTRY.register_bags)"""
+        self.momentum = state['momentum']
+        self.initial = state['initial']
+        self.keys = list(state['keys'])
+        self.key_to_index = {key: i for i, key in enumerate(self.keys)}
+        labels = torch.as_tensor(state['labels'], dtype=torch.float32)
+        if 'instance_bag_ids' not in state:
+            self.labels = labels.to(self.device).clone()
+            return self
+        if self.registry is None:
+            raise ValueError("Pseudo labels keyed by (bag id, position) need a PseudoLabelStore with a registry")
+
+        # Saved slot -> this process's instance id, instances that no longer exist are dropped
+        source, target = [], []
+        bag_ids = state['instance_bag_ids']
+        bag_ids = bag_ids.tolist() if hasattr(bag_ids, 'tolist') else bag_ids
+        for slot, (bag_id, position) in enumerate(zip(bag_ids, np.asarray(state['instance_positions']).tolist())):
+            instance_id = self.registry.lookup(bag_id, position)
+            if instance_id is not None:
+                source.append(slot)
+                target.append(instance_id)
+        self.labels = torch.full((max(len(self.registry), len(labels), 1),), self.initial, dtype=torch.float32)
+        self.labels[target] = labels[source]
+        self.labels = self.labels.to(self.device)
+        if len(source) < len(labels):
+            print(f"{len(labels) - len(source)} of {len(labels)} saved pseudo labels belong to instances that are no longer registered")
+        return self
+
+
+def save_selection_mask(selection_mask, path):
+    """
+    Save a selection mask as flat arrays: every bag's mask and probabilities are
+    concatenated and `offsets[i]:offsets[i+1]` is the slice belonging to `bag_ids[i]`.
+    """
+    if not isinstance(selection_mask, SelectionMask):
+        selection_mask = SelectionMask.from_dict(selection_mask)
+
+    save_tensors({
+        'bag_ids': selection_mask.bag_ids,
+        'offsets': selection_mask.offsets,
+        'mask': selection_mask.mask,
+        'probs': selection_mask.probs.astype(np.float32),
+    }, path)
+
+
+def load_selection_mask(path):
+    """Load a selection mask saved with save_selection_mask (or a legacy selection_mask.pkl)"""
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return SelectionMask.from_dict(pickle.load(f))
+
+    arrays, _ = load_tensors(path, mmap=False, as_numpy=True)
+    return SelectionMask(arrays['bag_ids'], arrays['offsets'], arrays['mask'], arrays['probs'])
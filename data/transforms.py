@@ -4,6 +4,7 @@ from torchvision import transforms
 import torch
 import numpy as np
 from PIL import Image
+from storage_adapter import read_image
 
 class GaussianNoise(object):
     def __init__(self, mean=0., std=0.1):
@@ -20,25 +21,28 @@ class GrayscaleToRGB:
             img = transforms.functional.to_pil_image(np.stack([img] * 3, axis=-1))
         return img
 
+def trim_long_side(img, trim_percent=0.05):
+    """Trim `trim_percent` from both ends of the longer side of a PIL image"""
+    w, h = img.size
+    if h > w:
+        trim_size = int(h * trim_percent)
+        # Trim 5% from the top and bottom
+        return img.crop((0, trim_size, w, h - trim_size))
+    trim_size = int(w * trim_percent)
+    # Trim 5% from the left and right
+    return img.crop((trim_size, 0, w - trim_size, h))
+
+
 class ResizeAndPad:
-    def __init__(self, output_size, fill=0):
+    def __init__(self, output_size, fill=0, trim=True):
         assert isinstance(output_size, int)
         self.output_size = output_size
         self.fill = fill
+        self.trim = trim
 
     def __call__(self, img):
-        w, h = img.size
-
-        # Determine the longer side and calculate 5% of its length
-        trim_percent = 0.05
-        if h > w:
-            trim_size = int(h * trim_percent)
-            # Trim 5% from the top and bottom
-            img = img.crop((0, trim_size, w, h - trim_size))
-        else:
-            trim_size = int(w * trim_percent)
-            # Trim 5% from the left and right
-            img = img.crop((trim_size, 0, w - trim_size, h))
+        if self.trim:
+            img = trim_long_side(img)
 
         # Update new image size
         w, h = img.size
@@ -63,6 +67,39 @@ class ResizeAndPad:
         img = ImageOps.expand(img, border=padding, fill=self.fill)
 
         return img
+
+
+def bucket_shape(w, h, output_size, multiple=32):
+    """(width, height) with the longer side at output_size and the shorter rounded to a multiple"""
+    scale = output_size / max(w, h)
+    short = max(multiple, int(round(min(w, h) * scale / multiple)) * multiple)
+    short = min(short, output_size)
+    return (output_size, short) if w >= h else (short, output_size)
+
+
+class ResizeLongest:
+    """
+    Same trim as ResizeAndPad, but keeps the aspect ratio instead of padding to a square.
+    The shorter side is rounded to a multiple of `multiple`, so images fall into a few
+    shape buckets that batches can be grouped by (see data/bucketing.py).
+    """
+    def __init__(self, output_size, multiple=32, trim=True):
+        assert isinstance(output_size, int)
+        self.output_size = output_size
+        self.multiple = multiple
+        self.trim = trim
+
+    def __call__(self, img):
+        if self.trim:
+            img = trim_long_side(img)
+        return img.resize(bucket_shape(*img.size, self.output_size, self.multiple))
+
+
+def fit_to_shape(img, shape):
+    """Resize an HxW(xC) array to shape (h, w) if it isn't already"""
+    if img.shape[:2] == tuple(shape):
+        return img
+    return cv2.resize(img, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
     
     
     
@@ -113,19 +150,161 @@ class HistogramEqualization(object):
 
 
 
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+# Single channel equivalents (mean of the RGB statistics), used in grayscale mode
+GRAY_MEAN = [0.449]
+GRAY_STD = [0.226]
+
+
+def _to_rgb(img):
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+
+
+def _to_gray(img):
+    if img.ndim == 2:
+        return img
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def decode_rgb(path):
+    """Decode an image once into an RGB uint8 HxWx3 array (converted in place)"""
+    return _to_rgb(read_image(path))
+
+
+def decode_image(path, grayscale=False):
+    """Decode an image into an RGB HxWx3 or, in grayscale mode, a single channel HxW uint8 array"""
+    img = read_image(path)
+    return _to_gray(img) if grayscale else _to_rgb(img)
+
+
+def decode_image_bytes(data, grayscale=False):
+    """decode_image for an encoded image held in memory (e.g. read from a shard)"""
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    return _to_gray(img) if grayscale else _to_rgb(img)
+
+
 class CLAHETransform(object):
+    """
+    CLAHE on the L channel of LAB, or directly on single channel images. Accepts an
+    HxWx3 / HxW uint8 array (modified in place), a CxHxW uint8 tensor or a PIL image,
+    and returns the same type.
+    """
     def __init__(self, clip_limit=2.0, tile_grid_size=(8, 8)):
         self.clip_limit = clip_limit
         self.tile_grid_size = tile_grid_size
+        self._clahe = None
 
-    def __call__(self, img):
-        clahe = cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=self.tile_grid_size)
+    def __getstate__(self):
+        # cv2 objects can't be pickled, every worker creates its own
+        state = self.__dict__.copy()
+        state['_clahe'] = None
+        return state
+
+    def _apply(self, img):
+        if self._clahe is None:
+            self._clahe = cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=self.tile_grid_size)
         
-        img = np.array(img)
         if len(img.shape) == 2:
-            img = clahe.apply(img)
-        else:
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
-            img[:, :, 0] = clahe.apply(img[:, :, 0])
-            img = cv2.cvtColor(img, cv2.COLOR_LAB2RGB)
-        return Image.fromarray(img)
\ No newline at end of file
+            return self._clahe.apply(img, dst=img)
+        if img.shape[2] == 1:
+            plane = img.reshape(img.shape[:2])
+            self._clahe.apply(plane, dst=plane)
+            return img
+        cv2.cvtColor(img, cv2.COLOR_RGB2LAB, dst=img)
+        l_channel = np.ascontiguousarray(img[:, :, 0])
+        img[:, :, 0] = self._clahe.apply(l_channel, dst=l_channel)
+        cv2.cvtColor(img, cv2.COLOR_LAB2RGB, dst=img)
+        return img
+
+    def __call__(self, img):
+        if isinstance(img, np.ndarray):
+            return self._apply(img)
+        if torch.is_tensor(img):
+            array = np.ascontiguousarray(img.permute(1, 2, 0).numpy()) if img.dim() == 3 else img.numpy().copy()
+            array = self._apply(array)
+            return torch.from_numpy(array).permute(2, 0, 1) if array.ndim == 3 else torch.from_numpy(array)
+        return Image.fromarray(self._apply(np.array(img)))
+
+
+class ToUint8Tensor(object):
+    """HxWxC uint8 array -> CxHxW uint8 tensor view, no copy and no scaling"""
+    def __call__(self, img):
+        if isinstance(img, Image.Image):
+            img = np.asarray(img)
+        if img.ndim == 2:
+            img = img[:, :, None]
+        return torch.from_numpy(img).permute(2, 0, 1)
+
+
+def normalize_images(images, device, mean=IMAGENET_MEAN, std=IMAGENET_STD, augment=None):
+    """
+    uint8 image tensor -> float tensor on `device`, scaled to [0, 1] and normalized.
+    `augment` (e.g. a BatchAugment) is applied to the [0, 1] batch before normalizing.
+    Single channel images use the grayscale statistics when given RGB ones.
+    """
+    if not torch.is_tensor(images) or images.dtype != torch.uint8:
+        return images
+    if images.shape[-3] == 1 and len(mean) != 1:
+        mean, std = GRAY_MEAN, GRAY_STD
+    images = images.to(device, non_blocking=True).float().div_(255)
+    if augment is not None:
+        images = augment(images)
+    shape = (-1, 1, 1)
+    mean = torch.tensor(mean, device=images.device).view(shape)
+    std = torch.tensor(std, device=images.device).view(shape)
+    return images.sub_(mean).div_(std)
+
+
+class NormalizedLoader(object):
+    """
+    Wraps a DataLoader whose workers return uint8 images (4x less to send between
+    processes) and normalizes each batch's images on `device` in the main process.
+    Images may be a tensor, a (q, k) tuple or a list of per-bag tensors.
+    Training loaders pass `augment` to run the random augmentations on the whole batch.
+    """
+    def __init__(self, loader, device=None, mean=IMAGENET_MEAN, std=IMAGENET_STD, augment=None):
+        self.loader = loader
+        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.mean = mean
+        self.std = std
+        self.augment = augment
+
+    def normalize(self, images):
+        """Normalize (and augment) one batch of uint8 images, e.g. from the wrapped loader's raw output"""
+        if isinstance(images, tuple):
+            # Each view gets its own random augmentation
+            return tuple(self.normalize(x) for x in images)
+        if isinstance(images, list):
+            batchable = images and all(torch.is_tensor(x) and x.dim() == 4 for x in images) \
+                and len(set(x.shape[1:] for x in images)) == 1
+            if self.augment is None or not batchable:
+                return [self.normalize(x) for x in images]
+            # Augment every instance of every bag in one pass, then split back into bags
+            sizes = [len(x) for x in images]
+            return list(self.normalize(torch.cat(images)).split(sizes))
+        return normalize_images(images, self.device, self.mean, self.std, self.augment)
+
+    def __iter__(self):
+        # The wrapped iterator (sampler draws, worker seeds) is created right away, not on the first batch
+        return self._normalized(iter(self.loader))
+
+    def _normalized(self, batches):
+        for batch in batches:
+            # Labels and ids from loader workers arrive on the CPU
+            rest = tuple(x.to(self.device, non_blocking=True) if torch.is_tensor(x) else x for x in batch[1:])
+            yield (self.normalize(batch[0]),) + rest
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
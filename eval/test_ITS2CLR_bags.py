@@ -142,8 +142,8 @@ if __name__ == '__main__':
         
         # Check if the model already exists
         model_folder = f"{parent_dir}/models/{model_name}/"
-        model_path = f'{model_folder}/{model_name}.pth'
-        model.load_state_dict(torch.load(model_path))
+        model_path = resolve_checkpoint(model_folder, model_name)
+        model.load_state_dict(load_checkpoint(model_path, device='cpu'))
         print(f"Loaded pre-existing model from {model_name}")
 
 
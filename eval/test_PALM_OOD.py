@@ -19,56 +19,73 @@ from data.save_arch import *
 from archs.model_solo_MIL import *
 from data.bag_loader import *
 from data.instance_loader import *
+from util.streaming_metrics import StreamingBinaryMetrics, QuantileSketch
+
+
+class FeatureReservoir:
+    """Uniform sample of at most `size` (feature, target) rows, visualize_prototypes_and_instances plots 1000"""
+    def __init__(self, size=1000, seed=0):
+        self.size = size
+        self.seen = 0
+        self.rng = np.random.default_rng(seed)
+        self.features, self.targets = [], []
+
+    def update(self, features, targets):
+        for feature, target in zip(features, targets):
+            if len(self.features) < self.size:
+                self.features.append(feature)
+                self.targets.append(target)
+            else:
+                slot = self.rng.integers(0, self.seen + 1)
+                if slot < self.size:
+                    self.features[slot], self.targets[slot] = feature, target
+            self.seen += 1
+
+    def arrays(self):
+        return np.array(self.features), np.array(self.targets)
 
 
 def test_model_and_collect_distances(model, palm, bag_dataloader, instance_dataloader, device):
+    """Bag / FC / PALM metric accumulators, a sketch of the PALM distances and a feature sample"""
     model.eval()
     
-    # Bag-level metrics
-    bag_targets, bag_predictions = [], []
-    
-    # Instance-level metrics
-    instance_targets, fc_predictions, palm_predictions = [], [], []
-    instance_info = []
-    instance_features = []
-    distances = []
+    bag_metrics = StreamingBinaryMetrics()
+    fc_metrics = StreamingBinaryMetrics()
+    palm_metrics = StreamingBinaryMetrics()
+    distances = QuantileSketch()
+    reservoir = FeatureReservoir()
     
     with torch.no_grad():
         # Bag-level testing
         for images, yb, _, unique_id in tqdm(bag_dataloader, desc="Testing bags"):
             bag_pred, _, _, _= model(images, pred_on=True)
-            bag_targets.extend(yb.cpu().numpy())
-            bag_predictions.extend((bag_pred > 0.5).float().cpu().numpy())
+            bag_metrics.update(yb, (bag_pred > 0.5).float())
         
         for images, instance_labels, unique_ids in tqdm(instance_dataloader, desc="Testing instances"):
             images = images.to(device)
             _, _, fc_pred, features = model(images, projector=True)
             palm_pred, dist = palm.predict(features)
             
-            distances.extend(dist.cpu().numpy())
-            instance_info.extend(unique_ids) 
-            instance_features.extend(features.cpu().numpy())
-            
-            instance_targets.extend(instance_labels.cpu().numpy())
+            distances.update(dist)
+            reservoir.update(features.cpu().numpy(), instance_labels.cpu().numpy())
             # Check if fc_pred is None and handle accordingly
             if fc_pred is None:
-                fc_predictions.extend([0] * len(instance_labels))
+                fc_metrics.update(instance_labels, torch.zeros(len(instance_labels)))
             else:
-                fc_predictions.extend((fc_pred > 0.5).float().cpu().numpy())
-            palm_predictions.extend(palm_pred.cpu().numpy())
+                fc_metrics.update(instance_labels, (fc_pred > 0.5).float())
+            palm_metrics.update(instance_labels, palm_pred)
                 
-    return (np.array(bag_targets), np.array(bag_predictions),  
-            np.array(instance_targets), np.array(fc_predictions), np.array(palm_predictions),
-            np.array(distances), instance_info, np.array(instance_features))
+    return bag_metrics, fc_metrics, palm_metrics, distances, reservoir
 
 
 
 def run_test(config):
     # Define transforms
+    mean, std = (GRAY_MEAN, GRAY_STD) if config['grayscale'] else (IMAGENET_MEAN, IMAGENET_STD)
     test_transform = T.Compose([
         CLAHETransform(),
         T.ToTensor(),
-        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        T.Normalize(mean=mean, std=std)
     ])
     
     # Prepare PALM
@@ -83,27 +100,27 @@ def run_test(config):
     num_labels = len(config['label_columns'])
 
     # Create test datasets and dataloaders
-    bag_dataset_test = BagOfImagesDataset(bags_val, transform=test_transform, save_processed=False)
+    bag_dataset_test = BagOfImagesDataset(bags_val, transform=test_transform, save_processed=False, grayscale=config['grayscale'])
     bag_dataloader_test = TUD.DataLoader(bag_dataset_test, batch_size=config['bag_batch_size'], collate_fn=collate_bag, shuffle=False)
 
-    instance_dataset_test = Instance_Dataset(bags_val, [], transform=test_transform, warmup=True)
+    instance_dataset_test = Instance_Dataset(bags_val, [], transform=test_transform, warmup=True, grayscale=config['grayscale'])
     instance_dataloader_test = TUD.DataLoader(instance_dataset_test, batch_size=config['instance_batch_size'], collate_fn=collate_instance, shuffle=False)
 
     # Load the trained model
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes=num_labels).to(device)
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes=num_labels, n_in=input_channels(config)).to(device)
     
     # Load the saved model state
     if model_version:
         save_dir = f"{model_folder}/{config['head_name']}/{model_version}"
     else:
         save_dir = f"{model_folder}/{config['head_name']}"
-    model_path = os.path.join(save_dir, "model.pth")
-    model.load_state_dict(torch.load(model_path))
+    model.load_state_dict(load_checkpoint(resolve_checkpoint(save_dir, 'model'), device='cpu'))
 
     # Test the model
     results = test_model_and_collect_distances(model, palm, bag_dataloader_test, instance_dataloader_test, device)
-    bag_targets, bag_predictions, instance_targets, fc_predictions, palm_predictions, distances, instance_info, instance_features = results
+    bag_metrics, fc_metrics, palm_metrics, distances, reservoir = results
+    instance_features, instance_targets = reservoir.arrays()
 
     # Extract prototypes
     prototypes = palm.protos.cpu().detach().numpy()
@@ -121,15 +138,15 @@ def run_test(config):
     # Calculate and print metrics
     print(f"\nResults for dataset: {config['dataset_name']}")
     print("Bag-level Metrics:")
-    calculate_metrics(bag_targets, bag_predictions, save_path=os.path.join(save_dir, 'bag'))
+    calculate_metrics(bag_metrics, None, save_path=os.path.join(save_dir, 'bag'))
 
     print("\nFC Instance-level Metrics:")
-    calculate_metrics(instance_targets, fc_predictions, instance_info, save_path=os.path.join(save_dir, 'instance'))
+    calculate_metrics(fc_metrics, None, save_path=os.path.join(save_dir, 'instance'))
 
     print("\nPALM Instance-level Metrics:")
-    calculate_metrics(instance_targets, palm_predictions, instance_info, save_path=os.path.join(save_dir, 'palm'))
+    calculate_metrics(palm_metrics, None, save_path=os.path.join(save_dir, 'palm'))
 
-    return distances, instance_info
+    return distances, reservoir
 
 
 if __name__ == '__main__':
@@ -147,7 +164,7 @@ if __name__ == '__main__':
     model_path = os.path.join(model_folder, head_name, model_version)
     config = load_model_config(model_path)
     config['head_name'] = head_name
-    palm_path = os.path.join(model_folder, head_name, model_version, "palm_state.pkl")
+    palm_path = os.path.join(model_folder, head_name, model_version, f"palm_state{TENSOR_FILE_EXT}")
 
     # Test 1: Original dataset
     distances_1, _ = run_test(config)
@@ -171,10 +188,11 @@ if __name__ == '__main__':
     
     # Create distribution graph
     plt.figure(figsize=(10, 6))
-    plt.hist(distances_1, bins=50, alpha=0.5, label=config['dataset_name'])
-    plt.hist(distances_2, bins=50, alpha=0.5, label=config['dataset_name'])
+    quantiles = np.linspace(0, 1, 201)
+    plt.plot([distances_1.quantile(q) for q in quantiles], quantiles, label=config['dataset_name'])
+    plt.plot([distances_2.quantile(q) for q in quantiles], quantiles, label=config['dataset_name'])
     plt.xlabel('Distance to Prototypes')
-    plt.ylabel('Frequency')
+    plt.ylabel('Cumulative fraction')
     plt.title(f'Distances to Prototypes ({head_name})')
     plt.legend()
     plt.savefig(f'{current_dir}/results/PALM_OOD/{head_name}_prototype_distribution.png')
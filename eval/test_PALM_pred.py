@@ -83,10 +83,10 @@ def run_test(dataset_name, label_columns, instance_columns, config, output_file)
     
     # Load the saved model state
     if model_version:
-        model_path = f"{model_folder}/{head_name}/{model_version}/model.pth"
+        model_path = resolve_checkpoint(f"{model_folder}/{head_name}/{model_version}", 'model')
     else:
-        model_path = f"{model_folder}/{head_name}/model.pth"
-    model.load_state_dict(torch.load(model_path))
+        model_path = resolve_checkpoint(f"{model_folder}/{head_name}", 'model')
+    model.load_state_dict(load_checkpoint(model_path, device='cpu'))
 
     # Run model on train and test sets
     with open(output_file, 'w', newline='') as csvfile:
@@ -46,7 +46,7 @@ def test_model(model, bag_dataloader, instance_dataloader):
             instance_labels = instance_labels.cuda(non_blocking=True)
             bag_pred, _, instance_pred, features = model(im_q)
             
-            instance_info.extend(unique_id) 
+            instance_info.extend(unique_id.tolist())
             
             instance_targets.extend(instance_labels.cpu().numpy())
             # Check if fc_pred is None and handle accordingly
@@ -57,7 +57,7 @@ def test_model(model, bag_dataloader, instance_dataloader):
                 
     return (np.array(bag_targets), np.array(bag_predictions), 
             np.array(instance_targets), np.array(fc_predictions),
-            instance_info)
+            resolve_instance_ids(instance_info))
 
 
 
@@ -79,23 +79,23 @@ if __name__ == '__main__':
     num_labels = len(config['label_columns'])
 
     # Create bag datasets
-    bag_dataset_train = BagOfImagesDataset(bags_train, transform=train_transform, save_processed=False)
+    bag_dataset_train = BagOfImagesDataset(bags_train, transform=train_transform, save_processed=False, grayscale=config['grayscale'])
     #bag_dataset_train = SyntheticBagDataset(bags_train, transform=train_transform)
-    bag_dataset_val = BagOfImagesDataset(bags_val, transform=val_transform, save_processed=False)
-    bag_dataloader_train = TUD.DataLoader(bag_dataset_train, batch_size=config['bag_batch_size'], collate_fn = collate_bag, drop_last=True, shuffle = True)
-    bag_dataloader_val = TUD.DataLoader(bag_dataset_val, batch_size=config['bag_batch_size'], collate_fn = collate_bag, drop_last=True)
+    bag_dataset_val = BagOfImagesDataset(bags_val, transform=val_transform, save_processed=False, grayscale=config['grayscale'])
+    bag_dataloader_train = NormalizedLoader(TUD.DataLoader(bag_dataset_train, batch_size=config['bag_batch_size'], collate_fn = collate_bag, drop_last=True, shuffle = True), augment=train_augment)
+    bag_dataloader_val = NormalizedLoader(TUD.DataLoader(bag_dataset_val, batch_size=config['bag_batch_size'], collate_fn = collate_bag, drop_last=True))
 
-    instance_dataloader_train = Instance_Dataset(bags_train, [], transform=val_transform, warmup=False, dual_output=True)
+    instance_dataloader_train = Instance_Dataset(bags_train, [], transform=val_transform, warmup=False, dual_output=True, grayscale=config['grayscale'])
     train_sampler = InstanceSampler(instance_dataloader_train, config['instance_batch_size'], strategy=1)
-    instance_dataloader_train = TUD.DataLoader(instance_dataloader_train, batch_sampler=train_sampler, collate_fn=collate_instance, shuffle=False)
+    instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataloader_train, batch_sampler=train_sampler, collate_fn=collate_instance, shuffle=False))
     
     
-    instance_dataset_test = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True, dual_output=True)
+    instance_dataset_test = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True, dual_output=True, grayscale=config['grayscale'])
     val_sampler = InstanceSampler(instance_dataset_test, config['instance_batch_size'], strategy=1)
-    instance_dataloader_test = TUD.DataLoader(instance_dataset_test, batch_sampler=val_sampler, collate_fn=collate_instance, shuffle=False)
+    instance_dataloader_test = NormalizedLoader(TUD.DataLoader(instance_dataset_test, batch_sampler=val_sampler, collate_fn=collate_instance, shuffle=False))
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     model, optimizer, state = setup_model(model, config)
 
@@ -115,8 +115,8 @@ if __name__ == '__main__':
     results_df.to_csv(f'{output_path}/instance_predictions_test.csv', index=False)
 
     print("BAG TRAINING")
-    calculate_metrics(bag_targets, bag_predictions, save_path=f'{output_path}/bag_metrics_val/')
+    calculate_metrics(bag_targets, bag_predictions, save_path=f'{output_path}/bag_metrics_val/', n_bootstrap=1000)
     
     print("\nINSTANCE TRAINING")
-    calculate_metrics(instance_targets, fc_predictions, save_path=f'{output_path}/instance_metrics_val/')
+    calculate_metrics(instance_targets, fc_predictions, save_path=f'{output_path}/instance_metrics_val/', n_bootstrap=1000, groups=groups_from_ids(instance_info))
     
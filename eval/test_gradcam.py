@@ -104,10 +104,10 @@ if __name__ == '__main__':
     
     # Load the saved model state
     if model_version:
-        model_path = f"{model_folder}/{head_name}/{model_version}/model.pth"
+        model_path = resolve_checkpoint(f"{model_folder}/{head_name}/{model_version}", 'model')
     else:
-        model_path = f"{model_folder}/{head_name}/model.pth"
-    model.load_state_dict(torch.load(model_path))
+        model_path = resolve_checkpoint(f"{model_folder}/{head_name}", 'model')
+    model.load_state_dict(load_checkpoint(model_path, device='cpu'))
     model.eval()
 
     # Setup Grad-CAM
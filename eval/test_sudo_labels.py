@@ -1,11 +1,17 @@
-import pickle
+import os
+import sys
 import numpy as np
 from collections import Counter
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from data.sudo_labels import load_selection_mask
+
 def analyze_selection_mask(file_path):
-    # Load the selection mask
-    with open(file_path, 'rb') as file:
-        selection_mask = pickle.load(file)
+    # Load the selection mask (selection_mask.tensors or legacy selection_mask.pkl)
+    selection_mask = load_selection_mask(file_path)
 
     total_instances = 0
     selected_instances = 0
@@ -6,7 +6,7 @@ class IWSCL(nn.Module):
     def __init__(self, feat_dim, num_classes=2, momentum=0.999, temperature=0.07):
         super(IWSCL, self).__init__()
         self.prototypes = nn.Parameter(torch.randn(num_classes, feat_dim))
-        self.proto_class_counts = torch.zeros(num_classes, num_classes).cuda()
+        self.register_buffer('proto_class_counts', torch.zeros(num_classes, num_classes))
         self.momentum = momentum
         self.num_classes = num_classes
         self.temperature = temperature
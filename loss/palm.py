@@ -1,5 +1,8 @@
 import torch
+import torch.distributed as dist
 from data.format_data import *
+from util.tensor_io import *
+from util.profiling import span
 
 
 
@@ -25,7 +28,7 @@ class PALM(nn.Module):
         self.protos = F.normalize(self.protos, dim=-1)
         
         # Initialize class counts for each prototype
-        self.proto_class_counts = torch.zeros(self.n_protos, self.num_classes).cuda() # ADDED
+        self.register_buffer("proto_class_counts", torch.zeros(self.n_protos, self.num_classes)) # ADDED
         
         self.distribution_limit = 0
         
@@ -60,10 +63,12 @@ class PALM(nn.Module):
     def mle_loss(self, features, targets, update_prototypes=True):
         # update prototypes by EMA
         anchor_labels = targets.contiguous().repeat(self.nviews).view(-1, 1)
-        contrast_labels = torch.arange(self.num_classes).repeat(self.cache_size).view(-1,1).cuda()
-        mask = torch.eq(anchor_labels, contrast_labels.T).float().cuda()
+        device = self.protos.device
+        contrast_labels = torch.arange(self.num_classes, device=device).repeat(self.cache_size).view(-1,1)
+        mask = torch.eq(anchor_labels, contrast_labels.T).float()
                 
-        Q = self.sinkhorn(features)
+        with span('palm_sinkhorn'):
+            Q = self.sinkhorn(features)
 
         # topk
         if self.k > 0:
@@ -74,7 +79,7 @@ class PALM(nn.Module):
                 1,
                 topk_idx,
                 1
-            ).cuda()
+            )
             update_mask = F.normalize(F.normalize(topk_mask*update_mask, dim=1, p=1),dim=0, p=1)
         # original
         else:
@@ -82,12 +87,15 @@ class PALM(nn.Module):
         update_features = torch.matmul(update_mask.T, features)
         
         if update_prototypes:
-            self.proto_class_counts += torch.matmul(update_mask.T, F.one_hot(targets, num_classes=self.num_classes).float()) # ADDED
+            class_counts = torch.matmul(update_mask.T, F.one_hot(targets, num_classes=self.num_classes).float())
+            update_features, class_counts = self.reduce_update(update_features, class_counts)
+            self.proto_class_counts += class_counts # ADDED
             protos = self.protos
             protos = self.proto_m * protos + (1-self.proto_m) * update_features
             self.protos = F.normalize(protos, dim=1, p=2)
         
-        Q = self.sinkhorn(features)
+        with span('palm_sinkhorn'):
+            Q = self.sinkhorn(features)
         
         proto_dis = torch.matmul(features, self.protos.detach().T)
         anchor_dot_contrast = torch.div(proto_dis, self.temp)
@@ -101,7 +109,7 @@ class PALM(nn.Module):
                 1,
                 topk_idx,
                 1
-            ).cuda()
+            )
             loss_mask = F.normalize(topk_mask*loss_mask, dim=1, p=1)
             masked_logits = loss_mask * logits 
         else:  
@@ -114,13 +122,33 @@ class PALM(nn.Module):
         loss = -torch.mean(log_prob)
         return loss   
     
+    def reduce_update(self, update_features, class_counts):
+        """
+        Combine the prototype updates of all ranks under torch.distributed so every rank
+        applies the same EMA step and keeps identical prototypes. Each prototype averages
+        the ranks whose batch assigned it anything, counts are summed. Gradients keep
+        flowing through this rank's own update_features.
+        """
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return update_features, class_counts
+
+        local = update_features.detach()
+        present = (local.abs().sum(dim=1, keepdim=True) > 0).float()
+        packed = torch.cat([local, present, class_counts.detach()], dim=1)
+        dist.all_reduce(packed)
+
+        summed, n_ranks, class_counts = packed.split([self.feat_dim, 1, self.num_classes], dim=1)
+        reduced = summed / n_ranks.clamp(min=1)
+        return update_features + (reduced - local), class_counts
+
     def proto_contra(self):
         
         protos = F.normalize(self.protos, dim=1)
         batch_size = self.num_classes
         
-        proto_labels = torch.arange(self.num_classes).repeat(self.cache_size).view(-1,1).cuda()
-        mask = torch.eq(proto_labels, proto_labels.T).float().cuda()    
+        device = self.protos.device
+        proto_labels = torch.arange(self.num_classes, device=device).repeat(self.cache_size).view(-1,1)
+        mask = torch.eq(proto_labels, proto_labels.T).float()
 
         contrast_count = self.cache_size
         contrast_feature = protos
@@ -140,7 +168,7 @@ class PALM(nn.Module):
         logits_mask = torch.scatter(
             torch.ones_like(mask),
             1,
-            torch.arange(batch_size * anchor_count).view(-1, 1).to('cuda'),
+            torch.arange(batch_size * anchor_count, device=device).view(-1, 1),
             0
         )
         mask = mask*logits_mask
@@ -176,12 +204,14 @@ class PALM(nn.Module):
         loss = 0
         loss_dict = {}
 
-        g_con = self.mle_loss(features, targets, update_prototypes)
+        with span('palm_mle'):
+            g_con = self.mle_loss(features, targets, update_prototypes)
         loss += g_con
         loss_dict['mle'] = g_con.cpu().item()
                     
         if self.lambda_pcon > 0:            
-            g_dis = self.lambda_pcon * self.proto_contra()
+            with span('palm_proto_contra'):
+                g_dis = self.lambda_pcon * self.proto_contra()
             loss += g_dis
             loss_dict['proto_contra'] = g_dis.cpu().item()
                                 
@@ -193,8 +223,9 @@ class PALM(nn.Module):
     
     
     # Saving / Loading State
-    def save_state(self, filename, max_distance = 0):
-        state = {
+    def state_to_save(self, max_distance = 0):
+        """Everything save_state writes, load_state reads it back"""
+        return {
             'protos': self.protos,
             'proto_class_counts': self.proto_class_counts,
             'num_classes': self.num_classes,
@@ -210,19 +241,31 @@ class PALM(nn.Module):
             'proto_m': self.proto_m,
             'distribution_limit': max_distance
         }
+    
+    def save_state(self, filename, max_distance = 0, writer = None):
+        state = self.state_to_save(max_distance)
         
-        with open(filename, 'wb') as f:
-            pickle.dump(state, f)
+        # Tensors are written from the CPU so the state loads on any device
+        if writer is not None:
+            writer.save(save_nested_state, state, filename)
+        else:
+            save_nested_state(state, filename)
         
     def load_state(self, filename):
-        if os.path.exists(filename):
-            with open(filename, 'rb') as f:
-                state = pickle.load(f)
+        if filename is not None and not os.path.exists(filename):
+            # Fall back to a legacy palm_state.pkl next to the requested file
+            filename = resolve_checkpoint(os.path.dirname(filename), 'palm_state')
+        
+        if filename is not None:
+            device = self.protos.device
+            state = load_checkpoint(filename, device=device, mmap=False)
             
             # Update all the attributes
             for key, value in state.items():
+                if torch.is_tensor(value):
+                    value = value.to(device)
                 setattr(self, key, value)
                 
             print(f"PALM state loaded")
         else:
-            print(f"No palm checkpoint found: {filename}")
\ No newline at end of file
+            print(f"No palm checkpoint found")
\ No newline at end of file
@@ -24,12 +24,13 @@ if __name__ == '__main__':
     data_config = FishDataConfig  # or LesionDataConfig
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_ABMIL.py')
     bags_train, bags_val, bag_dataloader_train, bag_dataloader_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
     
     # total model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}") 
         
         
@@ -311,6 +311,7 @@ if __name__ == '__main__':
     data_config = LesionDataConfig  # or LesionDataConfig
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_FanoGan.py')
     bags_train, bags_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
@@ -33,12 +33,13 @@ if __name__ == '__main__':
     mix='mixup'
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_GenSCL_ITS2CLR.py')
     bags_train, bags_val, bag_dataloader_train, bag_dataloader_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")    
         
     optimizer = optim.SGD(model.parameters(),
@@ -59,14 +60,14 @@ if __name__ == '__main__':
         if not state['pickup_warmup']: # Are we resuming from a head model?
         
             # Used the instance predictions from bag training to update the Instance Dataloader
-            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, dual_output=True)
+            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, dual_output=True, grayscale=config['grayscale'])
             
             if state['warmup']:
                 sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'])
-                instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=sampler, collate_fn = collate_instance)
+                instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, sampler), collate_fn = collate_instance), augment=train_augment)
                 target_count = config['warmup_epochs']
             else:
-                instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_size=config['instance_batch_size'], collate_fn = collate_instance, drop_last=True, shuffle = True)
+                instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, TUD.BatchSampler(TUD.RandomSampler(instance_dataset_train), config['instance_batch_size'], drop_last=True), drop_last=True), collate_fn = collate_instance), augment=train_augment)
                 target_count = config['feature_extractor_train_count']
             
 
@@ -144,11 +145,12 @@ if __name__ == '__main__':
         
         # Training phase
         print('\nTraining Bag Aggregator')
+        train_bag_logits = BagLogitsBuffer(bags_train, device)
         for iteration in range(config['MIL_train_count']):
             
             model.train()
             total_loss = 0.0
-            train_bag_logits = {}
+            train_bag_logits.reset()
             total_acc = 0
             total = 0
             correct = 0
@@ -175,8 +177,7 @@ if __name__ == '__main__':
                 total += yb.size(0)
                 correct += (predicted == yb).sum().item()
                 
-                for instance_id, bag_id in enumerate(unique_id):
-                    train_bag_logits[bag_id] = instance_predictions[instance_id].detach().cpu().numpy()
+                train_bag_logits.add_bags(unique_id, instance_predictions)
 
                 # Store raw predictions and targets
                 train_pred.update(bag_pred, yb, unique_id)
@@ -246,8 +247,7 @@ if __name__ == '__main__':
                     target_folder = state['model_folder']
                     
                 # Save selection
-                with open(f'{target_folder}/selection_mask.pkl', 'wb') as file:
-                    pickle.dump(state['selection_mask'], file)
+                state['writer'].submit(save_selection_mask, state['selection_mask'], f'{target_folder}/selection_mask.tensors')
 
                     
                     
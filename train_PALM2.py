@@ -11,6 +11,9 @@ from archs.model_solo_MIL import *
 from data.instance_loader import *
 from loss.palm import PALM
 from util.eval_util import *
+from util.progressive import *
+from util.resume import *
+from util.profiling import *
 torch.backends.cudnn.benchmark = True
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
@@ -29,7 +32,7 @@ if __name__ == '__main__':
     num_labels = len(config['label_columns'])
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     
     # LOSS INIT
@@ -46,20 +49,20 @@ if __name__ == '__main__':
     # MODEL INIT
     model, optimizer, state = setup_model(model, config, optimizer)
     palm.load_state(state['palm_path'])
+    cursor = TrainingCursor(config, state, generators=[train_augment.generator])
+    cursor.restore(model, optimizer, palm) # Mid-epoch snapshot, if a previous run was interrupted
+    profiler = Profiler(config, state['model_folder'], writer=state['writer'])
+    resizer = ProgressiveResizer(config, model, state)
+    bag_size = config['img_size'] # prepare_all_data's loaders
 
     
     # Training loop
     while state['epoch'] < config['total_epochs']:
         
         
-        if not state['pickup_warmup']: # Are we resuming from a head model?
+        if not state['pickup_warmup'] and cursor.runs('instance'): # Are we resuming from a head model?
         
-            # Used the instance predictions from bag training to update the Instance Dataloader
-            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True)
-            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True)
-            train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
-            instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=train_sampler, collate_fn = collate_instance)
-            instance_dataloader_val = TUD.DataLoader(instance_dataset_val, batch_size=config['instance_batch_size'], collate_fn = collate_instance)
+            instance_size = None
             
             if state['warmup']:
                 target_count = config['warmup_epochs']
@@ -78,7 +81,19 @@ if __name__ == '__main__':
 
             
             
-            for iteration in range(target_count): 
+            for iteration in cursor.iterations('instance', target_count): 
+                # Loaders are (re)built from the cache of this epoch's progressive resizing size
+                size = resizer.start_epoch()
+                if size != instance_size:
+                    instance_size = size
+                    
+                    # Used the instance predictions from bag training to update the Instance Dataloader
+                    instance_dataset_train = Instance_Dataset(bags_at_size(config, bags_train, size), state['selection_mask'], transform=train_transform, warmup=True, grayscale=config['grayscale'])
+                    instance_dataset_val = Instance_Dataset(bags_at_size(config, bags_val, size), [], transform=val_transform, warmup=True, grayscale=config['grayscale'])
+                    train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
+                    instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=ResumableBatchSampler(bucket_sampler(config, instance_dataset_train, train_sampler)), collate_fn = collate_instance, **loader_kwargs(config)), augment=train_augment)
+                    instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=bucket_sampler(config, instance_dataset_val, batch_size=config['instance_batch_size']), collate_fn = collate_instance, **loader_kwargs(config)))
+                
                 losses = AverageMeter()
                 palm_total_correct = 0
                 instance_total_correct = 0
@@ -86,33 +101,46 @@ if __name__ == '__main__':
                 train_pred = PredictionTracker()
                 model.train()
                 
+                # Continue the partial sums when resuming mid-epoch
+                batches, start = cursor.batches('instance', iteration, instance_dataloader_train)
+                saved = cursor.accumulators()
+                if saved:
+                    losses, train_pred = saved['losses'], saved['train_pred']
+                    palm_total_correct, instance_total_correct, total_samples = saved['palm_total_correct'], saved['instance_total_correct'], saved['total_samples']
+                
                 # Iterate over the training data
-                for idx, (images, instance_labels, unique_id) in enumerate(tqdm(instance_dataloader_train, total=len(instance_dataloader_train))):
-                    images = images.cuda(non_blocking=True)
-                    instance_labels = instance_labels.cuda(non_blocking=True)
+                profiler.begin_epoch()
+                for idx, (images, instance_labels, unique_id) in enumerate(tqdm(profiler.timed(batches), total=len(instance_dataloader_train), initial=start), start):
+                    with span('h2d'):
+                        images = images.cuda(non_blocking=True)
+                        instance_labels = instance_labels.cuda(non_blocking=True)
 
                     # forward
                     optimizer.zero_grad()
-                    _, _, instance_predictions, features = model(images, projector=True)
+                    with span('forward'):
+                        _, _, instance_predictions, features = model(images, projector=True)
                     features.to(device)
                     
-                    # Get loss from PALM
-                    palm_loss, loss_dict = palm(features, instance_labels)
-                    
-                    
-                    # Calculate BCE loss
-                    bce_loss_value = BCE_loss(instance_predictions, instance_labels.float())
+                    with span('loss'):
+                        # Get loss from PALM
+                        palm_loss, loss_dict = palm(features, instance_labels)
+                        
+                        
+                        # Calculate BCE loss
+                        bce_loss_value = BCE_loss(instance_predictions, instance_labels.float())
 
                     # Backward pass and optimization step
                     total_loss = palm_loss + bce_loss_value
-                    total_loss.backward()
-                    optimizer.step()
+                    with span('backward'):
+                        total_loss.backward()
+                    with span('optimizer'):
+                        optimizer.step()
         
                     # Update the loss meter
                     losses.update(total_loss.item(), images[0].size(0))
                     
                     # Get predictions from PALM
-                    with torch.no_grad():
+                    with torch.no_grad(), span('metrics'):
                         palm_predicted_classes, dist = palm.predict(features)
                         instance_predicted_classes = (instance_predictions) > 0.5
 
@@ -132,6 +160,11 @@ if __name__ == '__main__':
                     
                     # Clean up
                     torch.cuda.empty_cache()
+                    
+                    cursor.step(idx + 1, lambda: {'losses': losses, 'train_pred': train_pred, 'palm_total_correct': palm_total_correct,
+                                                  'instance_total_correct': instance_total_correct, 'total_samples': total_samples})
+                    profiler.step()
+                profiler.end_epoch(f"instance {iteration + 1}/{target_count}")
 
                 # Calculate accuracies
                 palm_train_acc = palm_total_correct / total_samples
@@ -185,6 +218,7 @@ if __name__ == '__main__':
                 # Calculate accuracies
                 palm_val_acc = palm_total_correct / total_samples
                 instance_val_acc = instance_total_correct / total_samples
+                resizer.end_epoch('instance', val_pred)
                 
                 print(f'[{iteration+1}/{target_count}] Train Loss: {losses.avg:.5f}, Train Palm Acc: {palm_train_acc:.5f}, Train FC Acc: {instance_train_acc:.5f}')
                 print(f'[{iteration+1}/{target_count}] Val Loss:   {val_losses.avg:.5f}, Val Palm Acc: {palm_val_acc:.5f}, Val FC Acc: {instance_val_acc:.5f}')
@@ -203,8 +237,10 @@ if __name__ == '__main__':
                     
                     if state['warmup']:
                         save_state(state, config, instance_train_acc, val_losses.avg, instance_val_acc, model, optimizer)
-                        palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                        palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                         print("Saved checkpoint due to improved val_loss_instance")
+                
+                cursor.end_iteration()
 
 
 
@@ -220,9 +256,15 @@ if __name__ == '__main__':
         
             
         print('\nTraining Bag Aggregator')
-        for iteration in range(config['MIL_train_count']):
+        train_bag_logits = BagLogitsBuffer(bags_train, device)
+        for iteration in cursor.iterations('bag', config['MIL_train_count']):
+            size = resizer.start_epoch()
+            if size != bag_size:
+                bag_size = size
+                bag_dataloader_train, bag_dataloader_val = make_bag_loaders(config, bags_at_size(config, bags_train, size), bags_at_size(config, bags_val, size))
+            
             model.train()
-            train_bag_logits = {}
+            train_bag_logits.reset()
             total_loss = 0.0
             total_acc = 0
             total = 0
@@ -232,34 +274,48 @@ if __name__ == '__main__':
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
 
-            for (images, yb, instance_labels, unique_id) in tqdm(bag_dataloader_train, total=len(bag_dataloader_train)):
+            batches, start = cursor.batches('bag', iteration, bag_dataloader_train)
+            saved = cursor.accumulators()
+            if saved:
+                total_loss, total, correct, train_pred = saved['total_loss'], saved['total'], saved['correct'], saved['train_pred']
+                train_bag_logits.load_state_dict(saved['train_bag_logits'])
+
+            profiler.begin_epoch()
+            for idx, (images, yb, instance_labels, unique_id) in enumerate(tqdm(profiler.timed(batches), total=len(bag_dataloader_train), initial=start), start):
                 num_bags = len(images)
                 optimizer.zero_grad()
 
                 # Forward pass
-                bag_pred, _, instance_pred, features = model(images, pred_on=True, projector=True)
+                with span('forward'):
+                    bag_pred, _, instance_pred, features = model(images, pred_on=True, projector=True)
     
-                # Split the embeddings back into per-bag embeddings
-                split_sizes = [bag.size(0) for bag in images]
-                y_hat_per_bag = torch.split(instance_pred, split_sizes, dim=0)
-                for i, y_h in enumerate(y_hat_per_bag):
-                    train_bag_logits[unique_id[i].item()] = y_h.detach().cpu().numpy()
+                # Keep the instance predictions on the device until the selection mask is built
+                train_bag_logits.add(unique_id, instance_pred)
             
                 
-                bag_loss = BCE_loss(bag_pred, yb)
-                bag_loss.backward()
-                optimizer.step()
-                
-                total_loss += bag_loss.item() * yb.size(0)
-                predicted = (bag_pred > 0.5).float()
-                total += yb.size(0)
-                correct += (predicted == yb).sum().item()
+                with span('loss'):
+                    bag_loss = BCE_loss(bag_pred, yb)
+                with span('backward'):
+                    bag_loss.backward()
+                with span('optimizer'):
+                    optimizer.step()
                 
-                # Store raw predictions and targets
-                train_pred.update(bag_pred, yb, unique_id)
+                with span('metrics'):
+                    total_loss += bag_loss.item() * yb.size(0)
+                    predicted = (bag_pred > 0.5).float()
+                    total += yb.size(0)
+                    correct += (predicted == yb).sum().item()
+                    
+                    # Store raw predictions and targets
+                    train_pred.update(bag_pred, yb, unique_id)
                 
                 # Clean up
                 torch.cuda.empty_cache()
+                
+                cursor.step(idx + 1, lambda: {'total_loss': total_loss, 'total': total, 'correct': correct,
+                                              'train_pred': train_pred, 'train_bag_logits': train_bag_logits.state_dict()})
+                profiler.step()
+            profiler.end_epoch(f"bag {iteration + 1}/{config['MIL_train_count']}")
                     
             
             
@@ -297,6 +353,7 @@ if __name__ == '__main__':
                         
             val_loss = total_val_loss / total
             val_acc = correct / total
+            resizer.end_epoch('bag', val_pred)
                 
         
             state['train_losses'].append(train_loss)
@@ -318,7 +375,7 @@ if __name__ == '__main__':
                 
                 save_state(state, config, train_acc, val_loss, val_acc, model, optimizer,)
                 save_metrics(config, state, train_pred, val_pred)
-                palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                 print("Saved checkpoint due to improved val_loss_bag")
 
                 
@@ -330,6 +387,9 @@ if __name__ == '__main__':
                 print("Created new sudo labels")
                 
                 # Save selection
-                with open(f'{target_folder}/selection_mask.pkl', 'wb') as file:
-                    pickle.dump(state['selection_mask'], file)
-
+                state['writer'].submit(save_selection_mask, state['selection_mask'], f'{target_folder}/selection_mask.tensors')
+            
+            cursor.end_iteration()
+    
+    cursor.finish()
+    profiler.close()
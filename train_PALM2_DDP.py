@@ -0,0 +1,407 @@
+import os, pickle
+import torch.utils.data as TUD
+from tqdm import tqdm
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel as DDP
+from data.save_arch import *
+from util.Gen_ITS2CLR_util import *
+import torch.optim as optim
+from data.format_data import *
+from data.sudo_labels import *
+from archs.model_solo_MIL import *
+from data.instance_loader import *
+from loss.palm import PALM
+from util.eval_util import *
+from util.distributed import *
+from util.profiling import *
+from data.shards import make_shard_loaders, shard_dirs
+torch.backends.cudnn.benchmark = True
+
+# train_PALM2 on several processes with DistributedDataParallel. Each rank trains on
+# its own class balanced share of the instances / bags, PALM's prototype updates are
+# all-reduced so every rank keeps the same prototypes, and rank 0 does all the saving.
+#   torchrun --nproc_per_node=<gpus> train_PALM2_DDP.py
+# Without CUDA the ranks run on the CPU over gloo.
+
+
+
+if __name__ == '__main__':
+    rank, world_size, device = init_distributed()
+    main_process = is_main_process()
+    torch.manual_seed(0)
+
+    # Config
+    model_version = '1'
+    head_name = "TEST75"
+    data_config = DogDataConfig #FishDataConfig or LesionDataConfig
+
+    config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_PALM2_DDP.py', supported=('profile',))
+    if config['aspect_buckets']:
+        # Shape buckets give every rank a different number of batches, which stalls the gradient all-reduce
+        print("aspect_buckets is not supported with DDP, using square images")
+        config['aspect_buckets'] = False
+
+    # Rank 0 preprocesses the image cache, the others then read it
+    if main_process:
+        bags_train, bags_val, _, _ = prepare_all_data(config)
+    barrier()
+    if not main_process:
+        bags_train, bags_val, _, _ = prepare_all_data(config)
+    if config['stream_shards']:
+        # Bags are read from the exported shards, no random access to the image cache
+        bag_dataloader_train, bag_dataloader_val = make_shard_loaders(config, *shard_dirs(config))
+    else:
+        bag_dataloader_train, bag_dataloader_val = make_bag_loaders(config, bags_train, bags_val, distributed=True)
+    num_classes = len(config['label_columns']) + 1
+    num_labels = len(config['label_columns'])
+
+    # Create Model
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).to(device)
+    if main_process:
+        print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")
+
+    # LOSS INIT
+    palm = PALM(nviews = 1, num_classes=2, n_protos=100, k = 0, lambda_pcon=1).to(device)
+    BCE_loss = nn.BCELoss()
+
+    optimizer = optim.SGD(model.parameters(),
+                        lr=config['learning_rate'],
+                        momentum=0.9,
+                        nesterov=True,
+                        weight_decay=0.001) # original .001
+
+
+    # MODEL INIT (rank 0 creates the model folders first)
+    if main_process:
+        model, optimizer, state = setup_model(model, config, optimizer)
+    barrier()
+    if not main_process:
+        model, optimizer, state = setup_model(model, config, optimizer)
+    palm.load_state(state['palm_path'])
+    broadcast_buffers(palm)
+
+    if device.type == 'cuda':
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    # The aggregator is idle in the instance phase and the projector in bag validation
+    ddp_model = DDP(model, device_ids=[device.index] if device.type == 'cuda' else None, find_unused_parameters=True)
+    sampler_epoch = 0
+
+    # Only rank 0 times its steps and writes the profile
+    profiler = Profiler(config if main_process else {}, state['model_folder'], writer=state['writer'])
+
+
+    # Training loop
+    while state['epoch'] < config['total_epochs']:
+
+
+        if not state['pickup_warmup']: # Are we resuming from a head model?
+
+            # Used the instance predictions from bag training to update the Instance Dataloader
+            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, grayscale=config['grayscale'])
+            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True, grayscale=config['grayscale'])
+            train_sampler = DistributedInstanceSampler(instance_dataset_train, config['instance_batch_size'])
+            val_sampler = DistributedEvalSampler(instance_dataset_val, config['instance_batch_size'])
+            instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=train_sampler, collate_fn = collate_instance), augment=train_augment)
+            instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=val_sampler, collate_fn = collate_instance))
+
+            if state['warmup']:
+                target_count = config['warmup_epochs']
+            else:
+                target_count = config['feature_extractor_train_count']
+
+
+
+            if main_process:
+                print('Training Feature Extractor')
+                print(f'Warmup Mode: {state["warmup"]}')
+
+            # Unfreeze encoder
+            for param in model.encoder.parameters():
+                param.requires_grad = True
+
+
+
+            for iteration in range(target_count):
+                set_sampler_epoch(instance_dataloader_train, sampler_epoch)
+                sampler_epoch += 1
+
+                losses = AverageMeter()
+                palm_total_correct = 0
+                instance_total_correct = 0
+                total_samples = 0
+                train_pred = PredictionTracker()
+                ddp_model.train()
+
+                # Iterate over the training data
+                profiler.begin_epoch()
+                for idx, (images, instance_labels, unique_id) in enumerate(tqdm(profiler.timed(instance_dataloader_train), total=len(instance_dataloader_train), disable=not main_process)):
+                    with span('h2d'):
+                        images = images.to(device, non_blocking=True)
+                        instance_labels = instance_labels.to(device, non_blocking=True)
+
+                    # forward
+                    optimizer.zero_grad()
+                    with span('forward'):
+                        _, _, instance_predictions, features = ddp_model(images, projector=True)
+
+                    with span('loss'):
+                        # Get loss from PALM, the prototype update is all-reduced inside
+                        palm_loss, loss_dict = palm(features, instance_labels)
+
+
+                        # Calculate BCE loss
+                        bce_loss_value = BCE_loss(instance_predictions, instance_labels.float())
+
+                    # Backward pass and optimization step
+                    total_loss = palm_loss + bce_loss_value
+                    with span('backward'):
+                        total_loss.backward()
+                    with span('optimizer'):
+                        optimizer.step()
+
+                    # Update the loss meter
+                    losses.update(total_loss.item(), instance_labels.size(0))
+
+                    # Get predictions from PALM
+                    with torch.no_grad(), span('metrics'):
+                        palm_predicted_classes, _ = palm.predict(features)
+                        instance_predicted_classes = (instance_predictions) > 0.5
+
+                        # Calculate accuracy for PALM predictions
+                        palm_correct = (palm_predicted_classes == instance_labels).sum().item()
+                        palm_total_correct += palm_correct
+
+                        # Calculate accuracy for instance predictions
+                        instance_correct = (instance_predicted_classes == instance_labels).sum().item()
+                        instance_total_correct += instance_correct
+
+                        total_samples += instance_labels.size(0)
+
+                    # Store raw predictions and targets
+                    train_pred.update(instance_predictions, instance_labels, unique_id)
+                    profiler.step()
+                profiler.end_epoch(f"instance {iteration + 1}/{target_count}")
+
+                # Calculate accuracies over all ranks
+                train_loss_sum, palm_total_correct, instance_total_correct, total_samples = all_reduce_sum(
+                    losses.sum, palm_total_correct, instance_total_correct, total_samples, device=device)
+                train_loss = train_loss_sum / total_samples
+                palm_train_acc = palm_total_correct / total_samples
+                instance_train_acc = instance_total_correct / total_samples
+
+
+
+                # Validation loop, on the wrapped module so uneven shares don't need collectives
+                model.eval()
+                palm_total_correct = 0
+                instance_total_correct = 0
+                total_samples = 0
+                val_losses = AverageMeter()
+                val_pred = PredictionTracker()
+
+                with torch.no_grad():
+                    for idx, (images, instance_labels, unique_id) in enumerate(tqdm(instance_dataloader_val, total=len(instance_dataloader_val), disable=not main_process)):
+                        images = images.to(device, non_blocking=True)
+                        instance_labels = instance_labels.to(device, non_blocking=True)
+
+                        # Forward pass
+                        _, _, instance_predictions, features = model(images, projector=True)
+
+                        # Get loss
+                        palm_loss, loss_dict = palm(features, instance_labels, update_prototypes=False)
+                        bce_loss_value = BCE_loss(instance_predictions, instance_labels.float())
+                        total_loss = palm_loss + bce_loss_value
+                        val_losses.update(total_loss.item(), instance_labels.size(0))
+
+                        # Get predictions
+                        palm_predicted_classes, _ = palm.predict(features)
+                        instance_predicted_classes = (instance_predictions) > 0.5
+
+                        # Calculate accuracy for PALM predictions
+                        palm_correct = (palm_predicted_classes == instance_labels).sum().item()
+                        palm_total_correct += palm_correct
+
+                        # Calculate accuracy for instance predictions
+                        instance_correct = (instance_predicted_classes == instance_labels).sum().item()
+                        instance_total_correct += instance_correct
+
+                        total_samples += instance_labels.size(0)
+
+                        # Store raw predictions and targets
+                        val_pred.update(instance_predictions, instance_labels, unique_id)
+
+                # Every rank gets the same totals, so they all take the same save decision
+                val_loss_sum, palm_total_correct, instance_total_correct, total_samples = all_reduce_sum(
+                    val_losses.sum, palm_total_correct, instance_total_correct, total_samples, device=device)
+                val_loss = val_loss_sum / total_samples
+                palm_val_acc = palm_total_correct / total_samples
+                instance_val_acc = instance_total_correct / total_samples
+                train_pred = gather_predictions(train_pred)
+                val_pred = gather_predictions(val_pred)
+
+                if main_process:
+                    print(f'[{iteration+1}/{target_count}] Train Loss: {train_loss:.5f}, Train Palm Acc: {palm_train_acc:.5f}, Train FC Acc: {instance_train_acc:.5f}')
+                    print(f'[{iteration+1}/{target_count}] Val Loss:   {val_loss:.5f}, Val Palm Acc: {palm_val_acc:.5f}, Val FC Acc: {instance_val_acc:.5f}')
+
+                # Save the model
+                if val_loss < state['val_loss_instance']:
+                    state['val_loss_instance'] = val_loss
+                    state['mode'] = 'instance'
+
+                    if state['warmup']:
+                        target_folder = state['head_folder']
+                    else:
+                        target_folder = state['model_folder']
+
+                    if main_process:
+                        save_metrics(config, state, train_pred, val_pred)
+
+                        if state['warmup']:
+                            save_state(state, config, instance_train_acc, val_loss, instance_val_acc, model, optimizer)
+                            palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
+                            print("Saved checkpoint due to improved val_loss_instance")
+
+
+
+
+
+        if state['pickup_warmup']:
+            state['pickup_warmup'] = False
+        if state['warmup']:
+            if main_process:
+                print("Warmup Phase Finished")
+            state['warmup'] = False
+
+
+
+
+        if main_process:
+            print('\nTraining Bag Aggregator')
+        train_bag_logits = BagLogitsBuffer(bags_train, device)
+        for iteration in range(config['MIL_train_count']):
+            set_sampler_epoch(bag_dataloader_train, sampler_epoch)
+            sampler_epoch += 1
+
+            ddp_model.train()
+            train_bag_logits.reset()
+            total_loss = 0.0
+            total = 0
+            correct = 0
+            train_pred = PredictionTracker()
+
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            profiler.begin_epoch()
+            for (images, yb, instance_labels, unique_id) in tqdm(profiler.timed(bag_dataloader_train), total=len(bag_dataloader_train), disable=not main_process):
+                num_bags = len(images)
+                with span('h2d'):
+                    yb = yb.to(device)
+                optimizer.zero_grad()
+
+                # Forward pass
+                with span('forward'):
+                    bag_pred, _, instance_pred, features = ddp_model(images, pred_on=True, projector=True)
+
+                # Keep the instance predictions on the device until the selection mask is built
+                train_bag_logits.add(unique_id, instance_pred)
+
+
+                with span('loss'):
+                    bag_loss = BCE_loss(bag_pred, yb)
+                with span('backward'):
+                    bag_loss.backward()
+                with span('optimizer'):
+                    optimizer.step()
+
+                with span('metrics'):
+                    total_loss += bag_loss.item() * yb.size(0)
+                    predicted = (bag_pred > 0.5).float()
+                    total += yb.size(0)
+                    correct += (predicted == yb).sum().item()
+
+                    # Store raw predictions and targets
+                    train_pred.update(bag_pred, yb, unique_id)
+                profiler.step()
+            profiler.end_epoch(f"bag {iteration + 1}/{config['MIL_train_count']}")
+
+            # Every rank needs the instance predictions of all bags for the selection mask
+            train_bag_logits.synchronize()
+            total_loss, correct, total = all_reduce_sum(total_loss, correct, total, device=device)
+            train_loss = total_loss / total
+            train_acc = correct / total
+
+
+            # Evaluation phase
+            model.eval()
+            total = 0
+            correct = 0
+            total_val_loss = 0.0
+            val_pred = PredictionTracker()
+
+            with torch.no_grad():
+                for (images, yb, instance_labels, unique_id) in tqdm(bag_dataloader_val, total=len(bag_dataloader_val), disable=not main_process):
+                    yb = yb.to(device)
+
+                    # Forward pass
+                    bag_pred, _, _, features = model(images, pred_on=True)
+
+                    # Calculate bag-level loss
+                    loss = BCE_loss(bag_pred, yb)
+                    total_val_loss += loss.item() * yb.size(0)
+
+                    predicted = (bag_pred > 0.5).float()
+                    total += yb.size(0)
+                    correct += (predicted == yb).sum().item()
+
+                    # Store raw predictions and targets
+                    val_pred.update(bag_pred, yb, unique_id)
+
+            total_val_loss, correct, total = all_reduce_sum(total_val_loss, correct, total, device=device)
+            val_loss = total_val_loss / total
+            val_acc = correct / total
+            train_pred = gather_predictions(train_pred)
+            val_pred = gather_predictions(val_pred)
+
+
+            state['train_losses'].append(train_loss)
+            state['valid_losses'].append(val_loss)
+
+            if main_process:
+                print(f"[{iteration+1}/{config['MIL_train_count']}] | Acc | Loss")
+                print(f"Train | {train_acc:.4f} | {train_loss:.4f}")
+                print(f"Val | {val_acc:.4f} | {val_loss:.4f}")
+
+            # Save the model
+            if val_loss < state['val_loss_bag']:
+                state['val_loss_bag'] = val_loss
+                state['mode'] = 'bag'
+                if state['warmup']:
+                    target_folder = state['head_folder']
+                else:
+                    target_folder = state['model_folder']
+
+                if main_process:
+                    save_state(state, config, train_acc, val_loss, val_acc, model, optimizer,)
+                    save_metrics(config, state, train_pred, val_pred)
+                    palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
+                    print("Saved checkpoint due to improved val_loss_bag")
+
+
+                state['epoch'] += 1
+
+                # Create selection mask, identical on every rank after synchronize()
+                predictions_ratio = prediction_anchor_scheduler(state['epoch'], config['total_epochs'], 0, config['initial_ratio'], config['final_ratio'])
+                state['selection_mask'] = create_selection_mask(train_bag_logits, predictions_ratio)
+
+                # Save selection
+                if main_process:
+                    print("Created new sudo labels")
+                    state['writer'].submit(save_selection_mask, state['selection_mask'], f'{target_folder}/selection_mask.tensors')
+
+    profiler.close()
+    if main_process:
+        state['writer'].close()
+    barrier()
+    cleanup_distributed()
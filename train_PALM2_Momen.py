@@ -28,12 +28,13 @@ if __name__ == '__main__':
     data_config = DogDataConfig  # or LesionDataConfig
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_PALM2_Momen.py')
     bags_train, bags_val, bag_dataloader_train, bag_dataloader_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     
     # LOSS INIT
@@ -51,9 +52,15 @@ if __name__ == '__main__':
     model, optimizer, state = setup_model(model, config, optimizer)
     palm.load_state(state['palm_path'])
     
-    # Initialize dictionary for unknown labels
-    unknown_labels = {}
-    unknown_label_momentum = 0.9
+    # Pseudo labels for unknown instances, stored next to the palm state
+    # Register the bags first so the saved (bag id, position) keys map onto this run's instance ids
+    INSTANCE_REGISTRY.register_bags(bags_train)
+    INSTANCE_REGISTRY.register_bags(bags_val)
+    unknown_labels = PseudoLabelStore(momentum=0.9, device=device, registry=INSTANCE_REGISTRY)
+    pseudo_labels_path = resolve_checkpoint(os.path.dirname(state['palm_path']), 'pseudo_labels')
+    if pseudo_labels_path:
+        unknown_labels.load_state_dict(load_checkpoint(pseudo_labels_path))
+        print(f"Loaded pseudo labels from {pseudo_labels_path}")
     
     # Training loop
     while state['epoch'] < config['total_epochs']:
@@ -62,11 +69,12 @@ if __name__ == '__main__':
         if not state['pickup_warmup']: # Are we resuming from a head model?
         
             # Used the instance predictions from bag training to update the Instance Dataloader
-            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=state['warmup'], dual_output=False)
-            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True)
+            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=state['warmup'], dual_output=False, grayscale=config['grayscale'])
+            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True, grayscale=config['grayscale'])
             train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
-            instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=train_sampler, collate_fn = collate_instance)
-            instance_dataloader_val = TUD.DataLoader(instance_dataset_val, batch_size=config['instance_batch_size'], collate_fn = collate_instance)
+            instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, train_sampler), collate_fn = collate_instance), augment=train_augment)
+            instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=bucket_sampler(config, instance_dataset_val, batch_size=config['instance_batch_size']), collate_fn = collate_instance))
+            unknown_labels.reserve(len(INSTANCE_REGISTRY))
             
             if state['warmup']:
                 target_count = config['warmup_epochs']
@@ -125,27 +133,13 @@ if __name__ == '__main__':
                             min_dist = torch.min(proto_dist)
                             normalized_dist = (proto_dist - min_dist) / (max_dist - min_dist)
                         
-                        for i, idx in enumerate(unlabeled_indices):
-                            unique_id = unique_ids[idx]
-                            
-                            if unique_id not in unknown_labels:
-                                unknown_labels[unique_id] = 0.5  # Initialize to 0.5 if not present
-                            
-                            # Calculate confidence from normalized distance
-                            confidence = 1 - normalized_dist[i].item()
-
-                            current_label = unknown_labels[unique_id]
-                            new_label = proto_class[i].item()
-
-                            # Adjust the momentum based on confidence
-                            adjusted_momentum = unknown_label_momentum * (1 - confidence) + confidence
-
-                            updated_label = adjusted_momentum * current_label + (1 - adjusted_momentum) * new_label
-                            updated_label = max(0, min(1, updated_label))  # Clamp the updated label to [0, 1]
-                            unknown_labels[unique_id] = updated_label
-                            
-                            # Update the combined_labels tensor with the new pseudo-label
-                            combined_labels[idx] = updated_label
+                        # Calculate confidence from normalized distance
+                        confidence = 1 - normalized_dist
+                        
+                        # Momentum update of the stored labels, then use them as targets
+                        store_indices = unique_ids.to(device, non_blocking=True)[unlabeled_indices]
+                        updated_labels = unknown_labels.update(store_indices, proto_class.float(), confidence)
+                        combined_labels[unlabeled_indices] = updated_labels
                             
                     # Store raw predictions and targets
                     train_pred.update(instance_predictions, combined_labels, unique_ids)
@@ -253,7 +247,8 @@ if __name__ == '__main__':
                         
                     if state['warmup']:
                         save_state(state, config, instance_train_acc, val_losses.avg, instance_val_acc, model, optimizer)
-                        palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                        palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
+                        state['writer'].save(save_nested_state, unknown_labels.state_dict(), os.path.join(target_folder, "pseudo_labels.tensors"))
                         print("Saved checkpoint due to improved val_loss_instance")
 
 
@@ -357,7 +352,8 @@ if __name__ == '__main__':
                 
                 save_state(state, config, train_acc, val_loss, val_acc, model, optimizer,)
                 save_metrics(config, state, train_pred, val_pred)
-                palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
+                state['writer'].save(save_nested_state, unknown_labels.state_dict(), os.path.join(target_folder, "pseudo_labels.tensors"))
                 print("Saved checkpoint due to improved val_loss_bag")
 
                 
@@ -28,12 +28,13 @@ if __name__ == '__main__':
     data_config = FishDataConfig  # or LesionDataConfig
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_PALM2_Sudo2.py')
     bags_train, bags_val, bag_dataloader_train, bag_dataloader_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     
     # LOSS INIT
@@ -60,11 +61,11 @@ if __name__ == '__main__':
         if not state['pickup_warmup']: # Are we resuming from a head model?
         
             # Used the instance predictions from bag training to update the Instance Dataloader
-            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=state['warmup'], dual_output=False)
-            instance_dataset_val = Instance_Dataset(bags_val, state['selection_mask'], transform=val_transform, warmup=True)
+            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=state['warmup'], dual_output=False, grayscale=config['grayscale'])
+            instance_dataset_val = Instance_Dataset(bags_val, state['selection_mask'], transform=val_transform, warmup=True, grayscale=config['grayscale'])
             train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
-            instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=train_sampler, collate_fn = collate_instance)
-            instance_dataloader_val = TUD.DataLoader(instance_dataset_val, batch_size=config['instance_batch_size'], collate_fn = collate_instance)
+            instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, train_sampler), collate_fn = collate_instance), augment=train_augment)
+            instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=bucket_sampler(config, instance_dataset_val, batch_size=config['instance_batch_size']), collate_fn = collate_instance))
             
             if state['warmup']:
                 target_count = config['warmup_epochs']
@@ -226,7 +227,7 @@ if __name__ == '__main__':
                         
                     if state['warmup']:
                         save_state(state, config, instance_train_acc, val_losses.avg, instance_val_acc, model, optimizer)
-                        palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                        palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                         print("Saved checkpoint due to improved val_loss_instance")
 
 
@@ -331,7 +332,7 @@ if __name__ == '__main__':
                 
                 save_state(state, config, train_acc, val_loss, val_acc, model, optimizer,)
                 save_metrics(config, state, train_pred, val_pred)
-                palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                 print("Saved checkpoint due to improved val_loss_bag")
 
                 
@@ -32,12 +32,13 @@ if __name__ == '__main__':
     mix='mixup'
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_PALM4_GenSCL.py')
     bags_train, bags_val, bag_dataloader_train, bag_dataloader_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     
     
@@ -62,11 +63,11 @@ if __name__ == '__main__':
         if not state['pickup_warmup']: # Are we resuming from a head model?
         
             # Used the instance predictions from bag training to update the Instance Dataloader
-            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, dual_output=True)
-            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True, dual_output=True)
+            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, dual_output=True, grayscale=config['grayscale'])
+            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True, dual_output=True, grayscale=config['grayscale'])
             train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
-            instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=train_sampler, collate_fn = collate_instance)
-            instance_dataloader_val = TUD.DataLoader(instance_dataset_val, batch_size=config['instance_batch_size'], collate_fn = collate_instance)
+            instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, train_sampler), collate_fn = collate_instance), augment=train_augment)
+            instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=bucket_sampler(config, instance_dataset_val, batch_size=config['instance_batch_size']), collate_fn = collate_instance))
             
             if state['warmup']:
                 target_count = config['warmup_epochs']
@@ -231,7 +232,7 @@ if __name__ == '__main__':
                         
                     if state['warmup']:
                         save_state(state, config, instance_train_acc, val_losses.avg, instance_val_acc, model, optimizer)
-                        palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                        palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                         print("Saved checkpoint due to improved val_loss_instance")
 
 
@@ -248,9 +249,10 @@ if __name__ == '__main__':
         
             
         print('\nTraining Bag Aggregator')
+        train_bag_logits = BagLogitsBuffer(bags_train, device)
         for iteration in range(config['MIL_train_count']):
             model.train()
-            train_bag_logits = {}
+            train_bag_logits.reset()
             total_loss = 0.0
             total_acc = 0
             total = 0
@@ -278,11 +280,8 @@ if __name__ == '__main__':
                     # Adjust confidence based on predicted class
                     adjusted_confidence = torch.where(palm_predicted_classes == 1, 0.5 + reversed_confidence, 0.5 - reversed_confidence)
                     
-                    # Split the embeddings back into per-bag embeddings
-                    split_sizes = [bag.size(0) for bag in images]
-                    y_hat_per_bag = torch.split(adjusted_confidence, split_sizes, dim=0)
-                    for i, y_h in enumerate(y_hat_per_bag):
-                        train_bag_logits[unique_id[i].item()] = y_h.detach().cpu().numpy()
+                    # Keep the instance confidences on the device until the selection mask is built
+                    train_bag_logits.add(unique_id, adjusted_confidence)
                         
                     # Store raw predictions and targets
                     train_pred.update(bag_pred, yb, unique_id)
@@ -353,7 +352,7 @@ if __name__ == '__main__':
                 
                 save_state(state, config, train_acc, val_loss, val_acc, model, optimizer)
                 save_metrics(config, state, train_pred, val_pred)
-                palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                 print("Saved checkpoint due to improved val_loss_bag")
 
                 
@@ -365,6 +364,5 @@ if __name__ == '__main__':
                 print("Created new sudo labels")
                 
                 # Save selection
-                with open(f'{target_folder}/selection_mask.pkl', 'wb') as file:
-                    pickle.dump(state['selection_mask'], file)
+                state['writer'].submit(save_selection_mask, state['selection_mask'], f'{target_folder}/selection_mask.tensors')
 
@@ -29,12 +29,13 @@ if __name__ == '__main__':
     data_config = DogDataConfig  # FishDataConfig or DogDataConfig
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_PALM_ITS2CLR.py')
     bags_train, bags_val, bag_dataloader_train, bag_dataloader_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     
     # LOSS INIT
@@ -61,11 +62,11 @@ if __name__ == '__main__':
             torch.cuda.empty_cache()
             #state['selection_mask']
             # Used the instance predictions from bag training to update the Instance Dataloader
-            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True)
-            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform)
+            instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, grayscale=config['grayscale'])
+            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, grayscale=config['grayscale'])
             train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
-            instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=train_sampler, collate_fn = collate_instance)
-            instance_dataloader_val = TUD.DataLoader(instance_dataset_val, batch_size=config['instance_batch_size'], collate_fn = collate_instance)
+            instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, train_sampler), collate_fn = collate_instance), augment=train_augment)
+            instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=bucket_sampler(config, instance_dataset_val, batch_size=config['instance_batch_size']), collate_fn = collate_instance))
             
             if state['warmup']:
                 target_count = config['warmup_epochs']
@@ -208,7 +209,7 @@ if __name__ == '__main__':
                     
                     if state['warmup']:
                         save_state(state, config, instance_train_acc, val_losses.avg, instance_val_acc, model, optimizer)
-                        palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                        palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                         print("Saved checkpoint due to improved val_loss_instance")
 
 
@@ -227,11 +228,12 @@ if __name__ == '__main__':
         torch.cuda.empty_cache()
         
         print('\nTraining Bag Aggregator')
+        train_bag_logits = BagLogitsBuffer(bags_train, device)
         for iteration in range(config['MIL_train_count']):
             
             model.train()
             total_loss = 0.0
-            train_bag_logits = {}
+            train_bag_logits.reset()
             total_acc = 0
             total = 0
             correct = 0
@@ -255,8 +257,7 @@ if __name__ == '__main__':
                 total += yb.size(0)
                 correct += (predicted == yb).sum().item()
                 
-                for instance_id, bag_id in enumerate(unique_id):
-                    train_bag_logits[bag_id] = instance_pred[instance_id].detach().cpu().numpy()
+                train_bag_logits.add_bags(unique_id, instance_pred)
                     
                 # Store raw predictions and targets
                 train_pred.update(bag_pred, yb, unique_id)
@@ -324,7 +325,7 @@ if __name__ == '__main__':
                 
                 save_state(state, config, train_acc, val_loss, val_acc, model, optimizer,)
                 save_metrics(config, state, train_pred, val_pred)
-                palm.save_state(os.path.join(target_folder, "palm_state.pkl"))
+                palm.save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
                 print("Saved checkpoint due to improved val_loss_bag")
 
                 
@@ -337,8 +338,7 @@ if __name__ == '__main__':
                 print("Created new sudo labels")
                 
                 # Save selection
-                with open(f'{target_folder}/selection_mask.pkl', 'wb') as file:
-                    pickle.dump(state['selection_mask'], file)
+                state['writer'].submit(save_selection_mask, state['selection_mask'], f'{target_folder}/selection_mask.tensors')
                     
                     
                     
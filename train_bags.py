@@ -77,17 +77,18 @@ if __name__ == '__main__':
     data_config = FishDataConfig  # or LesionDataConfig
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_bags.py')
     bags_train, bags_val, _, bag_dataloader_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
     
     # Procedural Bags
-    bag_dataset_train = SyntheticBagDataset(bags_train, transform=train_transform, min_bag_size=config['min_bag_size'], max_bag_size=config['max_bag_size'])
-    bag_dataloader_train = TUD.DataLoader(bag_dataset_train, batch_size=config['bag_batch_size'], collate_fn=collate_bag)
+    bag_dataset_train = SyntheticBagDataset(bags_train, transform=train_transform, min_bag_size=config['min_bag_size'], max_bag_size=config['max_bag_size'], grayscale=config['grayscale'])
+    bag_dataloader_train = NormalizedLoader(TUD.DataLoader(bag_dataset_train, batch_size=config['bag_batch_size'], collate_fn=collate_bag), augment=train_augment)
     
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     
 
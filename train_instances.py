@@ -37,12 +37,13 @@ if __name__ == '__main__':
     data_config = LesionDataConfig #FishDataConfig or LesionDataConfig
     
     config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_instances.py')
     bags_train, bags_val = prepare_all_data(config)
     num_classes = len(config['label_columns']) + 1
     num_labels = len(config['label_columns'])
 
     # Create Model
-    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels).cuda()
+    model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).cuda()
     print(f"Total Parameters: {sum(p.numel() for p in model.parameters())}")        
     
     # LOSS INIT
@@ -110,12 +111,12 @@ if __name__ == '__main__':
     
 
     # Used the instance predictions from bag training to update the Instance Dataloader
-    instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, max_positive=100)
-    instance_dataset_val = Instance_Dataset(bags_val, state['selection_mask'], transform=val_transform, warmup=True)
+    instance_dataset_train = Instance_Dataset(bags_train, state['selection_mask'], transform=train_transform, warmup=True, max_positive=100, grayscale=config['grayscale'])
+    instance_dataset_val = Instance_Dataset(bags_val, state['selection_mask'], transform=val_transform, warmup=True, grayscale=config['grayscale'])
     train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
     val_sampler = InstanceSampler(instance_dataset_val, config['instance_batch_size'], strategy=1)
-    instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=train_sampler, num_workers=2, collate_fn = collate_instance, persistent_workers=True, pin_memory=True)
-    instance_dataloader_val = TUD.DataLoader(instance_dataset_val, batch_sampler=val_sampler, collate_fn = collate_instance)
+    instance_dataloader_train = NormalizedLoader(TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, train_sampler), num_workers=2, collate_fn = collate_instance, persistent_workers=True, pin_memory=True), augment=train_augment)
+    instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=bucket_sampler(config, instance_dataset_val, val_sampler), collate_fn = collate_instance))
     
 
     
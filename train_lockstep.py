@@ -0,0 +1,322 @@
+import os
+import torch.utils.data as TUD
+from tqdm import tqdm
+from torch import nn
+from data.save_arch import *
+from util.Gen_ITS2CLR_util import *
+import torch.optim as optim
+from data.format_data import *
+from data.sudo_labels import *
+from archs.model_solo_MIL import *
+from data.instance_loader import *
+from loss.palm import PALM
+from loss.genSCL import GenSupConLossv2
+from util.eval_util import *
+from util.lockstep import *
+from util.profiling import *
+torch.backends.cudnn.benchmark = True
+device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+# Trains several train_PALM2 style variants in one process from one data stream. Every
+# batch is decoded once and each variant gets the same augmented views, or with
+# independent_views its own views augmented from the same decode. Variants keep their
+# own model, optimizer, losses, pseudo labels and checkpoints (models/<head_name>_<name>).
+# The instance stream holds every instance any variant selected, each variant trains
+# on the part of the batch it has labels for.
+
+
+
+if __name__ == '__main__':
+    # Config
+    model_version = '1'
+    head_name = "LOCKSTEP"
+    data_config = DogDataConfig #FishDataConfig or LesionDataConfig
+    independent_views = False
+
+    # n_protos: PALM prototypes, genscl: weight of GenSupConLossv2 over a second view (0 to skip)
+    variants = [
+        {'name': 'palm100', 'n_protos': 100, 'genscl': 0.0},
+        {'name': 'palm50', 'n_protos': 50, 'genscl': 0.0},
+        {'name': 'palm100_genscl', 'n_protos': 100, 'genscl': 0.5},
+    ]
+
+    config = build_config(model_version, head_name, data_config)
+    drop_unsupported(config, 'train_lockstep.py', supported=('profile',))
+    bags_train, bags_val, bag_dataloader_train, bag_dataloader_val = prepare_all_data(config)
+    num_classes = len(config['label_columns']) + 1
+    num_labels = len(config['label_columns'])
+    BCE_loss = nn.BCELoss()
+
+    # MODEL INIT, one of everything per variant
+    for i, v in enumerate(variants):
+        v['config'] = dict(config, head_name=f"{head_name}_{v['name']}")
+        model = Embeddingmodel(config['arch'], config['pretrained_arch'], num_classes = num_labels, n_in=input_channels(config)).to(device)
+        optimizer = optim.SGD(model.parameters(),
+                            lr=config['learning_rate'],
+                            momentum=0.9,
+                            nesterov=True,
+                            weight_decay=0.001)
+        v['model'], v['optimizer'], v['state'] = setup_model(model, v['config'], optimizer)
+        v['palm'] = PALM(nviews = 1, num_classes=2, n_protos=v['n_protos'], k = 0, lambda_pcon=1).to(device)
+        v['palm'].load_state(v['state']['palm_path'])
+        v['genscl_loss'] = GenSupConLossv2(temperature=0.07, base_temperature=0.07) if v['genscl'] else None
+        v['n_views'] = 2 if v['genscl'] else 1
+        v['normalizer'] = NormalizedLoader(None, augment=seeded_augment(train_augment, i) if independent_views else train_augment)
+
+    variants_in_step([v['state'] for v in variants])
+    shared = None if independent_views else NormalizedLoader(None, augment=train_augment)
+    n_views = [v['n_views'] for v in variants]
+
+    # One profile for the whole step of all variants, kept with the first variant
+    profiler = Profiler(config, variants[0]['state']['model_folder'], writer=variants[0]['state']['writer'])
+
+
+    # Training loop, variants leave once they reach total_epochs
+    while any(v['state']['epoch'] < config['total_epochs'] for v in variants):
+        active = [v for v in variants if v['state']['epoch'] < config['total_epochs']]
+        stage = active[0]['state']
+
+        if not stage['pickup_warmup']: # Are we resuming from a head model?
+
+            # One stream over every instance a variant selected, labels are looked up per variant
+            for v in active:
+                v['labels'] = instance_label_lookup(bags_train, v['state']['selection_mask'])
+            merged_mask = merge_selection_masks([v['state']['selection_mask'] for v in active])
+            instance_dataset_train = Instance_Dataset(bags_train, merged_mask, transform=train_transform, warmup=True, grayscale=config['grayscale'])
+            instance_dataset_val = Instance_Dataset(bags_val, [], transform=val_transform, warmup=True, grayscale=config['grayscale'])
+            train_sampler = InstanceSampler(instance_dataset_train, config['instance_batch_size'], strategy=1)
+            instance_dataloader_train = TUD.DataLoader(instance_dataset_train, batch_sampler=bucket_sampler(config, instance_dataset_train, train_sampler), collate_fn = collate_instance, **loader_kwargs(config))
+            instance_dataloader_val = NormalizedLoader(TUD.DataLoader(instance_dataset_val, batch_sampler=bucket_sampler(config, instance_dataset_val, batch_size=config['instance_batch_size']), collate_fn = collate_instance, **loader_kwargs(config)))
+
+            if stage['warmup']:
+                target_count = config['warmup_epochs']
+            else:
+                target_count = config['feature_extractor_train_count']
+
+            print('Training Feature Extractors')
+            print(f'Warmup Mode: {stage["warmup"]}')
+
+            for v in active:
+                # Unfreeze encoder
+                for param in v['model'].encoder.parameters():
+                    param.requires_grad = True
+
+
+            for iteration in range(target_count):
+                for v in active:
+                    v['model'].train()
+                    v['losses'] = AverageMeter()
+                    v['palm_correct'] = v['instance_correct'] = v['samples'] = 0
+                    v['train_pred'] = PredictionTracker()
+
+                # Iterate over the training data, decoded once for all variants
+                profiler.begin_epoch()
+                for idx, (images, _, unique_id) in enumerate(tqdm(profiler.timed(instance_dataloader_train), total=len(instance_dataloader_train))):
+                    with span('h2d'):
+                        images = images.to(device, non_blocking=True)
+                    with span('augment'):
+                        all_views = make_views(images, [v['normalizer'] for v in active], [v['n_views'] for v in active], shared)
+
+                    for v, views in zip(active, all_views):
+                        instance_labels = batch_labels(v['labels'], unique_id, device)
+                        keep = instance_labels >= 0
+                        if keep.sum() < 2: # BatchNorm needs two samples
+                            continue
+                        instance_labels = instance_labels[keep]
+                        bsz = instance_labels.size(0)
+
+                        # forward, both views in one pass for GenSCL
+                        v['optimizer'].zero_grad()
+                        with span('forward'):
+                            _, _, instance_predictions, features = v['model'](torch.cat([x[keep] for x in views]), projector=True)
+                        instance_predictions = instance_predictions[:bsz]
+                        zk = features[:bsz]
+
+                        with span('loss'):
+                            palm_loss, loss_dict = v['palm'](zk, instance_labels)
+                            bce_loss_value = BCE_loss(instance_predictions, instance_labels.float())
+                            total_loss = palm_loss + bce_loss_value
+                            if v['genscl_loss'] is not None:
+                                zq = features[bsz:]
+                                targets = mix_target(instance_labels, instance_labels, 1.0, num_classes)
+                                total_loss = total_loss + v['genscl'] * v['genscl_loss']([zk, zq], [targets, targets], None)
+
+                        with span('backward'):
+                            total_loss.backward()
+                        with span('optimizer'):
+                            v['optimizer'].step()
+                        v['losses'].update(total_loss.item(), bsz)
+
+                        with torch.no_grad(), span('metrics'):
+                            palm_predicted_classes, _ = v['palm'].predict(zk)
+                            v['palm_correct'] += (palm_predicted_classes == instance_labels).sum().item()
+                            v['instance_correct'] += ((instance_predictions > 0.5) == instance_labels).sum().item()
+                            v['samples'] += bsz
+
+                        # Store raw predictions and targets
+                        v['train_pred'].update(instance_predictions, instance_labels, unique_id[keep.cpu()])
+                    profiler.step()
+                profiler.end_epoch(f"instance {iteration + 1}/{target_count}")
+
+                for v in active:
+                    v['palm_train_acc'] = v['palm_correct'] / max(v['samples'], 1)
+                    v['instance_train_acc'] = v['instance_correct'] / max(v['samples'], 1)
+                    v['model'].eval()
+                    v['val_losses'] = AverageMeter()
+                    v['palm_correct'] = v['instance_correct'] = v['samples'] = 0
+                    v['val_pred'] = PredictionTracker()
+
+
+                # Validation loop, the same batches for every variant
+                with torch.no_grad():
+                    for idx, (images, instance_labels, unique_id) in enumerate(tqdm(instance_dataloader_val, total=len(instance_dataloader_val))):
+                        instance_labels = instance_labels.to(device, non_blocking=True)
+
+                        for v in active:
+                            _, _, instance_predictions, features = v['model'](images, projector=True)
+                            palm_loss, loss_dict = v['palm'](features, instance_labels, update_prototypes=False)
+                            total_loss = palm_loss + BCE_loss(instance_predictions, instance_labels.float())
+                            v['val_losses'].update(total_loss.item(), instance_labels.size(0))
+
+                            palm_predicted_classes, _ = v['palm'].predict(features)
+                            v['palm_correct'] += (palm_predicted_classes == instance_labels).sum().item()
+                            v['instance_correct'] += ((instance_predictions > 0.5) == instance_labels).sum().item()
+                            v['samples'] += instance_labels.size(0)
+                            v['val_pred'].update(instance_predictions, instance_labels, unique_id)
+
+                for v in active:
+                    state = v['state']
+                    palm_val_acc = v['palm_correct'] / v['samples']
+                    instance_val_acc = v['instance_correct'] / v['samples']
+                    print(f"{v['name']} [{iteration+1}/{target_count}] Train Loss: {v['losses'].avg:.5f}, Train Palm Acc: {v['palm_train_acc']:.5f}, Train FC Acc: {v['instance_train_acc']:.5f}")
+                    print(f"{v['name']} [{iteration+1}/{target_count}] Val Loss:   {v['val_losses'].avg:.5f}, Val Palm Acc: {palm_val_acc:.5f}, Val FC Acc: {instance_val_acc:.5f}")
+
+                    # Save the model
+                    if v['val_losses'].avg < state['val_loss_instance']:
+                        state['val_loss_instance'] = v['val_losses'].avg
+                        state['mode'] = 'instance'
+
+                        if state['warmup']:
+                            target_folder = state['head_folder']
+                        else:
+                            target_folder = state['model_folder']
+
+                        save_metrics(v['config'], state, v['train_pred'], v['val_pred'])
+
+                        if state['warmup']:
+                            save_state(state, v['config'], v['instance_train_acc'], v['val_losses'].avg, instance_val_acc, v['model'], v['optimizer'])
+                            v['palm'].save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
+                            print(f"{v['name']}: Saved checkpoint due to improved val_loss_instance")
+
+
+
+
+        for v in active:
+            if v['state']['pickup_warmup']:
+                v['state']['pickup_warmup'] = False
+            if v['state']['warmup']:
+                v['state']['warmup'] = False
+        print("Warmup Phase Finished")
+
+
+        print('\nTraining Bag Aggregators')
+        for v in active:
+            v['bag_logits'] = BagLogitsBuffer(bags_train, device)
+
+        for iteration in range(config['MIL_train_count']):
+            for v in active:
+                v['model'].train()
+                v['bag_logits'].reset()
+                v['total_loss'] = 0.0
+                v['correct'] = v['total'] = 0
+                v['train_pred'] = PredictionTracker()
+
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            # Bags are decoded once, every variant augments them (or shares one augmentation)
+            profiler.begin_epoch()
+            for (images, yb, instance_labels, unique_id) in tqdm(profiler.timed(bag_dataloader_train.loader), total=len(bag_dataloader_train)):
+                with span('h2d'):
+                    images = [bag.to(device, non_blocking=True) for bag in images]
+                    # The raw loader skips NormalizedLoader, labels from workers are still on the CPU
+                    yb = yb.to(device, non_blocking=True)
+                    unique_id = unique_id.to(device, non_blocking=True)
+                with span('augment'):
+                    all_views = make_views(images, [v['normalizer'] for v in active], [1] * len(active), shared)
+
+                for v, views in zip(active, all_views):
+                    v['optimizer'].zero_grad()
+                    with span('forward'):
+                        bag_pred, _, instance_pred, features = v['model'](views[0], pred_on=True, projector=True)
+                    v['bag_logits'].add(unique_id, instance_pred)
+
+                    with span('loss'):
+                        bag_loss = BCE_loss(bag_pred, yb)
+                    with span('backward'):
+                        bag_loss.backward()
+                    with span('optimizer'):
+                        v['optimizer'].step()
+
+                    with span('metrics'):
+                        v['total_loss'] += bag_loss.item() * yb.size(0)
+                        v['total'] += yb.size(0)
+                        v['correct'] += ((bag_pred > 0.5).float() == yb).sum().item()
+                        v['train_pred'].update(bag_pred, yb, unique_id)
+                profiler.step()
+            profiler.end_epoch(f"bag {iteration + 1}/{config['MIL_train_count']}")
+
+            for v in active:
+                v['train_loss'] = v['total_loss'] / v['total']
+                v['train_acc'] = v['correct'] / v['total']
+                v['model'].eval()
+                v['total_val_loss'] = 0.0
+                v['correct'] = v['total'] = 0
+                v['val_pred'] = PredictionTracker()
+
+            # Evaluation phase
+            with torch.no_grad():
+                for (images, yb, instance_labels, unique_id) in tqdm(bag_dataloader_val, total=len(bag_dataloader_val)):
+                    for v in active:
+                        bag_pred, _, _, features = v['model'](images, pred_on=True)
+                        v['total_val_loss'] += BCE_loss(bag_pred, yb).item() * yb.size(0)
+                        v['total'] += yb.size(0)
+                        v['correct'] += ((bag_pred > 0.5).float() == yb).sum().item()
+                        v['val_pred'].update(bag_pred, yb, unique_id)
+
+            for v in active:
+                state = v['state']
+                val_loss = v['total_val_loss'] / v['total']
+                val_acc = v['correct'] / v['total']
+                state['train_losses'].append(v['train_loss'])
+                state['valid_losses'].append(val_loss)
+
+                print(f"{v['name']} [{iteration+1}/{config['MIL_train_count']}] | Acc | Loss")
+                print(f"Train | {v['train_acc']:.4f} | {v['train_loss']:.4f}")
+                print(f"Val | {val_acc:.4f} | {val_loss:.4f}")
+
+                # Save the model
+                if val_loss < state['val_loss_bag']:
+                    state['val_loss_bag'] = val_loss
+                    state['mode'] = 'bag'
+                    if state['warmup']:
+                        target_folder = state['head_folder']
+                    else:
+                        target_folder = state['model_folder']
+
+                    save_state(state, v['config'], v['train_acc'], val_loss, val_acc, v['model'], v['optimizer'],)
+                    save_metrics(v['config'], state, v['train_pred'], v['val_pred'])
+                    v['palm'].save_state(os.path.join(target_folder, "palm_state.tensors"), writer=state['writer'])
+                    print(f"{v['name']}: Saved checkpoint due to improved val_loss_bag")
+
+                    state['epoch'] += 1
+
+                    # Create selection mask
+                    predictions_ratio = prediction_anchor_scheduler(state['epoch'], config['total_epochs'], 0, config['initial_ratio'], config['final_ratio'])
+                    state['selection_mask'] = create_selection_mask(v['bag_logits'], predictions_ratio)
+                    print(f"{v['name']}: Created new sudo labels")
+
+                    # Save selection
+                    state['writer'].submit(save_selection_mask, state['selection_mask'], f'{target_folder}/selection_mask.tensors')
+
+    profiler.close()
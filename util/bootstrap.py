@@ -0,0 +1,162 @@
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Vectorized bootstrap for the reporting metrics.
+# Every replicate is a row of resampling counts (weights) over the original
+# samples, so a chunk of replicates is just a (B, N) matrix. Threshold metrics
+# are one matrix product with indicator columns and AUC is computed for the
+# whole chunk at once from midranks, no per-replicate sklearn calls.
+
+BOOTSTRAP_METRICS = ['sensitivity', 'specificity', 'ppv', 'npv']
+
+
+def groups_from_ids(ids):
+    """
+    Accession level groups for resampling. Instance ids look like
+    '{accession}_{idx}_{img|vid}', any other id (bag ids) is its own group.
+    """
+    return np.array([i.rsplit('_', 2)[0] if isinstance(i, str) and i.count('_') >= 2 else str(i) for i in ids], dtype=object)
+
+
+def _row_bincount(index, weights, n_bins):
+    """bincount of `index` for every row of `weights` (B, len(index)), returns (B, n_bins)"""
+    n_rows = weights.shape[0]
+    flat = (index[None, :] + np.arange(n_rows)[:, None] * n_bins).ravel()
+    return np.bincount(flat, weights=weights.ravel(), minlength=n_rows * n_bins).reshape(n_rows, n_bins)
+
+
+def resample_weights(rng, n_boot, unit_index, n_units):
+    """
+    Draw n_boot resamples of the units (samples or accessions) with replacement.
+    Returns (n_boot, N) counts of how often each sample was drawn.
+    """
+    picks = rng.integers(0, n_units, size=(n_boot, n_units))
+    offsets = np.arange(n_boot)[:, None] * n_units
+    unit_counts = np.bincount((picks + offsets).ravel(), minlength=n_boot * n_units).reshape(n_boot, n_units)
+    return unit_counts[:, unit_index].astype(np.float64)
+
+
+def batched_auc(weights, positive, rank_index, n_ranks):
+    """
+    Midrank (Mann-Whitney) AUC for every row of `weights`.
+    rank_index maps each sample to the index of its prediction among the sorted unique values.
+    """
+    pos_w = _row_bincount(rank_index[positive], weights[:, positive], n_ranks)
+    neg_w = _row_bincount(rank_index[~positive], weights[:, ~positive], n_ranks)
+
+    # Negatives strictly below each value, ties count half
+    neg_below = np.cumsum(neg_w, axis=1) - neg_w
+    pairs = pos_w.sum(axis=1) * neg_w.sum(axis=1)
+    wins = (pos_w * (neg_below + 0.5 * neg_w)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(pairs > 0, wins / pairs, np.nan)
+
+
+def _indicator_matrix(targets, predictions, thresholds):
+    """Columns TP, FN, FP, TN for each threshold, so weights @ matrix gives the confusion counts"""
+    positive = targets == 1
+    columns = []
+    for threshold in thresholds:
+        predicted = predictions >= np.asarray(threshold, dtype=predictions.dtype)
+        columns += [positive & predicted, positive & ~predicted, ~positive & predicted, ~positive & ~predicted]
+    return np.stack(columns, axis=1).astype(np.float64)
+
+
+def _ratio(numerator, denominator):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def _chunk_metrics(weights, data):
+    """All bootstrap metrics for a (B, N) weight matrix, returns {name: (B,) array}"""
+    results = {'auc': batched_auc(weights, data['positive'], data['rank_index'], data['n_ranks'])}
+
+    counts = weights @ data['indicators']
+    for i, name in enumerate(data['threshold_names']):
+        TP, FN, FP, TN = (counts[:, 4 * i + j] for j in range(4))
+        results[f'{name}_sensitivity'] = _ratio(TP, TP + FN)
+        results[f'{name}_specificity'] = _ratio(TN, TN + FP)
+        results[f'{name}_ppv'] = _ratio(TP, TP + FP)
+        results[f'{name}_npv'] = _ratio(TN, TN + FN)
+    return results
+
+
+# Worker processes receive the data once through the pool initializer
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _run_chunk(seed, n_boot, data=None):
+    data = data if data is not None else _worker_data
+    rng = np.random.default_rng(seed)
+    weights = resample_weights(rng, n_boot, data['unit_index'], data['n_units'])
+    return _chunk_metrics(weights, data)
+
+
+def bootstrap_metrics(targets, predictions, thresholds, groups=None, n_bootstrap=1000, alpha=0.05,
+                      seed=0, n_workers=None, chunk_size=None):
+    """
+    Percentile bootstrap confidence intervals.
+
+    thresholds: {name: threshold} operating points, fixed from the full data
+    groups:     optional group label per sample (e.g. accession), whole groups are resampled together
+    Returns {metric: (point estimate, lower, upper)}.
+    """
+    targets = np.asarray(targets).ravel()
+    predictions = np.asarray(predictions).ravel()
+    n = len(targets)
+
+    if groups is None:
+        unit_index = np.arange(n)
+        n_units = n
+    else:
+        _, unit_index = np.unique(np.asarray(groups), return_inverse=True)
+        n_units = int(unit_index.max()) + 1 if n else 0
+
+    unique_preds, rank_index = np.unique(predictions, return_inverse=True)
+    data = {
+        'positive': targets == 1,
+        'rank_index': rank_index.ravel(),
+        'n_ranks': len(unique_preds),
+        'unit_index': unit_index.ravel(),
+        'n_units': n_units,
+        'threshold_names': list(thresholds.keys()),
+        'indicators': _indicator_matrix(targets, predictions, thresholds.values()),
+    }
+
+    # Keep each (B, N) chunk around 32M values
+    if chunk_size is None:
+        chunk_size = int(np.clip(32_000_000 // max(n, max(data['n_ranks'], 1)), 1, 500))
+    sizes = [min(chunk_size, n_bootstrap - start) for start in range(0, n_bootstrap, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    # Pools can't be started from daemon processes (e.g. the checkpoint writer's plot process)
+    if n_workers is None:
+        n_workers = min(len(sizes), os.cpu_count() or 1)
+    if mp.current_process().daemon:
+        n_workers = 1
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(data,)) as pool:
+            chunks = list(pool.map(_run_chunk, seeds, sizes))
+    else:
+        chunks = [_run_chunk(s, b, data) for s, b in zip(seeds, sizes)]
+
+    point = _chunk_metrics(np.ones((1, n)), data)
+    lower_q, upper_q = 100 * alpha / 2, 100 * (1 - alpha / 2)
+
+    intervals = {}
+    for name in point:
+        values = np.concatenate([chunk[name] for chunk in chunks])
+        if np.all(np.isnan(values)):
+            low = high = np.nan
+        else:
+            low, high = np.nanpercentile(values, [lower_q, upper_q])
+        intervals[name] = (point[name][0], low, high)
+    return intervals
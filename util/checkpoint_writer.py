@@ -0,0 +1,139 @@
+import atexit
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+import torch
+
+
+def snapshot_to_cpu(value):
+    """Copy every tensor in a (nested) state to CPU memory so training can keep mutating the originals"""
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {k: snapshot_to_cpu(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [snapshot_to_cpu(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(snapshot_to_cpu(v) for v in value)
+    return value
+
+
+def _plot_worker(jobs):
+    # Runs in a separate process so matplotlib rendering never blocks training
+    import matplotlib
+    matplotlib.use('Agg')
+    while True:
+        job = jobs.get()
+        try:
+            if job is None:
+                return
+            fn, args, kwargs = job
+            fn(*args, **kwargs)
+        except Exception:
+            print("Error in plot worker:")
+            traceback.print_exc()
+        finally:
+            jobs.task_done()
+
+
+class CheckpointWriter:
+    """
+    Background writer for checkpoints and reports.
+
+    File jobs run on a single thread in submission order. Plot jobs are forwarded
+    (in the same order) to one worker process. Pending jobs are always completed
+    before the interpreter exits.
+
+    A failed file job is printed right away and raised again from the next submit(),
+    save() or flush(), so a lost checkpoint doesn't pass silently.
+
+    With synchronous=True every job runs inline, which is the old behaviour.
+    """
+    def __init__(self, synchronous=False):
+        self.synchronous = synchronous
+        self._closed = False
+        self._error = None
+        self._jobs = None
+        self._thread = None
+        self._plot_jobs = None
+        self._plot_process = None
+
+        if not synchronous:
+            self._jobs = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception as e:
+                print("Error in checkpoint writer:")
+                traceback.print_exc()
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise RuntimeError("A background checkpoint job failed, see the traceback above") from error
+
+    def _start_plot_process(self):
+        ctx = mp.get_context('spawn')
+        self._plot_jobs = ctx.JoinableQueue()
+        self._plot_process = ctx.Process(target=_plot_worker, args=(self._plot_jobs,), daemon=True)
+        self._plot_process.start()
+
+    def _forward_plot(self, fn, args, kwargs):
+        if self._plot_process is None:
+            self._start_plot_process()
+        self._plot_jobs.put((fn, args, kwargs))
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the writer thread after all previously submitted jobs"""
+        self._raise_error()
+        if self.synchronous or self._closed:
+            fn(*args, **kwargs)
+        else:
+            self._jobs.put((fn, args, kwargs))
+
+    def plot(self, fn, *args, **kwargs):
+        """Run a plotting/report function in the plot process. fn and args must be picklable"""
+        if self.synchronous or self._closed:
+            fn(*args, **kwargs)
+        else:
+            self.submit(self._forward_plot, fn, args, kwargs)
+
+    def save(self, save_fn, state, path):
+        """Snapshot `state` to the CPU now and write it with save_fn(state, path) in the background"""
+        self.submit(save_fn, snapshot_to_cpu(state), path)
+
+    def flush(self):
+        """Block until every submitted job has finished"""
+        if self.synchronous:
+            return
+        self._jobs.join()
+        if self._plot_jobs is not None:
+            self._plot_jobs.join()
+        self._raise_error()
+
+    def close(self):
+        if self.synchronous or self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._jobs.put(None)
+            self._thread.join()
+            if self._plot_process is not None:
+                self._plot_jobs.put(None)
+                self._plot_process.join()
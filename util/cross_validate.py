@@ -0,0 +1,109 @@
+import os
+import sys
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from config import *
+from util.sweep import Trial, run_trials
+from util.progressive import binary_auc
+
+# Accession grouped k-fold cross validation. The bags are prepared once, the folds are
+# assigned once (stratified by bag label) and every fold trains in its own process with
+# config['fold'] masking its bags as validation. Fold k trains its head and model into
+# models/<head>/<version>/fold_k, then the bag predictions of all folds are pooled into
+# an out-of-fold AUC next to them.
+#
+#   python util/cross_validate.py --head CV_LESION --version 1 --folds 5 --parallel 2 --gpus 0,1
+
+
+def fold_predictions(head_name, version):
+    """Validation predictions the fold's last saved bag model made, None if it never saved one"""
+    path = os.path.join(parent_dir, "models", head_name, version, "evaluation", "bag_predictions_val.csv")
+    return pd.read_csv(path) if os.path.exists(path) else None
+
+
+def aggregate_folds(trials, cv_folder):
+    """Per fold AUC and pooled out-of-fold AUC, written to cv_results.csv and oof_predictions.csv"""
+    rows, pooled = [], []
+    for fold, trial in enumerate(trials):
+        row = {'fold': fold, **trial.result()}
+        predictions = fold_predictions(trial.head_name, os.path.basename(trial.model_folder))
+        if predictions is not None:
+            predictions['fold'] = fold
+            pooled.append(predictions)
+            row['val_bags'] = len(predictions)
+            row['val_auc'] = binary_auc(predictions['target'].values, predictions['prediction'].values)
+        rows.append(row)
+
+    results = pd.DataFrame(rows)
+    if pooled:
+        oof = pd.concat(pooled, ignore_index=True)
+        oof.to_csv(os.path.join(cv_folder, "oof_predictions.csv"), index=False)
+        oof_auc = binary_auc(oof['target'].values, oof['prediction'].values)
+        fold_aucs = results['val_auc'].dropna()
+        summary = {'fold': 'all', 'val_bags': len(oof), 'val_auc': oof_auc}
+        results = pd.concat([results, pd.DataFrame([summary])], ignore_index=True)
+        print(f"\nFold AUC: {fold_aucs.mean():.4f} +/- {fold_aucs.std():.4f} over {len(fold_aucs)} folds")
+        print(f"Pooled out-of-fold AUC: {oof_auc:.4f} ({len(oof)} bags)")
+    else:
+        print("No fold saved bag predictions")
+
+    results.to_csv(os.path.join(cv_folder, "cv_results.csv"), index=False)
+    return results
+
+
+def run_cross_validation(head_name, version, n_folds, script='train_PALM2.py', data_config='LesionDataConfig',
+                         parallel=1, threads=None, gpus=None, seed=0, poll_seconds=30):
+    from data.format_data import prepare_all_data, save_bag_cache, load_bag_cache, assign_folds
+
+    cv_folder = os.path.join(parent_dir, "models", head_name, version)
+    os.makedirs(cv_folder, exist_ok=True)
+    bag_cache = os.path.join(cv_folder, "cv_bags.pkl")
+    folds_path = os.path.join(cv_folder, "cv_folds.pkl")
+
+    # Prepare once, every fold only masks the same bags differently
+    if not os.path.exists(bag_cache):
+        config = build_config(version, head_name, globals()[data_config], overrides={})
+        bags_train, bags_val, _, _ = prepare_all_data(config)
+        save_bag_cache(bag_cache, bags_train, bags_val)
+    if not os.path.exists(folds_path):
+        bags_train, bags_val = load_bag_cache(bag_cache)
+        bag_ids, folds = assign_folds({**bags_train, **bags_val}, n_folds, seed)
+        with open(folds_path, 'wb') as f:
+            pickle.dump((bag_ids, folds), f)
+    with open(folds_path, 'rb') as f:
+        bag_ids, folds = pickle.load(f)
+    print(f"{len(bag_ids)} bags in {n_folds} folds: {np.bincount(folds, minlength=n_folds).tolist()}")
+
+    trials = []
+    for fold in range(n_folds):
+        overrides = {'data_config': data_config, 'bag_cache': bag_cache, 'cv_folds': folds_path, 'fold': fold}
+        trials.append(Trial(fold, f"fold_{fold}", {'fold': fold}, overrides, f"{head_name}/{version}/fold_{fold}", version, cv_folder))
+
+    run_trials(script, trials, parallel, threads, gpus, poll_seconds)
+    return aggregate_folds(trials, cv_folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accession grouped k-fold cross validation')
+    parser.add_argument('--head', required=True)
+    parser.add_argument('--version', default='1')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--script', default='train_PALM2.py')
+    parser.add_argument('--data_config', default='LesionDataConfig')
+    parser.add_argument('--parallel', type=int, default=1, help='Folds trained at the same time')
+    parser.add_argument('--threads', type=int, default=None, help='CPU cores / threads per fold')
+    parser.add_argument('--gpus', default=None, help='Comma separated GPU ids, handed out round robin')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--poll', type=int, default=30, help='Seconds between checks on the fold processes')
+    args = parser.parse_args()
+
+    gpus = [int(g) for g in args.gpus.split(',')] if args.gpus else None
+    run_cross_validation(args.head, args.version, args.folds, args.script, args.data_config,
+                         args.parallel, args.threads, gpus, args.seed, args.poll)
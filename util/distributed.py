@@ -0,0 +1,219 @@
+import os
+import random
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+# Multi process training helpers (train_PALM2_DDP.py). Launch with torchrun, e.g.
+#   torchrun --nproc_per_node=2 train_PALM2_DDP.py
+# Without torchrun's environment everything here falls back to a single process.
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def init_distributed(backend=None):
+    """
+    Join the process group described by torchrun's RANK / WORLD_SIZE / LOCAL_RANK.
+    gloo runs on CPU (and is the default without CUDA), nccl needs one GPU per rank.
+    Returns (rank, world_size, device).
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+
+    if world_size > 1 and not is_distributed():
+        dist.init_process_group(backend=backend)
+    return get_rank(), get_world_size(), device
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def broadcast_buffers(module, src=0):
+    """Copy every buffer of `module` (e.g. PALM's prototypes) from rank `src` to all ranks"""
+    if not is_distributed():
+        return
+    for buffer in module.buffers():
+        dist.broadcast(buffer.data, src)
+
+
+def all_reduce_sum(*values, device='cpu'):
+    """Sum python numbers over all ranks, returns a list of floats"""
+    if not is_distributed():
+        return [float(v) for v in values]
+    packed = torch.tensor([float(v) for v in values], dtype=torch.float64, device=device)
+    dist.all_reduce(packed)
+    return packed.tolist()
+
+
+def gather_predictions(tracker):
+    """Merge the PredictionTrackers of all ranks, every rank gets the combined tracker"""
+    if not is_distributed():
+        return tracker
+    predictions, targets, ids = tracker.get_results()
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, (predictions, targets, ids))
+
+    merged = type(tracker)()
+    for predictions, targets, ids in gathered:
+        merged.update(predictions, targets, ids if torch.is_tensor(ids) else list(ids))
+    return merged
+
+
+def _rank_share(indices, rank, world_size):
+    """Every world_size-th index starting at rank, trimmed so all ranks get the same count"""
+    per_rank = len(indices) // world_size
+    return indices[rank::world_size][:per_rank]
+
+
+class DistributedInstanceSampler(Sampler):
+    """
+    InstanceSampler for one rank. Positives and the equally sized draw of non positives
+    are both split across ranks, so every rank keeps the 50/50 class balance and the
+    one-positive-per-batch guarantee. All ranks draw from the same seed each epoch.
+    """
+    def __init__(self, dataset, batch_size, rank=None, world_size=None, seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.seed = seed
+        self.epoch = 0
+
+        labels = dataset.output_image_labels
+        self.indices_positive = [i for i, label in enumerate(labels) if label == 1]
+        self.indices_non_positive = [i for i, label in enumerate(labels) if label in (0, -1)]
+
+        self.samples_per_class = len(self.indices_positive) // self.world_size
+        self.total_batches = self.samples_per_class * 2 // self.batch_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+
+        # Same draw on every rank, then each takes its share of both classes
+        positives = list(self.indices_positive)
+        rng.shuffle(positives)
+        non_positives = rng.sample(self.indices_non_positive, min(len(positives), len(self.indices_non_positive)))
+        positives = _rank_share(positives, self.rank, self.world_size)
+        non_positives = _rank_share(non_positives, self.rank, self.world_size)
+
+        # From here on the draws are per rank
+        rng = random.Random(self.seed + self.epoch * self.world_size + self.rank + 1)
+        all_indices = positives + non_positives
+        rng.shuffle(all_indices)
+
+        for i in range(self.total_batches):
+            # Ensure at least one positive sample
+            pos_sample = rng.choice(positives)
+            available_indices = [idx for idx in all_indices if idx != pos_sample]
+            batch = [pos_sample] + rng.sample(available_indices, self.batch_size - 1)
+            rng.shuffle(batch)
+            yield batch
+
+    def __len__(self):
+        return self.total_batches
+
+
+class DistributedBalancedBagSampler(Sampler):
+    """BalancedBagSampler for one rank: both classes downsampled to the minority size and split across ranks"""
+    def __init__(self, dataset, batch_size, rank=None, world_size=None, seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.seed = seed
+        self.epoch = 0
+
+        self.pos_indices = []
+        self.neg_indices = []
+        for idx in range(len(dataset)):
+            bag_labels = dataset.bags_dict[dataset.unique_bag_ids[idx]]['bag_labels']
+            if 1 in bag_labels:
+                self.pos_indices.append(idx)
+            else:
+                self.neg_indices.append(idx)
+
+        self.min_class_size = min(len(self.pos_indices), len(self.neg_indices)) // self.world_size
+        self.n_samples = 2 * self.min_class_size
+        self.n_batches = -(-self.n_samples // batch_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        pos = list(self.pos_indices)
+        neg = list(self.neg_indices)
+        rng.shuffle(pos)
+        rng.shuffle(neg)
+
+        share = self.min_class_size
+        pos = pos[self.rank * share:(self.rank + 1) * share]
+        neg = neg[self.rank * share:(self.rank + 1) * share]
+
+        all_indices = pos + neg
+        random.Random(self.seed + self.epoch * self.world_size + self.rank + 1).shuffle(all_indices)
+        for start in range(0, self.n_samples, self.batch_size):
+            yield all_indices[start:start + self.batch_size]
+
+    def __len__(self):
+        return self.n_batches
+
+
+class DistributedEvalSampler(Sampler):
+    """Sequential batches of every rank's stride of the dataset, each item is evaluated exactly once"""
+    def __init__(self, dataset, batch_size, rank=None, world_size=None):
+        self.batch_size = batch_size
+        rank = get_rank() if rank is None else rank
+        world_size = get_world_size() if world_size is None else world_size
+        self.indices = list(range(rank, len(dataset), world_size))
+
+    def __iter__(self):
+        for start in range(0, len(self.indices), self.batch_size):
+            yield self.indices[start:start + self.batch_size]
+
+    def __len__(self):
+        return -(-len(self.indices) // self.batch_size)
+
+
+def set_sampler_epoch(loader, epoch):
+    """Call set_epoch on the distributed sampler or streaming dataset inside a (Normalized)Loader"""
+    loader = getattr(loader, 'loader', loader)
+    if hasattr(loader.dataset, 'set_epoch'):
+        loader.dataset.set_epoch(epoch)
+    sampler = loader.batch_sampler
+    while sampler is not None:
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+        sampler = getattr(sampler, 'batch_sampler', None)
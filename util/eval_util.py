@@ -7,9 +7,11 @@ from sklearn.manifold import TSNE
 import plotly.graph_objects as go
 import plotly.io as pio
 import matplotlib.pyplot as plt
-from sklearn.metrics import roc_curve, confusion_matrix, precision_score, recall_score, f1_score, roc_auc_score, balanced_accuracy_score
+from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score, roc_auc_score, balanced_accuracy_score
 import seaborn as sns
 import pandas as pd
+from util.bootstrap import bootstrap_metrics, groups_from_ids
+from data.instance_registry import resolve_instance_ids
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
@@ -27,10 +29,15 @@ class PredictionTracker:
         
         self.predictions.append(predictions.cpu().detach())
         self.targets.append(targets.cpu().detach())
-        self.ids.extend(ids)
+        # Instance and bag ids are int tensors, anything else is kept as a list
+        self.ids.append(ids.detach().cpu().reshape(-1) if torch.is_tensor(ids) else list(ids))
     
     def get_results(self):
-        return torch.cat(self.predictions), torch.cat(self.targets), self.ids
+        if self.ids and all(torch.is_tensor(ids) for ids in self.ids):
+            ids = torch.cat(self.ids)
+        else:
+            ids = [i for ids in self.ids for i in (ids.tolist() if torch.is_tensor(ids) else ids)]
+        return torch.cat(self.predictions), torch.cat(self.targets), ids
 
 def plot_Confusion(all_targs, all_preds, vocab, file_path):
     # Convert to numpy arrays if they aren't already
@@ -42,7 +49,10 @@ def plot_Confusion(all_targs, all_preds, vocab, file_path):
     
     # Compute the confusion matrix
     cm = confusion_matrix(all_targs_np, all_preds_binary)
-    
+    plot_confusion_counts(cm, vocab, file_path)
+
+
+def plot_confusion_counts(cm, vocab, file_path):
     # Normalize the confusion matrix by the total number of predictions
     cm_normalized = cm.astype('float') / cm.sum()
     
@@ -156,6 +166,11 @@ def visualize_prototypes_and_instances(prototypes, prototype_labels, instance_fe
 
 
 def calculate_ood_stats(distances_1, distances_2):
+    # QuantileSketches from util/streaming_metrics.py answer the same question in constant memory
+    if hasattr(distances_1, 'quantile'):
+        from util.streaming_metrics import calculate_ood_stats_streaming
+        return calculate_ood_stats_streaming(distances_1, distances_2)
+    
     # Calculate threshold (95th percentile of distances_1)
     threshold = np.percentile(distances_1, 95)
     
@@ -176,89 +191,127 @@ def get_metrics_path(head_name, version = None):
     
     return output_path
 
-def evaluate_model_performance(targets, predictions, target_specificity, save_path):
-    # Basic metrics
-    pred_class = (predictions >= 0.5).astype(int)  # Threshold for basic metrics
-    accuracy = balanced_accuracy_score(targets, pred_class)
-    precision = precision_score(targets, pred_class, average='binary')
-    recall = recall_score(targets, pred_class, average='binary') 
-    f1 = f1_score(targets, pred_class, average='binary')
-    auc = roc_auc_score(targets, predictions)
+def _safe_ratio(numerator, denominator):
+    """Elementwise numerator / denominator, 0 where the denominator is 0"""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+
+def roc_counts(targets, predictions):
+    """
+    Confusion counts at every distinct prediction value from a single sort.
     
-    # Calculate metrics for threshold 0.5
-    pred_class = (predictions >= 0.5).astype(int)
-    TP = np.sum((targets == 1) & (pred_class == 1))
-    TN = np.sum((targets == 0) & (pred_class == 0))
-    FP = np.sum((targets == 0) & (pred_class == 1))
-    FN = np.sum((targets == 1) & (pred_class == 0))
+    Returns (thresholds, TP, FP, n_pos, n_neg) with thresholds in descending order,
+    TP[i]/FP[i] count the positives/negatives with prediction >= thresholds[i].
+    """
+    targets = np.asarray(targets).ravel()
+    predictions = np.asarray(predictions).ravel()
     
-    default_sens = TP / (TP + FN) if (TP + FN) != 0 else 0
-    default_spec = TN / (TN + FP) if (TN + FP) != 0 else 0
-    default_ppv = TP / (TP + FP) if (TP + FP) != 0 else 0
-    default_npv = TN / (TN + FN) if (TN + FN) != 0 else 0
+    order = np.argsort(predictions, kind='mergesort')[::-1]
+    sorted_preds = predictions[order]
+    sorted_targets = targets[order]
     
+    tp = np.cumsum(sorted_targets == 1)
+    fp = np.cumsum(sorted_targets == 0)
+    n_pos = int(tp[-1]) if len(tp) else 0
+    n_neg = int(fp[-1]) if len(fp) else 0
+    
+    # Last position of each run of equal predictions
+    last = np.r_[np.flatnonzero(sorted_preds[1:] != sorted_preds[:-1]), len(sorted_preds) - 1] if len(sorted_preds) else np.zeros(0, dtype=int)
+    
+    return sorted_preds[last], tp[last], fp[last], n_pos, n_neg
 
+
+def counts_at_thresholds(exact_thresholds, exact_tp, exact_fp, thresholds):
+    """Read TP/FP of `predictions >= t` for arbitrary thresholds off the output of roc_counts"""
+    thresholds = np.asarray(thresholds)
+    if np.issubdtype(exact_thresholds.dtype, np.floating):
+        # Compare in the prediction dtype, like `predictions >= threshold` does
+        thresholds = thresholds.astype(exact_thresholds.dtype)
     
-    # Detailed threshold analysis
-    thresholds = np.linspace(0, 1, 1000)
-    best_threshold = best_accuracy = best_sensitivity = best_specificity = best_ppv = best_npv = 0
-    target_threshold = None
-    target_metrics = None
-    
-    # Arrays to store metrics for plotting
-    sensitivity_arr = []
-    specificity_arr = []
-    accuracy_arr = []
-    
-    for threshold in thresholds:
-        pred_class = (predictions >= threshold).astype(int)
-        TP = np.sum((targets == 1) & (pred_class == 1))
-        TN = np.sum((targets == 0) & (pred_class == 0))
-        FP = np.sum((targets == 0) & (pred_class == 1))
-        FN = np.sum((targets == 1) & (pred_class == 0))
-        
-        sens = TP / (TP + FN) if (TP + FN) != 0 else 0
-        spec = TN / (TN + FP) if (TN + FP) != 0 else 0
-        acc = (TP + TN) / (TP + TN + FP + FN)
-        ppv = TP / (TP + FP) if (TP + FP) != 0 else 0
-        npv = TN / (TN + FN) if (TN + FN) != 0 else 0
-        
-        sensitivity_arr.append(sens)
-        specificity_arr.append(spec)
-        accuracy_arr.append(acc)
-        
-        if target_threshold is None and spec >= target_specificity:
-            target_threshold = threshold
-            target_metrics = (acc, sens, spec, ppv, npv)
-            
-        if acc > best_accuracy:
-            best_accuracy = acc
-            best_threshold = threshold
-            best_sensitivity = sens
-            best_specificity = spec
-            best_ppv = ppv
-            best_npv = npv
+    # Number of distinct prediction values >= each threshold
+    k = len(exact_thresholds) - np.searchsorted(exact_thresholds[::-1], thresholds, side='left')
+    tp = np.r_[0, exact_tp][k]
+    fp = np.r_[0, exact_fp][k]
+    return tp, fp
 
+
+def threshold_confusion_counts(targets, predictions, thresholds=None):
+    """
+    TP, FP, TN, FN of `predictions >= t` for every threshold in O(N log N).
+    With thresholds=None every distinct prediction value is used as a threshold.
+    """
+    exact_thresholds, exact_tp, exact_fp, n_pos, n_neg = roc_counts(targets, predictions)
+    if thresholds is None:
+        thresholds, tp, fp = exact_thresholds, exact_tp, exact_fp
+    else:
+        tp, fp = counts_at_thresholds(exact_thresholds, exact_tp, exact_fp, thresholds)
+    return thresholds, tp, fp, n_neg - fp, n_pos - tp
+
+
+def threshold_metrics(thresholds, TP, FP, n_pos, n_neg, target_specificity):
+    """Sensitivity/specificity/accuracy curves plus the best accuracy and target specificity operating points"""
+    FN = n_pos - TP
+    TN = n_neg - FP
+    
+    sens = _safe_ratio(TP, TP + FN)
+    spec = _safe_ratio(TN, TN + FP)
+    acc = (TP + TN) / (n_pos + n_neg)
+    ppv = _safe_ratio(TP, TP + FP)
+    npv = _safe_ratio(TN, TN + FN)
+    
+    results = {
+        'thresholds': thresholds,
+        'sensitivity': sens,
+        'specificity': spec,
+        'accuracy': acc,
+        'best_threshold': 0, 'best_accuracy': 0, 'best_sensitivity': 0,
+        'best_specificity': 0, 'best_ppv': 0, 'best_npv': 0,
+        'target_threshold': None,
+        'target_metrics': None,
+    }
+    
+    # First threshold with the highest (non zero) accuracy
+    if len(acc):
+        i = int(np.argmax(acc))
+        if acc[i] > 0:
+            results.update(best_threshold=thresholds[i], best_accuracy=acc[i], best_sensitivity=sens[i],
+                           best_specificity=spec[i], best_ppv=ppv[i], best_npv=npv[i])
+    
+    # First threshold reaching the target specificity
+    hits = np.flatnonzero(spec >= target_specificity)
+    if len(hits):
+        i = hits[0]
+        results['target_threshold'] = thresholds[i]
+        results['target_metrics'] = (acc[i], sens[i], spec[i], ppv[i], npv[i])
+    
+    return results
+
+
+def write_performance_report(save_path, basic, sweep, target_specificity):
+    target_metrics = sweep['target_metrics']
+    
     with open(f"{save_path}/performance.txt", 'w') as f:
         f.write("Basic Metrics:\n")
-        f.write(f"* Accuracy: {accuracy:.2%}\n")
-        f.write(f"* AUC: {auc:.2%}\n")
-        f.write(f"* Sensitivity: {default_sens:.2%}\n")
-        f.write(f"* Specificity: {default_spec:.2%}\n")
-        f.write(f"* PPV: {default_ppv:.2%}\n")
-        f.write(f"* NPV: {default_npv:.2%}\n")
+        f.write(f"* Accuracy: {basic['accuracy']:.2%}\n")
+        f.write(f"* AUC: {basic['auc']:.2%}\n")
+        f.write(f"* Sensitivity: {basic['sensitivity']:.2%}\n")
+        f.write(f"* Specificity: {basic['specificity']:.2%}\n")
+        f.write(f"* PPV: {basic['ppv']:.2%}\n")
+        f.write(f"* NPV: {basic['npv']:.2%}\n")
         f.write(f"* Threshold: 0.50\n")
-        f.write(f"* Precision: {precision:.2%}\n")
-        f.write(f"* Recall: {recall:.2%}\n")
-        f.write(f"* F1 Score: {f1:.2%}\n\n")
+        f.write(f"* Precision: {basic['precision']:.2%}\n")
+        f.write(f"* Recall: {basic['recall']:.2%}\n")
+        f.write(f"* F1 Score: {basic['f1']:.2%}\n\n")
         
         f.write("Best Accuracy Threshold Metrics:\n")
-        f.write(f"* Accuracy: {best_accuracy:.2%}\n")
-        f.write(f"* Sensitivity: {best_sensitivity:.2%}\n")
-        f.write(f"* Specificity: {best_specificity:.2%}\n")
-        f.write(f"* PPV: {best_ppv:.2%}\n")
-        f.write(f"* NPV: {best_npv:.2%}\n")
-        f.write(f"* Threshold: {best_threshold:.2f}\n\n")
+        f.write(f"* Accuracy: {sweep['best_accuracy']:.2%}\n")
+        f.write(f"* Sensitivity: {sweep['best_sensitivity']:.2%}\n")
+        f.write(f"* Specificity: {sweep['best_specificity']:.2%}\n")
+        f.write(f"* PPV: {sweep['best_ppv']:.2%}\n")
+        f.write(f"* NPV: {sweep['best_npv']:.2%}\n")
+        f.write(f"* Threshold: {sweep['best_threshold']:.2f}\n\n")
         
         if target_metrics:
             f.write(f"Target Specificity ({target_specificity:.0%}) Threshold Metrics:\n")
@@ -267,14 +320,18 @@ def evaluate_model_performance(targets, predictions, target_specificity, save_pa
             f.write(f"* Specificity: {target_metrics[2]:.2%}\n")
             f.write(f"* PPV: {target_metrics[3]:.2%}\n")
             f.write(f"* NPV: {target_metrics[4]:.2%}\n")
-            f.write(f"* Threshold: {target_threshold:.2f}\n")
+            f.write(f"* Threshold: {sweep['target_threshold']:.2f}\n")
+
+
+def plot_threshold_metrics(save_path, sweep, target_specificity):
+    target_threshold = sweep['target_threshold']
     
     # Plot Performance Metrics
     plt.figure(figsize=(8, 8))
-    plt.plot(thresholds, sensitivity_arr, label='Sensitivity')
-    plt.plot(thresholds, specificity_arr, label='Specificity')
-    plt.plot(thresholds, accuracy_arr, label='Accuracy')
-    plt.axvline(x=best_threshold, color='r', linestyle='--', label='Best Accuracy Threshold')
+    plt.plot(sweep['thresholds'], sweep['sensitivity'], label='Sensitivity')
+    plt.plot(sweep['thresholds'], sweep['specificity'], label='Specificity')
+    plt.plot(sweep['thresholds'], sweep['accuracy'], label='Accuracy')
+    plt.axvline(x=sweep['best_threshold'], color='r', linestyle='--', label='Best Accuracy Threshold')
 
     # Only plot target threshold line if a valid threshold was found
     if target_threshold is not None:
@@ -288,19 +345,20 @@ def evaluate_model_performance(targets, predictions, target_specificity, save_pa
     plt.grid(True)
     plt.savefig(f"{save_path}/Performance_metrics_graph.png")
     plt.close()
-        
-    
-    # Plot ROC Curve
-    fpr, tpr, roc_thresholds = roc_curve(targets, predictions)
 
+
+def plot_roc_curve(save_path, fpr, tpr, auc, sweep, target_specificity):
+    target_threshold = sweep['target_threshold']
+    target_metrics = sweep['target_metrics']
+    
     plt.figure(figsize=(10, 10))
     plt.plot(fpr, tpr, color='blue', label=f'ROC curve (AUC = {auc:.2f})')
     plt.plot([0, 1], [0, 1], color='red', linestyle='--', label='Random Classifier')
 
     # Find point for threshold 0.5
-    threshold_05_idx = np.argmin(np.abs(thresholds - 0.5))
-    fpr_05 = 1 - specificity_arr[threshold_05_idx]
-    tpr_05 = sensitivity_arr[threshold_05_idx]
+    threshold_05_idx = np.argmin(np.abs(sweep['thresholds'] - 0.5))
+    fpr_05 = 1 - sweep['specificity'][threshold_05_idx]
+    tpr_05 = sweep['sensitivity'][threshold_05_idx]
 
     # Plot threshold points and annotations
     plt.plot(fpr_05, tpr_05, 'go', markersize=10, label='Threshold at 0.5')
@@ -337,15 +395,85 @@ def evaluate_model_performance(targets, predictions, target_specificity, save_pa
 
     plt.savefig(f"{save_path}/AUC_graph.png")
     plt.close()
+
+
+def evaluate_model_performance(targets, predictions, target_specificity, save_path):
+    # Basic metrics
+    pred_class = (predictions >= 0.5).astype(int)  # Threshold for basic metrics
+    accuracy = balanced_accuracy_score(targets, pred_class)
+    precision = precision_score(targets, pred_class, average='binary')
+    recall = recall_score(targets, pred_class, average='binary') 
+    f1 = f1_score(targets, pred_class, average='binary')
+    
+    # One sort gives the confusion counts at every distinct prediction value,
+    # every other threshold is a binary search into that curve
+    exact_thresholds, exact_tp, exact_fp, n_pos, n_neg = roc_counts(targets, predictions)
+    if n_pos == 0 or n_neg == 0:
+        raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+    
+    # Exact ROC curve and AUC
+    fpr = np.r_[0.0, exact_fp / n_neg]
+    tpr = np.r_[0.0, exact_tp / n_pos]
+    auc = np.trapz(tpr, fpr)
+    
+    # Calculate metrics for threshold 0.5
+    TP, FP = counts_at_thresholds(exact_thresholds, exact_tp, exact_fp, [0.5])
+    TP, FP = TP[0], FP[0]
+    FN = n_pos - TP
+    TN = n_neg - FP
+    
+    basic = {
+        'accuracy': accuracy,
+        'auc': auc,
+        'sensitivity': TP / (TP + FN) if (TP + FN) != 0 else 0,
+        'specificity': TN / (TN + FP) if (TN + FP) != 0 else 0,
+        'ppv': TP / (TP + FP) if (TP + FP) != 0 else 0,
+        'npv': TN / (TN + FN) if (TN + FN) != 0 else 0,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+    }
+    
+    # Detailed threshold analysis on the reporting grid
+    thresholds = np.linspace(0, 1, 1000)
+    TP, FP = counts_at_thresholds(exact_thresholds, exact_tp, exact_fp, thresholds)
+    sweep = threshold_metrics(thresholds, TP, FP, n_pos, n_neg, target_specificity)
+
+    write_performance_report(save_path, basic, sweep, target_specificity)
+    plot_threshold_metrics(save_path, sweep, target_specificity)
+    plot_roc_curve(save_path, fpr, tpr, auc, sweep, target_specificity)
+    
+    return sweep
     
     
     
     
             
-def calculate_metrics(targets, predictions, ids = None, target_specificity=0.80, save_path="./"):
+def write_confidence_intervals(save_path, intervals, thresholds, n_bootstrap, grouped, alpha=0.05):
+    with open(f"{save_path}/confidence_intervals.txt", 'w') as f:
+        f.write(f"Bootstrap {1 - alpha:.0%} Confidence Intervals ({n_bootstrap} replicates, {'accession' if grouped else 'sample'} resampling):\n")
+        point, low, high = intervals['auc']
+        f.write(f"* AUC: {point:.2%} ({low:.2%} - {high:.2%})\n\n")
+        
+        for name, threshold in thresholds.items():
+            f.write(f"{name} Threshold ({threshold:.2f}):\n")
+            for metric, label in [('sensitivity', 'Sensitivity'), ('specificity', 'Specificity'), ('ppv', 'PPV'), ('npv', 'NPV')]:
+                point, low, high = intervals[f'{name}_{metric}']
+                f.write(f"* {label}: {point:.2%} ({low:.2%} - {high:.2%})\n")
+            f.write("\n")
+
+
+def calculate_metrics(targets, predictions, ids = None, target_specificity=0.80, save_path="./", n_bootstrap=0, groups=None):
+    """Report files for targets / predictions, or for a StreamingBinaryMetrics passed as `targets` (predictions=None)"""
     # Create directory if it doesn't exist
     os.makedirs(save_path, exist_ok=True)
     
+    # Streaming accumulators only keep histograms, worst_instances.csv and bootstrap intervals need every prediction
+    if hasattr(targets, 'write_reports'):
+        if ids is not None or n_bootstrap:
+            print("Skipping worst instances and bootstrap intervals for a streaming accumulator")
+        return targets.write_reports(save_path, target_specificity)
+    
     # Convert PyTorch tensors to numpy arrays if needed
     if torch.is_tensor(targets):
         targets = targets.cpu().numpy()
@@ -363,12 +491,22 @@ def calculate_metrics(targets, predictions, ids = None, target_specificity=0.80,
     binary_indices = np.where((targets == 0) | (targets == 1))[0]
     targets = targets[binary_indices]
     predictions = predictions[binary_indices]
+    if groups is not None:
+        groups = np.asarray(groups)[binary_indices]
     
     # Collect worst performing labels
     if ids:
         get_worse_instances(targets, predictions, ids, save_path)
     
-    evaluate_model_performance(targets, predictions, target_specificity, save_path)
+    sweep = evaluate_model_performance(targets, predictions, target_specificity, save_path)
+    
+    # Confidence intervals at the fixed operating points of the full data
+    if n_bootstrap:
+        thresholds = {'Default': 0.5}
+        if sweep['target_threshold'] is not None:
+            thresholds['Target Specificity'] = sweep['target_threshold']
+        intervals = bootstrap_metrics(targets, predictions, thresholds, groups=groups, n_bootstrap=n_bootstrap)
+        write_confidence_intervals(save_path, intervals, thresholds, n_bootstrap, groups is not None)
 
     # Plot confusion matrix
     plot_Confusion(targets, predictions, ['Negitive', 'Positive'], f"{save_path}/confusion_matrix.png")
@@ -485,6 +623,24 @@ def get_worse_instances(targets, predictions, ids, output_path='./'):
         print(f"ids type: {type(ids)}, shape: {ids.shape if hasattr(ids, 'shape') else 'no shape'}")
         raise e
     
+def _ids_to_list(ids, mode):
+    if torch.is_tensor(ids):
+        # Instance ids go back to their report strings, bag ids are reported as is
+        return resolve_instance_ids(ids) if mode == 'instance' else ids.tolist()
+    return list(ids)
+
+def save_predictions(path, ids, targets, predictions):
+    """One row per id with its target and prediction (one column pair per label)"""
+    targets = np.asarray(targets).reshape(len(ids), -1)
+    predictions = np.asarray(predictions).reshape(len(ids), -1)
+    columns = {'id': ids}
+    for i in range(targets.shape[1]):
+        suffix = '' if targets.shape[1] == 1 else f'_{i}'
+        columns[f'target{suffix}'] = targets[:, i]
+        columns[f'prediction{suffix}'] = predictions[:, i]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.DataFrame(columns).to_csv(path, index=False)
+
 def save_metrics(config, state, train_pred, val_pred):
     
     train_pred, train_targets, train_ids = train_pred.get_results()
@@ -495,5 +651,21 @@ def save_metrics(config, state, train_pred, val_pred):
     if not state['warmup']: model_version = config['model_version']
     
     output_path = get_metrics_path(config['head_name'], model_version)
-    calculate_metrics(train_targets, train_pred, train_ids, save_path=f'{output_path}/{state["mode"]}_metrics_train/')
-    calculate_metrics(val_targets, val_pred, val_ids, save_path=f'{output_path}/{state["mode"]}_metrics_val/')
\ No newline at end of file
+    
+    # Reports are rendered in the writer's plot process, send it plain numpy/lists
+    writer = state.get('writer')
+    report = writer.plot if writer is not None else (lambda fn, *args, **kwargs: fn(*args, **kwargs))
+    train_ids = _ids_to_list(train_ids, state['mode'])
+    val_ids = _ids_to_list(val_ids, state['mode'])
+    
+    # Instances from the same accession are resampled together
+    n_bootstrap = config.get('bootstrap_samples', 0)
+    train_groups = groups_from_ids(train_ids) if n_bootstrap else None
+    val_groups = groups_from_ids(val_ids) if n_bootstrap else None
+    
+    report(calculate_metrics, train_targets.numpy(), train_pred.numpy(), train_ids, save_path=f'{output_path}/{state["mode"]}_metrics_train/', n_bootstrap=n_bootstrap, groups=train_groups)
+    report(calculate_metrics, val_targets.numpy(), val_pred.numpy(), val_ids, save_path=f'{output_path}/{state["mode"]}_metrics_val/', n_bootstrap=n_bootstrap, groups=val_groups)
+    
+    # Raw validation predictions, pooled into out-of-fold results by util/cross_validate.py
+    submit = writer.submit if writer is not None else (lambda fn, *args, **kwargs: fn(*args, **kwargs))
+    submit(save_predictions, f'{output_path}/{state["mode"]}_predictions_val.csv', val_ids, val_targets.numpy(), val_pred.numpy())
\ No newline at end of file
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.utils.data as TUD
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from config import *
+from data.format_data import *
+from data.instance_loader import *
+from data.bucketing import bucket_sampler
+
+# Finds the DataLoader settings that feed the training loops fastest on this machine.
+# Builds the real Instance_Dataset / BagOfImagesDataset of a data config and times
+# batches through NormalizedLoader (with train_augment, like train_PALM2) while sweeping
+# one setting at a time: num_workers, prefetch_factor, pin_memory (GPU only),
+# persistent_workers (time to the first batch of later epochs) and torch threads.
+# Every run reports images/sec, per batch latency (p50 / p95) and its jitter (std / mean).
+# A single process profile of the stages says what bounds the pipeline:
+#   decode        decode_image, reading and decoding the files (worker)
+#   augmentation  train_transform per image (worker) and train_augment and CLAHE per batch (main process)
+#   collate       collate_fn stacking the batch (worker)
+# The recommendation is printed as the ITS2CLRConfig loader fields (see loader_kwargs).
+#
+#   python util/loader_doctor.py --data_config LesionDataConfig --loader instance,bag
+#   python util/loader_doctor.py --data_config DogDataConfig --workers 0,4,8 --batches 50 --output doctor.json
+
+SETTINGS = ('num_workers', 'prefetch_factor', 'pin_memory', 'persistent_workers')
+STAGE_BOUNDS = {'decode': 'decode', 'transform': 'augmentation', 'augment': 'augmentation', 'collate': 'collate'}
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def default_grid(cpus):
+    return sorted({n for n in (0, 2, 4, 8, 16, 32, cpus) if n <= cpus})
+
+
+def n_images(images):
+    if isinstance(images, tuple):
+        return n_images(images[0])
+    if isinstance(images, list):
+        return sum(len(x) for x in images)
+    return images.size(0)
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def build_dataset(config, bags, kind):
+    if kind == 'instance':
+        return Instance_Dataset(bags, [], transform=train_transform, warmup=True, grayscale=config['grayscale'])
+    if kind == 'bag':
+        return BagOfImagesDataset(bags, transform=train_transform, grayscale=config['grayscale'])
+    raise ValueError(f"Unknown loader '{kind}', expected instance or bag")
+
+
+def batch_sampler(config, dataset, kind):
+    if kind == 'instance':
+        return bucket_sampler(config, dataset, InstanceSampler(dataset, config['instance_batch_size'], strategy=1))
+    return bucket_sampler(config, dataset, BalancedBagSampler(dataset, batch_size=config['bag_batch_size']))
+
+
+def make_loader(config, dataset, kind, settings):
+    collate = collate_instance if kind == 'instance' else collate_bag
+    loader = TUD.DataLoader(dataset, batch_sampler=batch_sampler(config, dataset, kind), collate_fn=collate,
+                            **loader_kwargs({**config, **settings}))
+    return NormalizedLoader(loader, augment=train_augment)
+
+
+def measure(loader, batches, warmup, epochs):
+    """
+    images/sec, per batch latencies (s) and the time to the first batch of every epoch,
+    over `batches` timed batches per epoch after `warmup` untimed ones
+    """
+    latencies, startup, images = [], [], 0
+    for _ in range(epochs):
+        start = time.perf_counter()
+        iterator = iter(loader)
+        last = start
+        for i in range(warmup + batches):
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            _sync()
+            now = time.perf_counter()
+            if i == 0:
+                startup.append(now - start)
+            elif i >= warmup:
+                latencies.append(now - last)
+                images += n_images(batch[0])
+            last = now
+        del iterator
+    if not latencies:
+        raise ValueError("No batches timed, the dataset is smaller than --warmup batches")
+    return images / sum(latencies), np.array(latencies), startup
+
+
+def summarize(settings, threads, result):
+    throughput, latencies, startup = result
+    mean = latencies.mean()
+    return {
+        **settings,
+        'torch_threads': threads,
+        'images_per_sec': float(throughput),
+        'p50_ms': float(1000 * np.percentile(latencies, 50)),
+        'p95_ms': float(1000 * np.percentile(latencies, 95)),
+        'jitter': float(latencies.std() / mean) if mean else 0.0,
+        'first_batch_s': float(startup[0]),
+        'later_first_batch_s': float(np.mean(startup[1:])) if len(startup) > 1 else float(startup[0]),
+    }
+
+
+def print_header():
+    print(f"{'workers':>8}{'prefetch':>9}{'pin':>5}{'persist':>8}{'threads':>8}{'img/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'jitter':>8}{'first s':>9}{'later s':>9}")
+
+
+def print_row(row):
+    print(f"{row['num_workers']:>8}{row['prefetch_factor']:>9}{str(row['pin_memory'])[0]:>5}{str(row['persistent_workers'])[0]:>8}"
+          f"{row['torch_threads']:>8}{row['images_per_sec']:>10.1f}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+          f"{row['jitter']:>8.2f}{row['first_batch_s']:>9.2f}{row['later_first_batch_s']:>9.2f}")
+
+
+def pick(rows, tolerance, key='images_per_sec'):
+    """First (cheapest) row within `tolerance` of the best, rows are ordered cheapest first"""
+    if key == 'images_per_sec':
+        best = max(r[key] for r in rows)
+        return next(r for r in rows if r[key] >= best * (1 - tolerance))
+    best = min(r[key] for r in rows)
+    return next(r for r in rows if r[key] <= best * (1 + tolerance) + 1e-3)
+
+
+def stage_costs(config, dataset, kind, samples):
+    """Seconds per image of every stage, run one after another in this process"""
+    loader = make_loader(config, dataset, kind, {'num_workers': 0})
+    indices = next(iter(loader.loader.batch_sampler))
+    if kind == 'instance':
+        paths = [dataset.images[i] for i in range(min(samples, len(dataset)))]
+    else:
+        paths = [p for bag_id in dataset.unique_bag_ids for p in dataset.bags_dict[bag_id]['images'] + dataset.bags_dict[bag_id]['videos']][:samples]
+
+    start = time.perf_counter()
+    decoded = [decode_image(p, config['grayscale']) for p in paths]
+    decode = (time.perf_counter() - start) / len(paths)
+
+    start = time.perf_counter()
+    for img in decoded:
+        train_transform(img)
+    transform = (time.perf_counter() - start) / len(paths)
+
+    items = [dataset[i] for i in indices]
+    start = time.perf_counter()
+    batch = loader.loader.collate_fn(items)
+    collate = (time.perf_counter() - start) / n_images(batch[0])
+
+    loader.normalize(batch[0]) # First call allocates on the device
+    _sync()
+    start = time.perf_counter()
+    loader.normalize(batch[0])
+    _sync()
+    augment = (time.perf_counter() - start) / n_images(batch[0])
+
+    return {'decode': decode, 'transform': transform, 'collate': collate, 'augment': augment}
+
+
+def bottleneck(costs, workers):
+    """(stage, images/sec ceiling of the pipeline) with `workers` loader workers"""
+    if workers == 0:
+        # Everything runs one after another in the main process
+        return max(costs, key=costs.get), 1 / sum(costs.values())
+    worker_cost = costs['decode'] + costs['transform'] + costs['collate']
+    if costs['augment'] * workers > worker_cost:
+        return 'augment', 1 / costs['augment']
+    stage = max(('decode', 'transform', 'collate'), key=costs.get)
+    return stage, workers / worker_cost
+
+
+def diagnose(config, bags, kind, args, cpus):
+    dataset = build_dataset(config, bags, kind)
+    pin_choices = [False, True] if torch.cuda.is_available() else [False]
+    grid = [int(n) for n in args.workers.split(',')] if args.workers else default_grid(cpus)
+    threads_grid = sorted({int(n) for n in args.threads.split(',')}) if args.threads else \
+        sorted({n for n in (1, 2, 4, 8, cpus) if n <= cpus})
+    default_threads = torch.get_num_threads()
+    print(f"\n{kind} loader: {len(dataset)} {'images' if kind == 'instance' else 'bags'}, {cpus} CPUs, "
+          f"{'cuda' if torch.cuda.is_available() else 'cpu'} normalize")
+
+    rows = []
+    def run(settings, threads=default_threads, epochs=1):
+        torch.set_num_threads(threads)
+        loader = make_loader(config, dataset, kind, settings)
+        row = summarize(settings, threads, measure(loader, args.batches, args.warmup, epochs))
+        del loader
+        print_row(row)
+        rows.append(row)
+        return row
+
+    print_header()
+    best = {'num_workers': 0, 'prefetch_factor': 2, 'pin_memory': False, 'persistent_workers': False}
+    settings_of = lambda row: {k: row[k] for k in SETTINGS}
+    best = settings_of(pick([run({**best, 'num_workers': n}) for n in grid], args.tolerance))
+    if best['num_workers'] > 0:
+        best = settings_of(pick([run({**best, 'prefetch_factor': n}) for n in (2, 4, 8)], args.tolerance))
+        if len(pin_choices) > 1:
+            best = settings_of(pick([run({**best, 'pin_memory': p}) for p in pin_choices], args.tolerance))
+        # Persistent workers only pay off from the second epoch on
+        persist = [run({**best, 'persistent_workers': p}, epochs=2) for p in (False, True)]
+        best = settings_of(pick(persist, args.tolerance, key='later_first_batch_s'))
+    thread_rows = [run(best, threads=t) for t in threads_grid]
+    threads = pick(thread_rows, args.tolerance)['torch_threads']
+    torch.set_num_threads(default_threads)
+
+    costs = stage_costs(config, dataset, kind, args.samples)
+    stage, ceiling = bottleneck(costs, best['num_workers'])
+    measured = max(r['images_per_sec'] for r in thread_rows)
+    total = sum(costs.values())
+    print(f"\nStages (one process, ms per image):")
+    for name, seconds in costs.items():
+        where = 'main' if name == 'augment' or best['num_workers'] == 0 else 'worker'
+        print(f"  {name:<10}{1000 * seconds:>8.2f}{seconds / total:>8.1%}  ({where})")
+    print(f"{STAGE_BOUNDS[stage]}-bound ({stage}) with {best['num_workers']} workers, "
+          f"ceiling {ceiling:.0f} img/s, measured {measured:.0f} img/s")
+    if measured < 0.6 * ceiling:
+        print("  Measured rate is well below the stage ceiling, the rest goes to storage reads, inter-process transfer or worker startup")
+    if stage != 'augment' and best['num_workers'] >= cpus:
+        print("  Workers already use every CPU, more throughput needs a cheaper stage (e.g. a preprocessed cache at the training size)")
+
+    return {'loader': kind, 'settings': best, 'torch_threads': threads, 'bound': STAGE_BOUNDS[stage], 'stage': stage,
+            'stage_ms_per_image': {k: 1000 * v for k, v in costs.items()}, 'runs': rows}
+
+
+def recommend(reports, cpus):
+    """Loader fields for both loaders, they share one set in the config"""
+    # The loader that needs the most workers sets them, the bag loader's on ties
+    report = max(reports, key=lambda r: (r['settings']['num_workers'], r['loader'] == 'bag'))
+    settings = report['settings']
+    threads = min(r['torch_threads'] for r in reports)
+    print("\nRecommended loader configuration (ITS2CLRConfig in config.py):")
+    for key in SETTINGS:
+        print(f"        self.{key} = {settings[key]}")
+    print(f"Torch threads in the main process: {threads} (torch.set_num_threads or OMP_NUM_THREADS)")
+    if settings['num_workers'] + threads > cpus:
+        print(f"  {settings['num_workers']} workers and {threads} threads oversubscribe the {cpus} CPUs once training runs too")
+    return {**settings, 'torch_threads': threads}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep DataLoader settings and recommend the fastest')
+    parser.add_argument('--data_config', default='LesionDataConfig', help='Config class the datasets are built from')
+    parser.add_argument('--model_version', default='1')
+    parser.add_argument('--head_name', default='loader_doctor')
+    parser.add_argument('--loader', default='instance,bag', help='Comma separated, instance and/or bag')
+    parser.add_argument('--workers', default=None, help='Comma separated num_workers grid, defaults to powers of two up to the CPU count')
+    parser.add_argument('--threads', default=None, help='Comma separated torch thread counts')
+    parser.add_argument('--batches', type=int, default=30, help='Timed batches per run')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed batches per epoch, after the first')
+    parser.add_argument('--samples', type=int, default=64, help='Images in the stage profile')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='Take the cheaper setting within this fraction of the best')
+    parser.add_argument('--output', default=None, help='JSON of every run and the recommendation')
+    args = parser.parse_args()
+
+    config = build_config(args.model_version, args.head_name, globals()[args.data_config])
+    bags_train, _, _, _ = prepare_all_data(config)
+    cpus = available_cpus()
+
+    reports = [diagnose(config, bags_train, kind, args, cpus) for kind in args.loader.split(',')]
+    recommendation = recommend(reports, cpus)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'recommendation': recommendation, 'reports': reports, 'cpus': cpus}, f, indent=2)
+        print(f"\nRuns in {args.output}")
@@ -0,0 +1,70 @@
+import copy
+import numpy as np
+import torch
+from data.sudo_labels import SelectionMask
+from data.instance_loader import Instance_Dataset
+
+# Helpers for train_lockstep.py, which trains several model variants in one process
+# from a single decoded data stream.
+
+
+def _as_selection_mask(mask):
+    if isinstance(mask, SelectionMask):
+        return mask
+    return SelectionMask.from_dict(mask if isinstance(mask, dict) else {})
+
+
+def merge_selection_masks(masks):
+    """
+    Union of the variants' pseudo label selections: an instance is in the shared
+    instance stream if any variant selected it. Each variant still trains on its own
+    labels (instance_label_lookup).
+    """
+    masks = [_as_selection_mask(m) for m in masks]
+    merged = {}
+    for mask in masks:
+        for bag_id, (labels, probs) in mask.items():
+            if bag_id not in merged:
+                merged[bag_id] = [labels.copy(), probs.copy()]
+                continue
+            unset = merged[bag_id][0] == -1
+            merged[bag_id][0][unset] = labels[unset]
+            merged[bag_id][1][unset] = probs[unset]
+    return SelectionMask.from_dict(merged)
+
+
+def instance_label_lookup(bags_dict, selection_mask):
+    """{instance id: label} of the instances a variant trains on with its own selection mask"""
+    dataset = Instance_Dataset(bags_dict, selection_mask, warmup=True)
+    return dict(zip(dataset.unique_ids.tolist(), dataset.output_image_labels))
+
+
+def batch_labels(lookup, ids, device):
+    """Labels of a batch for one variant, -1 where the variant does not use the instance"""
+    return torch.tensor([lookup.get(i, -1) for i in ids.tolist()], dtype=torch.long, device=device)
+
+
+def seeded_augment(augment, seed):
+    """Copy of a BatchAugment drawing from its own generator, for independently augmented views"""
+    augment = copy.copy(augment)
+    augment.generator = torch.Generator().manual_seed(seed)
+    return augment
+
+
+def make_views(raw, normalizers, n_views, shared=None):
+    """
+    Augmented views of one decoded batch for every variant. With a `shared` normalizer
+    all variants get the same views, otherwise each variant augments with its own.
+    """
+    if shared is not None:
+        views = [shared.normalize(raw) for _ in range(max(n_views))]
+        return [views[:n] for n in n_views]
+    return [[normalizer.normalize(raw) for _ in range(n)] for normalizer, n in zip(normalizers, n_views)]
+
+
+def variants_in_step(states):
+    """All variants must be in the same phase of training to share one data stream"""
+    keys = ('warmup', 'pickup_warmup')
+    stages = {tuple(state[k] for k in keys) for state in states}
+    if len(stages) > 1:
+        raise ValueError(f"Lockstep variants are at different stages ({', '.join(map(str, sorted(stages)))}), resume them separately")
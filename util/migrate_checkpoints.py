@@ -0,0 +1,88 @@
+import os
+import sys
+import argparse
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from util.tensor_io import *
+from data.sudo_labels import load_selection_mask, save_selection_mask
+
+# Converts legacy model folders (model.pth, classifier.pth, optimizer.pth,
+# palm_state.pkl, selection_mask.pkl) into device independent tensor files.
+# stats.pkl and the text/plot outputs are left untouched.
+
+STATE_DICT_FILES = ['model.pth', 'classifier.pth', 'optimizer.pth']
+
+
+def convert_file(src_path, dst_path, kind):
+    if kind == 'state_dict':
+        save_nested_state(load_legacy_torch(src_path), dst_path)
+    elif kind == 'palm':
+        save_nested_state(load_legacy_pickle(src_path), dst_path)
+    elif kind == 'selection_mask':
+        save_selection_mask(load_selection_mask(src_path), dst_path)
+
+
+def migrate_folder(folder, delete_legacy=False, overwrite=False):
+    """Convert every legacy checkpoint in `folder`. Returns the number of converted files"""
+    jobs = [(name, 'state_dict') for name in STATE_DICT_FILES]
+    jobs += [('palm_state.pkl', 'palm'), ('selection_mask.pkl', 'selection_mask')]
+
+    converted = 0
+    for file_name, kind in jobs:
+        src_path = os.path.join(folder, file_name)
+        if not os.path.exists(src_path):
+            continue
+        dst_path = os.path.join(folder, os.path.splitext(file_name)[0] + TENSOR_FILE_EXT)
+        if os.path.exists(dst_path) and not overwrite:
+            print(f"Skipping {src_path}, {os.path.basename(dst_path)} already exists")
+            continue
+
+        try:
+            convert_file(src_path, dst_path, kind)
+        except Exception as e:
+            print(f"Error converting {src_path}: {e}")
+            continue
+
+        converted += 1
+        print(f"Converted {src_path}")
+        if delete_legacy:
+            os.remove(src_path)
+
+    return converted
+
+
+def verify_folder(folder):
+    """Load every tensor file in `folder` on the CPU and report the load time"""
+    for file_name in sorted(os.listdir(folder)):
+        if not file_name.endswith(TENSOR_FILE_EXT):
+            continue
+        path = os.path.join(folder, file_name)
+        start = time.perf_counter()
+        header, _ = read_tensor_header(path)
+        load_tensors(path, device='cpu', mmap=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"  {file_name}: {len(header['tensors'])} tensors, {elapsed:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert legacy .pth/.pkl checkpoints to tensor files')
+    parser.add_argument('--models_dir', default=os.path.join(parent_dir, 'models'), help='Root folder to search for model folders')
+    parser.add_argument('--delete_legacy', action='store_true', help='Remove the legacy files after a successful conversion')
+    parser.add_argument('--overwrite', action='store_true', help='Replace tensor files that already exist')
+    parser.add_argument('--verify', action='store_true', help='Load every converted folder on the CPU afterwards')
+    args = parser.parse_args()
+
+    total = 0
+    for folder, _, files in os.walk(args.models_dir):
+        if not any(f in files for f in STATE_DICT_FILES + ['palm_state.pkl', 'selection_mask.pkl']):
+            continue
+        count = migrate_folder(folder, args.delete_legacy, args.overwrite)
+        total += count
+        if args.verify:
+            verify_folder(folder)
+
+    print(f"Converted {total} checkpoint files")
@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import torch
+
+# Hot path timing (config['profile']). Regions are wrapped in span(name) in the
+# trainers, Embeddingmodel.forward and PALM. When profiling is off span() returns one
+# shared no-op context manager, so the instrumentation costs a global lookup per region.
+#
+#   profiler = Profiler(config, state['model_folder'], writer=state['writer'])
+#   profiler.begin_epoch()
+#   for batch in profiler.timed(loader):     # time spent waiting on the loader -> 'data'
+#       with span('forward'):
+#           ...
+#       profiler.step()
+#   profiler.end_epoch('instance 3')         # prints the table, appends profile.csv, writes trace_<n>.json
+#   profiler.close()
+#
+# CUDA runs asynchronously, with config['profile_cuda_sync'] every span synchronizes at
+# its boundaries so the times belong to the region (at some cost to throughput). Spans
+# nest, the table lists every name with its own total, so 'forward' includes 'encoder'.
+# The trace_<n>.json files open in chrome://tracing or https://ui.perfetto.dev.
+# config['profile_torch'] additionally runs torch.profiler over a few steps of every epoch
+# (torch_trace_<n>.json), with the spans showing up as record_function ranges in its trace.
+
+MAX_TRACE_EVENTS = 200000
+
+_active = None
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('profiler', 'name', 'start', 'record')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler.sync:
+            torch.cuda.synchronize()
+        self.record = None
+        if profiler.torch_profiler is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        if profiler.sync:
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        if self.record is not None:
+            self.record.__exit__(None, None, None)
+        profiler.add(self.name, self.start, end)
+        return False
+
+
+def span(name):
+    """Time the enclosed region under `name` if a Profiler is active"""
+    if _active is None:
+        return _NULL_SPAN
+    return _Span(_active, name)
+
+
+class Profiler:
+    """
+    Collects span timings per epoch. Only one profiler is active at a time, the last
+    one created with config['profile'] set. Disabled profilers do nothing.
+    """
+    def __init__(self, config, output_folder, writer=None):
+        global _active
+        self.enabled = config.get('profile', False)
+        self.sync = self.enabled and config.get('profile_cuda_sync', True) and torch.cuda.is_available()
+        self.output_folder = output_folder
+        self.writer = writer
+        self.profile_torch = self.enabled and config.get('profile_torch', False)
+        self.torch_profiler = None
+        self.epoch = 0
+        self.stats = {}
+        self.events = []
+        self._origin = time.perf_counter()
+        self._epoch_start = self._origin
+        if not self.enabled:
+            return
+
+        _active = self
+        self._start_torch_profiler()
+
+    def _start_torch_profiler(self):
+        # One schedule cycle per epoch, end_epoch stops this one and starts the next
+        if not self.profile_torch:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.torch_profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=5, warmup=2, active=5, repeat=1),
+            on_trace_ready=self._export_torch_trace)
+        self.torch_profiler.__enter__()
+
+    def _stop_torch_profiler(self):
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+            self.torch_profiler = None
+
+    def _export_torch_trace(self, prof):
+        prof.export_chrome_trace(os.path.join(self.output_folder, f"torch_trace_{self.epoch}.json"))
+
+    def add(self, name, start, end):
+        seconds = end - start
+        entry = self.stats.get(name)
+        if entry is None:
+            self.stats[name] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+        if len(self.events) < MAX_TRACE_EVENTS:
+            self.events.append((name, start, end))
+
+    def timed(self, iterable, name='data'):
+        """Iterate `iterable`, timing every wait for the next item as `name`"""
+        if not self.enabled:
+            return iterable
+        return self._timed(iterable, name)
+
+    def _timed(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, start, time.perf_counter())
+            yield item
+
+    def step(self):
+        """Call once per training batch, advances the torch.profiler schedule"""
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def table(self, wall_seconds):
+        """[(name, count, total s, mean ms, max ms, share of the epoch's wall time), ...], largest total first"""
+        rows = []
+        for name, (count, total, longest) in sorted(self.stats.items(), key=lambda kv: -kv[1][1]):
+            rows.append((name, count, total, 1000 * total / count, 1000 * longest, total / wall_seconds if wall_seconds else 0.0))
+        return rows
+
+    def begin_epoch(self):
+        """Start the clock of an epoch's table, spans outside begin/end_epoch are dropped"""
+        if not self.enabled:
+            return
+        self.stats = {}
+        self.events = []
+        self._epoch_start = time.perf_counter()
+
+    def end_epoch(self, label):
+        """Report and reset the spans timed since the last call"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        wall = now - self._epoch_start
+        rows = self.table(wall)
+
+        print(f"\nProfile {label} ({wall:.1f} s)")
+        print(f"{'region':<24}{'count':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'share':>8}")
+        for name, count, total, mean, longest, share in rows:
+            print(f"{name:<24}{count:>8}{total:>10.2f}{mean:>10.2f}{longest:>10.2f}{share:>8.1%}")
+
+        trace = self._chrome_trace(label)
+        csv_rows = [[self.epoch, label, name, count, f"{total:.4f}", f"{mean:.3f}", f"{longest:.3f}", f"{share:.4f}"]
+                    for name, count, total, mean, longest, share in rows]
+        self._submit(_append_rows, os.path.join(self.output_folder, 'profile.csv'),
+                     ['epoch', 'label', 'region', 'count', 'total_s', 'mean_ms', 'max_ms', 'share'], csv_rows)
+        self._submit(_write_json, trace, os.path.join(self.output_folder, f"trace_{self.epoch}.json"))
+
+        self._stop_torch_profiler()
+        self.epoch += 1
+        self._start_torch_profiler()
+        self.begin_epoch()
+
+    def _chrome_trace(self, label):
+        pid = os.getpid()
+        to_us = lambda t: round((t - self._origin) * 1e6, 3)
+        events = [{'name': name, 'cat': 'train', 'ph': 'X', 'ts': to_us(start), 'dur': round((end - start) * 1e6, 3), 'pid': pid, 'tid': 0}
+                  for name, start, end in self.events]
+        events.append({'name': label, 'cat': 'epoch', 'ph': 'X', 'ts': to_us(self._epoch_start),
+                       'dur': round((time.perf_counter() - self._epoch_start) * 1e6, 3), 'pid': pid, 'tid': 1})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def _submit(self, fn, *args):
+        if self.writer is not None:
+            self.writer.submit(fn, *args)
+        else:
+            fn(*args)
+
+    def close(self):
+        global _active
+        self._stop_torch_profiler()
+        if _active is self:
+            _active = None
+
+
+def _append_rows(path, header, rows):
+    new = not os.path.exists(path)
+    with open(path, 'a') as f:
+        if new:
+            f.write(','.join(header) + '\n')
+        for row in rows:
+            f.write(','.join(str(v) for v in row) + '\n')
+
+
+def _write_json(value, path):
+    with open(path, 'w') as f:
+        json.dump(value, f)
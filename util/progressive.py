@@ -0,0 +1,108 @@
+import os
+import time
+import numpy as np
+import torch
+from torch import nn
+from util.eval_util import roc_counts
+
+# Progressive resizing (config['progressive_resizing']). Early training epochs run on
+# smaller images from the per size caches prepare_all_data crops alongside img_size,
+# and the size steps up over training. Epochs here count every pass over a training
+# loader, instance and bag phases alike, and are kept in the checkpoint stats so a
+# resumed run picks up at the right size.
+
+
+def resolution_schedule(config):
+    """[(first epoch, img_size), ...] sorted by epoch, empty when progressive resizing is off"""
+    return sorted((int(epoch), int(size)) for epoch, size in config.get('progressive_resizing', []))
+
+
+def size_at(config, epoch):
+    """Image size for a training epoch, img_size when there is no schedule"""
+    schedule = resolution_schedule(config)
+    if not schedule:
+        return config['img_size']
+    size = schedule[0][1]
+    for start, scheduled in schedule:
+        if epoch >= start:
+            size = scheduled
+    return size
+
+
+def reset_batchnorm_stats(model):
+    """
+    Forget the BatchNorm running statistics. Pooled features (ins_classifier's input)
+    shift with the input size, so stats from the previous size would skew evaluation.
+    """
+    for module in model.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            module.reset_running_stats()
+
+
+def binary_auc(targets, predictions):
+    """Exact ROC AUC, None if only one class is present"""
+    _, tp, fp, n_pos, n_neg = roc_counts(targets, predictions)
+    if n_pos == 0 or n_neg == 0:
+        return None
+    return float(np.trapz(np.r_[0.0, tp / n_pos], np.r_[0.0, fp / n_neg]))
+
+
+def _append_row(path, header, row):
+    new_file = not os.path.exists(path)
+    with open(path, 'a') as f:
+        if new_file:
+            f.write(','.join(header) + '\n')
+        f.write(','.join(str(v) for v in row) + '\n')
+
+
+class ProgressiveResizer:
+    """
+    Serves the image size for each training epoch and tracks the wall clock time the
+    run needs to reach config['target_auc'] on validation.
+
+        size = resizer.start_epoch()   # rebuild the loaders when the size changed
+        ... train + validate ...
+        resizer.end_epoch('instance', val_pred)
+
+    Every epoch is logged to time_to_auc.csv in the model folder, so fixed size and
+    progressive runs can be compared with benchmarks/time_to_auc.py.
+    """
+    def __init__(self, config, model, state):
+        self.config = config
+        self.model = model
+        self.state = state
+        self.current = None
+        self._start = None
+        state.setdefault('train_epochs', 0)
+        state.setdefault('train_seconds', 0.0)
+
+    def start_epoch(self):
+        size = size_at(self.config, self.state['train_epochs'])
+        if self.current is not None and size != self.current:
+            print(f"Progressive resizing: {self.current} -> {size}")
+            reset_batchnorm_stats(self.model)
+            # cudnn.benchmark tunes each new shape once, free the old size's cached blocks first
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        self.current = size
+        self._start = time.perf_counter()
+        return size
+
+    def end_epoch(self, phase, val_pred):
+        self.state['train_seconds'] += time.perf_counter() - self._start
+        self.state['train_epochs'] += 1
+
+        predictions, targets, _ = val_pred.get_results()
+        auc = binary_auc(targets.numpy(), predictions.numpy())
+        seconds = self.state['train_seconds']
+
+        target = self.config.get('target_auc')
+        if auc is not None and target is not None and auc >= target and 'time_to_auc' not in self.state:
+            self.state['time_to_auc'] = seconds
+            print(f"Reached val AUC {auc:.4f} >= {target} after {seconds / 60:.1f} min ({self.state['train_epochs']} epochs, size {self.current})")
+
+        self.state['writer'].submit(
+            _append_row, os.path.join(self.state['model_folder'], 'time_to_auc.csv'),
+            ['epoch', 'phase', 'img_size', 'seconds', 'val_auc'],
+            [self.state['train_epochs'], phase, self.current, f"{seconds:.1f}", '' if auc is None else f"{auc:.5f}"])
+        return auc
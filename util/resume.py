@@ -0,0 +1,237 @@
+import os
+import copy
+import pickle
+import random
+import shutil
+import numpy as np
+import torch
+import torch.utils.data as TUD
+from util.tensor_io import *
+from util.checkpoint_writer import snapshot_to_cpu
+
+# Mid-epoch resume for preemptible machines. setup_model() resumes from the last saved
+# best model, TrainingCursor also snapshots where the loop is (phase, iteration, batch),
+# the python / numpy / torch RNG states and the trainer's partial accumulators every
+# config['resume_every'] batches and after every iteration, into <model_folder>/resume.
+# A resumed run replays the epoch's batch order and continues with the same random
+# draws (bitwise identical results still need deterministic cuDNN kernels).
+#
+#   cursor = TrainingCursor(config, state)
+#   cursor.restore(model, optimizer, palm)
+#   for iteration in cursor.iterations('instance', count):
+#       batches, start = cursor.batches('instance', iteration, loader)
+#       saved = cursor.accumulators()   # partial sums to continue from, None on a fresh epoch
+#       for idx, batch in enumerate(batches, start):
+#           ...
+#           cursor.step(idx + 1, lambda: {...partial sums...})
+#       ...
+#       cursor.end_iteration()
+#   cursor.finish()
+
+RESUME_FOLDER = "resume"
+PHASES = ('instance', 'bag')
+STATE_KEYS = ('epoch', 'mode', 'warmup', 'pickup_warmup', 'val_loss_instance', 'val_loss_bag', 'train_losses',
+              'valid_losses', 'selection_mask', 'train_epochs', 'train_seconds', 'time_to_auc')
+
+
+def rng_state(generators=()):
+    """Python, numpy, torch (CPU and every GPU) and extra generator RNG states"""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'generators': [g.get_state() for g in generators],
+    }
+
+
+def set_rng_state(rng, generators=()):
+    random.setstate(rng['python'])
+    np.random.set_state(rng['numpy'])
+    torch.set_rng_state(rng['torch'])
+    if rng['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+    for g, g_state in zip(generators, rng['generators']):
+        g.set_state(g_state)
+
+
+class ResumableBatchSampler(TUD.Sampler):
+    """
+    Draws the whole epoch from `batch_sampler` when it is iterated, so the sampler's random
+    draws happen at a known point instead of whenever the DataLoader prefetches. Setting
+    `skip` starts the next epoch that many batches in, without loading the skipped ones.
+    """
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.skip = 0
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)
+        skip, self.skip = self.skip, 0
+        return iter(batches[skip:])
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+def _resumable_sampler(loader):
+    loader = getattr(loader, 'loader', loader)
+    sampler = loader.batch_sampler
+    while sampler is not None:
+        if isinstance(sampler, ResumableBatchSampler):
+            return sampler
+        sampler = getattr(sampler, 'batch_sampler', None)
+    return None
+
+
+def _write_pickle(value, path):
+    with atomic_write_path(path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f)
+
+
+def _swap_in(staging, folder):
+    # A crash in between leaves folder.old, which restore() falls back to
+    old = f"{folder}.old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(folder):
+        os.replace(folder, old)
+    os.replace(staging, folder)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _write_snapshot(folder, weights, palm_state, cursor):
+    """
+    One writer job, so a failing file stops it before cursor.pkl marks the staging
+    folder complete and before it replaces the last good snapshot
+    """
+    staging = f"{folder}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    save_nested_state(weights, os.path.join(staging, f"snapshot{TENSOR_FILE_EXT}"))
+    if palm_state is not None:
+        save_nested_state(palm_state, os.path.join(staging, f"palm_state{TENSOR_FILE_EXT}"))
+    _write_pickle(cursor, os.path.join(staging, 'cursor.pkl'))
+    _swap_in(staging, folder)
+
+
+class TrainingCursor:
+    """
+    Position of a train script inside its phase / iteration / batch loops, snapshotted with
+    the model, optimizer, PALM state, RNG states and partial accumulators so a preempted
+    run continues mid-epoch. Loaders have to batch through a ResumableBatchSampler.
+    """
+    def __init__(self, config, state, generators=()):
+        self.state = state
+        self.every = config.get('resume_every', 0) or 0
+        self.generators = [g for g in generators if g is not None]
+        self.folder = os.path.join(state['model_folder'], RESUME_FOLDER)
+        self.pending = None
+        self.phase = None
+        self.iteration = 0
+        self.epoch_rng = None
+        self._accumulators = None
+        self.model = self.optimizer = self.palm = None
+
+    def _snapshot_folder(self):
+        for folder in (self.folder, f"{self.folder}.old"):
+            if os.path.exists(os.path.join(folder, 'cursor.pkl')):
+                return folder
+        return None
+
+    def restore(self, model, optimizer, palm=None):
+        """Load the latest snapshot, if there is one, over what setup_model() loaded"""
+        self.model, self.optimizer, self.palm = model, optimizer, palm
+        folder = self._snapshot_folder()
+        if folder is None:
+            return False
+
+        with open(os.path.join(folder, 'cursor.pkl'), 'rb') as f:
+            cursor = pickle.load(f)
+        weights = load_checkpoint(os.path.join(folder, f"snapshot{TENSOR_FILE_EXT}"), device='cpu', mmap=False)
+        model.load_state_dict(weights['model'])
+        optimizer.load_state_dict(weights['optimizer'])
+        if palm is not None:
+            palm.load_state(os.path.join(folder, f"palm_state{TENSOR_FILE_EXT}"))
+        self.state.update(cursor['state'])
+        self.pending = cursor
+        print(f"Resuming {cursor['phase']} phase at iteration {cursor['iteration']}, batch {cursor['batch']} (epoch {self.state['epoch']})")
+        return True
+
+    def runs(self, phase):
+        """False while resuming into a later phase of the same epoch"""
+        return self.pending is None or PHASES.index(self.pending['phase']) <= PHASES.index(phase)
+
+    def iterations(self, phase, count):
+        """range() of the phase's iterations, starting at the resumed one"""
+        if self.pending is None or self.pending['phase'] != phase:
+            return range(count)
+        start = self.pending['iteration']
+        if start >= count:
+            # Snapshot was taken after the phase's last iteration
+            set_rng_state(self.pending['rng'], self.generators)
+            self.pending = None
+        return range(start, count)
+
+    def batches(self, phase, iteration, loader):
+        """(iterator over `loader` for this epoch, index of its first batch)"""
+        sampler = _resumable_sampler(loader)
+        pending, self.pending = self.pending, None
+        self.phase, self.iteration = phase, iteration
+        self._accumulators = None
+
+        if pending is None or (pending['phase'], pending['iteration']) != (phase, iteration):
+            self.epoch_rng = rng_state(self.generators)
+            return iter(loader), 0
+
+        start = pending['batch']
+        if start and sampler is None:
+            raise ValueError("Resuming mid-epoch needs a loader batching through a ResumableBatchSampler")
+
+        # Replay the epoch's draws (sampler, worker seeds), then continue from the snapshot's
+        set_rng_state(pending['epoch_rng'] if start else pending['rng'], self.generators)
+        self.epoch_rng = rng_state(self.generators)
+        if start:
+            sampler.skip = start
+        batches = iter(loader)
+        if start:
+            set_rng_state(pending['rng'], self.generators)
+            self._accumulators = pending['accumulators']
+        return batches, start
+
+    def accumulators(self):
+        """Partial accumulators saved with the snapshot this epoch resumed from, None otherwise"""
+        accumulators, self._accumulators = self._accumulators, None
+        return accumulators
+
+    def step(self, batch, accumulators):
+        """Call after every batch, `accumulators()` returns the partial sums to snapshot"""
+        if self.every and batch % self.every == 0:
+            self.save(batch, accumulators())
+
+    def end_iteration(self):
+        """Call once an iteration is validated and saved, the snapshot resumes at the next one"""
+        if self.every:
+            self.save(0, None, iteration=self.iteration + 1)
+
+    def save(self, batch, accumulators, iteration=None):
+        writer = self.state['writer']
+        cursor = copy.deepcopy(snapshot_to_cpu({
+            'phase': self.phase,
+            'iteration': self.iteration if iteration is None else iteration,
+            'batch': batch,
+            'epoch_rng': self.epoch_rng if batch else None,
+            'rng': rng_state(self.generators),
+            'accumulators': accumulators,
+            'state': {k: self.state[k] for k in STATE_KEYS if k in self.state},
+        }))
+
+        # CPU copies now, written by the checkpoint writer, cursor.pkl last marks the snapshot complete
+        weights = snapshot_to_cpu({'model': self.model.state_dict(), 'optimizer': self.optimizer.state_dict()})
+        palm_state = snapshot_to_cpu(self.palm.state_to_save()) if self.palm is not None else None
+        writer.submit(_write_snapshot, self.folder, weights, palm_state, cursor)
+
+    def finish(self):
+        """Training completed, drop the snapshots"""
+        writer = self.state['writer']
+        for folder in (self.folder, f"{self.folder}.old", f"{self.folder}.tmp"):
+            writer.submit(shutil.rmtree, folder, True)
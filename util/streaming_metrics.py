@@ -0,0 +1,298 @@
+import os
+import math
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+from util.eval_util import (threshold_metrics, write_performance_report, plot_threshold_metrics,
+                            plot_roc_curve, plot_confusion_counts, _safe_ratio)
+
+# Constant memory versions of the evaluation reports. Accumulators only keep
+# histograms and counts, so they can be updated batch by batch, merged across
+# processes/shards and saved with save_nested_state(acc.state_dict(), path).
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x).ravel()
+
+
+class StreamingBinaryMetrics:
+    """
+    Streaming replacement for calculate_metrics.
+
+    - AUC/ROC from a fine histogram of predictions per class. Only pairs that
+      fall in the same bin are uncertain, see auc() for the error bound.
+    - Exact confusion counts at the report grid thresholds and at 0.5, so
+      performance.txt matches calculate_metrics.
+    """
+    def __init__(self, n_bins=65536, thresholds=None):
+        self.n_bins = n_bins
+        self.thresholds = np.linspace(0, 1, 1000) if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+        self.label_hists = {}   # label -> (n_bins,) prediction histogram, includes non 0/1 labels
+        self.grid_counts = {0: np.zeros(len(self.thresholds) + 1, dtype=np.int64),
+                            1: np.zeros(len(self.thresholds) + 1, dtype=np.int64)}
+        self.default_counts = np.zeros((2, 2), dtype=np.int64)   # [label, prediction >= 0.5]
+        self.confusion_counts = np.zeros((2, 2), dtype=np.int64) # [label, prediction > 0.5]
+
+    def update(self, targets, predictions):
+        targets = _to_numpy(targets)
+        predictions = _to_numpy(predictions)
+
+        bins = np.clip((predictions.astype(np.float64) * self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+        for label in np.unique(targets):
+            key = label.item()
+            hist = np.bincount(bins[targets == label], minlength=self.n_bins)
+            if key in self.label_hists:
+                self.label_hists[key] += hist
+            else:
+                self.label_hists[key] = hist.astype(np.int64)
+
+        # Compare in the prediction dtype, like `predictions >= threshold` does
+        grid = self.thresholds.astype(predictions.dtype) if np.issubdtype(predictions.dtype, np.floating) else self.thresholds
+        half = np.asarray(0.5, dtype=grid.dtype)
+        for label in (0, 1):
+            preds = predictions[targets == label]
+            # Bucket k holds the predictions with exactly k grid thresholds <= prediction
+            self.grid_counts[label] += np.bincount(np.searchsorted(grid, preds, side='right'), minlength=len(grid) + 1)
+            self.default_counts[label, 1] += np.count_nonzero(preds >= half)
+            self.default_counts[label, 0] += len(preds) - np.count_nonzero(preds >= half)
+            self.confusion_counts[label, 1] += np.count_nonzero(preds > half)
+            self.confusion_counts[label, 0] += len(preds) - np.count_nonzero(preds > half)
+
+    def merge(self, other):
+        if other.n_bins != self.n_bins or not np.array_equal(other.thresholds, self.thresholds):
+            raise ValueError("Cannot merge accumulators with different bins or thresholds")
+        for key, hist in other.label_hists.items():
+            if key in self.label_hists:
+                self.label_hists[key] = self.label_hists[key] + hist
+            else:
+                self.label_hists[key] = hist.copy()
+        for label in (0, 1):
+            self.grid_counts[label] = self.grid_counts[label] + other.grid_counts[label]
+        self.default_counts = self.default_counts + other.default_counts
+        self.confusion_counts = self.confusion_counts + other.confusion_counts
+        return self
+
+    def state_dict(self):
+        return {
+            'n_bins': self.n_bins,
+            'thresholds': self.thresholds,
+            'label_hists': self.label_hists,
+            'grid_counts': self.grid_counts,
+            'default_counts': self.default_counts,
+            'confusion_counts': self.confusion_counts,
+        }
+
+    def load_state_dict(self, state):
+        self.n_bins = state['n_bins']
+        self.thresholds = np.asarray(state['thresholds'], dtype=np.float64)
+        self.label_hists = {k: np.array(v, dtype=np.int64) for k, v in state['label_hists'].items()}
+        self.grid_counts = {k: np.array(v, dtype=np.int64) for k, v in state['grid_counts'].items()}
+        self.default_counts = np.array(state['default_counts'], dtype=np.int64)
+        self.confusion_counts = np.array(state['confusion_counts'], dtype=np.int64)
+        return self
+
+    @classmethod
+    def merged(cls, accumulators):
+        accumulators = list(accumulators)
+        result = cls(accumulators[0].n_bins, accumulators[0].thresholds)
+        for acc in accumulators:
+            result.merge(acc)
+        return result
+
+    def _class_hists(self):
+        empty = np.zeros(self.n_bins, dtype=np.int64)
+        return self.label_hists.get(1, empty), self.label_hists.get(0, empty)
+
+    def auc(self):
+        """
+        Returns (auc, error_bound). Pairs within the same bin are counted as ties,
+        the true AUC is within auc +- 0.5 * sum_b(pos_b * neg_b) / (P * N).
+        """
+        pos, neg = self._class_hists()
+        pairs = float(pos.sum()) * float(neg.sum())
+        if pairs == 0:
+            raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+        neg_below = np.cumsum(neg) - neg
+        auc = float((pos * (neg_below + 0.5 * neg)).sum() / pairs)
+        bound = float(0.5 * (pos * neg).sum() / pairs)
+        return auc, bound
+
+    def roc_curve(self):
+        pos, neg = self._class_hists()
+        tpr = np.r_[0.0, np.cumsum(pos[::-1]) / pos.sum()]
+        fpr = np.r_[0.0, np.cumsum(neg[::-1]) / neg.sum()]
+        return fpr, tpr
+
+    def threshold_counts(self):
+        """TP and FP of `predictions >= t` for every grid threshold"""
+        # Predictions >= thresholds[j] are the buckets after j
+        tp = np.cumsum(self.grid_counts[1][::-1])[::-1][1:]
+        fp = np.cumsum(self.grid_counts[0][::-1])[::-1][1:]
+        return tp, fp
+
+    def basic_metrics(self):
+        """The 0.5 threshold metrics written at the top of performance.txt"""
+        (TN, FP), (FN, TP) = self.default_counts
+        sens = _safe_ratio(TP, TP + FN).item()
+        spec = _safe_ratio(TN, TN + FP).item()
+        ppv = _safe_ratio(TP, TP + FP).item()
+        npv = _safe_ratio(TN, TN + FN).item()
+        auc, _ = self.auc()
+        return {
+            'accuracy': (sens + spec) / 2,
+            'auc': auc,
+            'sensitivity': sens,
+            'specificity': spec,
+            'ppv': ppv,
+            'npv': npv,
+            'precision': ppv,
+            'recall': sens,
+            'f1': _safe_ratio(2 * TP, 2 * TP + FP + FN).item(),
+        }
+
+    def write_reports(self, save_path, target_specificity=0.80):
+        """Same report files as calculate_metrics (without worst_instances.csv, which needs every id)"""
+        os.makedirs(save_path, exist_ok=True)
+        plot_distribution_histograms(self.label_hists, self.n_bins, save_path)
+
+        n_pos = int(self.grid_counts[1].sum())
+        n_neg = int(self.grid_counts[0].sum())
+        tp, fp = self.threshold_counts()
+        sweep = threshold_metrics(self.thresholds, tp, fp, n_pos, n_neg, target_specificity)
+
+        basic = self.basic_metrics()
+        auc, bound = self.auc()
+        print(f"Histogram AUC: {auc:.4f} (+-{bound:.2e})")
+
+        write_performance_report(save_path, basic, sweep, target_specificity)
+        plot_threshold_metrics(save_path, sweep, target_specificity)
+        fpr, tpr = self.roc_curve()
+        plot_roc_curve(save_path, fpr, tpr, auc, sweep, target_specificity)
+        plot_confusion_counts(self.confusion_counts, ['Negitive', 'Positive'], f"{save_path}/confusion_matrix.png")
+        return sweep
+
+
+def plot_distribution_histograms(label_hists, n_bins, output_path='./', plot_bins=100):
+    """Histogram version of plot_distribution_analysis"""
+    labels = sorted(label_hists.keys())
+
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 5))
+
+    # Plot label distribution
+    ax1.bar(labels, [int(label_hists[label].sum()) for label in labels])
+    ax1.set_title('Label Distribution')
+    ax1.set_xlabel('Label')
+    ax1.set_ylabel('Count')
+
+    # Plot prediction densities by label on a coarser grid
+    group = max(n_bins // plot_bins, 1)
+    centers = (np.arange(n_bins // group) + 0.5) / (n_bins // group)
+    for label in labels:
+        coarse = label_hists[label][:len(centers) * group].reshape(-1, group).sum(axis=1)
+        density = coarse / max(coarse.sum(), 1) * len(centers)
+        ax2.plot(centers, density, label=f'Label {label}')
+
+    ax2.set_title('Prediction Distribution by Label')
+    ax2.set_xlabel('Prediction Value')
+    ax2.set_ylabel('Density')
+    ax2.set_xlim(0, 1)
+    ax2.legend()
+
+    plt.tight_layout()
+    plt.savefig(f'{output_path}/distribution_analysis.png')
+    plt.close()
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative error `relative_accuracy` (DDSketch).
+    Values are counted in logarithmic buckets, memory grows with the log of the
+    value range, not with the number of values.
+    """
+    def __init__(self, relative_accuracy=0.005):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _add(self, store, values):
+        keys, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def update(self, values):
+        values = _to_numpy(values).astype(np.float64)
+        values = values[~np.isnan(values)]
+        self._add(self.positive, values[values > 0])
+        self._add(self.negative, -values[values < 0])
+        self.zero_count += int(np.count_nonzero(values == 0))
+        self.count += len(values)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def _buckets(self):
+        """(value, count) in ascending value order"""
+        buckets = [(-self._value(k), self.negative[k]) for k in sorted(self.negative, reverse=True)]
+        if self.zero_count:
+            buckets.append((0.0, self.zero_count))
+        buckets += [(self._value(k), self.positive[k]) for k in sorted(self.positive)]
+        return buckets
+
+    def quantile(self, q):
+        """Value at quantile q in [0, 1], like np.percentile(values, 100 * q) within the relative accuracy"""
+        if self.count == 0:
+            return float('nan')
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, count in self._buckets():
+            seen += count
+            if seen > rank:
+                return value
+        return self._buckets()[-1][0]
+
+    def fraction_above(self, threshold):
+        """Approximate fraction of values > threshold"""
+        if self.count == 0:
+            return float('nan')
+        above = sum(count for value, count in self._buckets() if value > threshold)
+        return above / self.count
+
+    def state_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'positive': self.positive,
+            'negative': self.negative,
+            'zero_count': self.zero_count,
+            'count': self.count,
+        }
+
+    def load_state_dict(self, state):
+        self.__init__(state['relative_accuracy'])
+        self.positive = {int(k): int(v) for k, v in state['positive'].items()}
+        self.negative = {int(k): int(v) for k, v in state['negative'].items()}
+        self.zero_count = int(state['zero_count'])
+        self.count = int(state['count'])
+        return self
+
+
+def calculate_ood_stats_streaming(sketch_1, sketch_2, percentile=95):
+    """calculate_ood_stats on two QuantileSketches of PALM distances"""
+    threshold = sketch_1.quantile(percentile / 100)
+    ood_percentage = sketch_2.fraction_above(threshold) * 100
+    return threshold, ood_percentage
@@ -0,0 +1,278 @@
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import hashlib
+import argparse
+import itertools
+import subprocess
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from config import *
+
+# Hyperparameter sweeps over the config fields. Every trial is a train script run in
+# its own process with CONFIG_OVERRIDES (see build_config), pinned to its own CPU cores
+# and with its thread pools capped to them. The bags are prepared once per distinct
+# set of preprocessing fields and shared through config['bag_cache'].
+#
+#   python util/sweep.py --name lr_sweep --space sweep.json --parallel 2 --threads 8 --gpus 0,1
+#
+# sweep.json maps config fields to values. A list is a grid axis, or the choices
+# of a random search (--random N), where {"low": 1e-4, "high": 1e-2, "log": true}
+# samples a range. Trials log to sweeps/<name>/ and train into models/<name>_t<NNN>.
+# Trials whose best val AUC (time_to_auc.csv, written by train_PALM2) falls below the
+# median of the others at the same epoch are stopped early.
+
+SWEEP_DIR = os.path.join(parent_dir, "sweeps")
+THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def grid_trials(space):
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+
+
+def _sample(values, rng):
+    if isinstance(values, list):
+        return rng.choice(values)
+    low, high = values['low'], values['high']
+    if values.get('log', False):
+        value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    else:
+        value = rng.uniform(low, high)
+    return int(round(value)) if isinstance(low, int) and isinstance(high, int) else value
+
+
+def random_trials(space, n_trials, seed=0):
+    rng = random.Random(seed)
+    return [{k: _sample(v, rng) for k, v in space.items()} for _ in range(n_trials)]
+
+
+# Fields that change the prepared bags (create_bags and the crops). Folds are split again
+# from the cache in apply_fold, so cv_folds and fold share one cache
+PREPROCESS_FIELDS = {
+    'dataset_name', 'label_columns', 'instance_columns', 'img_size', 'extra_img_sizes',
+    'min_bag_size', 'max_bag_size', 'use_videos', 'grayscale', 'aspect_buckets',
+    'progressive_resizing', 'bucket', 'export_location', 'cropped_images', 'data_config',
+}
+
+
+def prepare_bag_cache(sweep_dir, overrides, data_config_class):
+    """Run prepare_all_data once for these preprocessing overrides and pickle the bags, returns the cache path"""
+    from data.format_data import prepare_all_data, save_bag_cache
+
+    key = hashlib.md5(json.dumps(overrides, sort_keys=True).encode()).hexdigest()[:10]
+    path = os.path.join(sweep_dir, f"bags_{key}.pkl")
+    if not os.path.exists(path):
+        config = build_config('1', 'sweep', data_config_class, overrides=overrides)
+        bags_train, bags_val, _, _ = prepare_all_data(config)
+        save_bag_cache(path, bags_train, bags_val)
+    return path
+
+
+def read_progress(model_folder):
+    """[(training epoch, val AUC), ...] from a trial's time_to_auc.csv"""
+    path = os.path.join(model_folder, 'time_to_auc.csv')
+    if not os.path.exists(path):
+        return []
+    try:
+        log = pd.read_csv(path).dropna(subset=['val_auc'])
+    except (pd.errors.EmptyDataError, KeyError):
+        return []
+    return list(zip(log['epoch'].astype(int), log['val_auc'].astype(float)))
+
+
+def best_by(progress, epoch):
+    """Best AUC reported up to `epoch`, None if the trial has not got that far"""
+    values = [auc for e, auc in progress if e <= epoch]
+    if not progress or progress[-1][0] < epoch or not values:
+        return None
+    return max(values)
+
+
+def below_median(progress, others, min_epochs=2, min_trials=3):
+    """Median stopping rule: is this trial's best AUC below the median of the other trials at its current epoch?"""
+    if not progress or progress[-1][0] < min_epochs:
+        return False
+    epoch = progress[-1][0]
+    peers = [b for b in (best_by(p, epoch) for p in others) if b is not None]
+    if len(peers) < min_trials:
+        return False
+    return best_by(progress, epoch) < np.median(peers)
+
+
+class Trial:
+    """One training process: `script` run with `overrides` as CONFIG_OVERRIDES, training into models/<head_name>/<model_version>"""
+    def __init__(self, index, name, params, overrides, head_name, model_version, log_dir):
+        self.index = index
+        self.name = name
+        self.params = params
+        self.overrides = {**overrides, 'head_name': head_name, 'model_version': model_version}
+        self.head_name = head_name
+        self.model_folder = os.path.join(parent_dir, "models", head_name, model_version)
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self.process = None
+        self.slot = None
+        self.cores = []
+        self.gpu = None
+        self.status = 'pending'
+        self.started = None
+        self.seconds = 0.0
+
+    def start(self, script, cores, gpu):
+        self.cores = cores
+        self.gpu = gpu
+        env = dict(os.environ)
+        env['CONFIG_OVERRIDES'] = json.dumps(self.overrides)
+        for var in THREAD_VARS:
+            env[var] = str(max(1, len(cores)))
+        if gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+
+        # Pin to the trial's cores where the OS supports it (Linux)
+        preexec = (lambda: os.sched_setaffinity(0, cores)) if cores and hasattr(os, 'sched_setaffinity') else None
+        self.log = open(self.log_path, 'w')
+        self.process = subprocess.Popen([sys.executable, script], cwd=parent_dir, env=env, stdout=self.log, stderr=subprocess.STDOUT, preexec_fn=preexec)
+        self.status = 'running'
+        self.started = time.time()
+        print(f"Started {self.name} on cores {cores or 'any'}{'' if gpu is None else f', GPU {gpu}'}: {self.params}")
+
+    def finish(self, status):
+        self.status = status
+        self.seconds = time.time() - self.started
+        self.log.close()
+        print(f"{self.name} {status} after {self.seconds / 60:.1f} min")
+
+    def result(self):
+        row = {'trial': self.name, 'status': self.status, 'minutes': round(self.seconds / 60, 2), **self.params}
+        progress = read_progress(self.model_folder)
+        row['best_val_auc'] = max((auc for _, auc in progress), default=None)
+        row['train_epochs'] = progress[-1][0] if progress else 0
+
+        # Checkpoints from the warmup go to the head folder
+        stats_paths = [os.path.join(folder, 'stats.pkl') for folder in (self.model_folder, os.path.dirname(self.model_folder))]
+        stats_path = next((p for p in stats_paths if os.path.exists(p)), None)
+        if stats_path:
+            with open(stats_path, 'rb') as f:
+                stats = pickle.load(f)
+            row['epoch'] = stats.get('epoch')
+            row['val_loss_bag'] = stats.get('val_loss_bag')
+            row['val_loss_instance'] = stats.get('val_loss_instance')
+        return row
+
+
+def run_trials(script, trials, parallel=1, threads=None, gpus=None, poll_seconds=30, should_stop=None, on_finish=None):
+    """
+    Run the Trials `parallel` at a time, each pinned to `threads` cores of its own and
+    given the GPUs round robin. should_stop(trial, progress) is checked every poll with
+    {trial index: read_progress()} of the started trials. Returns the finished trials.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    threads = threads or max(1, len(cores) // parallel)
+    if threads * parallel > len(cores):
+        print(f"{parallel} trials x {threads} threads is more than the {len(cores)} available cores, not pinning")
+        cores = []
+    gpus = gpus or [None]
+
+    pending = list(trials)
+    running, finished = [], []
+    slots = list(range(parallel))
+
+    def free(trial):
+        running.remove(trial)
+        finished.append(trial)
+        slots.append(trial.slot)
+        if on_finish is not None:
+            on_finish(finished)
+
+    while pending or running:
+        while pending and slots:
+            trial = pending.pop(0)
+            trial.slot = slots.pop(0)
+            trial_cores = cores[trial.slot * threads:(trial.slot + 1) * threads] if cores else []
+            trial.start(script, trial_cores, gpus[trial.slot % len(gpus)])
+            running.append(trial)
+
+        time.sleep(poll_seconds)
+
+        progress = {t.index: read_progress(t.model_folder) for t in running + finished}
+        for trial in list(running):
+            code = trial.process.poll()
+            if code is not None:
+                trial.finish('done' if code == 0 else f'failed ({code})')
+                free(trial)
+            elif should_stop is not None and should_stop(trial, progress):
+                trial.process.terminate()
+                trial.process.wait()
+                trial.finish('stopped')
+                free(trial)
+    return finished
+
+
+def run_sweep(name, script, trials, data_config='DogDataConfig', parallel=1, threads=None, gpus=None,
+              min_epochs=2, min_trials=3, poll_seconds=30):
+    """Run every params dict in `trials` through `script`, returns the results table"""
+    sweep_dir = os.path.join(SWEEP_DIR, name)
+    os.makedirs(sweep_dir, exist_ok=True)
+    data_config_class = globals()[data_config]
+
+    # Known fields only, a typo should not silently train the default config
+    known = set(build_config('1', name, data_config_class, overrides={}))
+    for params in trials:
+        unknown = set(params) - known
+        if unknown:
+            raise KeyError(f"Unknown config fields in sweep: {sorted(unknown)}")
+
+    # One prepared bag cache per distinct set of preprocessing fields
+    runs = []
+    for i, params in enumerate(trials):
+        prep = {'data_config': data_config, **{k: v for k, v in params.items() if k in PREPROCESS_FIELDS}}
+        overrides = {**params, 'data_config': data_config, 'bag_cache': prepare_bag_cache(sweep_dir, prep, data_config_class)}
+        runs.append(Trial(i, f"{name}_t{i:03d}", params, overrides, f"{name}_t{i:03d}", '1', sweep_dir))
+
+    def should_stop(trial, progress):
+        others = [p for index, p in progress.items() if index != trial.index]
+        return below_median(progress[trial.index], others, min_epochs, min_trials)
+
+    results_path = os.path.join(sweep_dir, 'results.csv')
+    save_results = lambda finished: pd.DataFrame([t.result() for t in finished]).to_csv(results_path, index=False)
+    finished = run_trials(script, runs, parallel, threads, gpus, poll_seconds, should_stop, save_results)
+
+    results = pd.DataFrame([t.result() for t in finished])
+    results.to_csv(results_path, index=False)
+    print(f"\nResults in {results_path}")
+    if 'best_val_auc' in results:
+        print(results.sort_values('best_val_auc', ascending=False).to_string(index=False))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep over config fields')
+    parser.add_argument('--name', required=True, help='Sweep name, used for sweeps/<name> and the trial head names')
+    parser.add_argument('--space', required=True, help='JSON file mapping config fields to values')
+    parser.add_argument('--script', default='train_PALM2.py')
+    parser.add_argument('--data_config', default='DogDataConfig')
+    parser.add_argument('--random', type=int, default=0, help='Random search with this many trials instead of the grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--parallel', type=int, default=1, help='Concurrent trials')
+    parser.add_argument('--threads', type=int, default=None, help='CPU cores / threads per trial')
+    parser.add_argument('--gpus', default=None, help='Comma separated GPU ids, handed out round robin')
+    parser.add_argument('--min_epochs', type=int, default=2, help='Epochs before median stopping applies')
+    parser.add_argument('--min_trials', type=int, default=3, help='Other trials needed at an epoch for median stopping')
+    parser.add_argument('--poll', type=int, default=30, help='Seconds between progress checks')
+    args = parser.parse_args()
+
+    with open(args.space) as f:
+        space = json.load(f)
+    trials = random_trials(space, args.random, args.seed) if args.random else grid_trials(space)
+    gpus = [int(g) for g in args.gpus.split(',')] if args.gpus else None
+
+    run_sweep(args.name, args.script, trials, args.data_config, args.parallel, args.threads, gpus,
+              args.min_epochs, args.min_trials, args.poll)
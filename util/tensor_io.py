@@ -0,0 +1,270 @@
+import os
+import io
+import json
+import pickle
+import struct
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+# File layout:
+#   8 bytes  little-endian header length
+#   header   JSON {"metadata": ..., "tensors": {name: {dtype, shape, offset, nbytes}}}
+#   padding  so the data block starts on an ALIGNMENT boundary
+#   data     raw tensor bytes, each tensor aligned to ALIGNMENT
+# Tensors are always written from CPU memory, so the file has no device information
+# and loads on any machine. Reading memory-maps the data block, weights are only
+# paged in when they are touched (e.g. by model.load_state_dict).
+
+TENSOR_FILE_EXT = '.tensors'
+ALIGNMENT = 64
+
+_TORCH_TO_NAME = {
+    torch.float64: 'float64',
+    torch.float32: 'float32',
+    torch.float16: 'float16',
+    torch.bfloat16: 'bfloat16',
+    torch.int64: 'int64',
+    torch.int32: 'int32',
+    torch.int16: 'int16',
+    torch.int8: 'int8',
+    torch.uint8: 'uint8',
+    torch.bool: 'bool',
+}
+_NAME_TO_TORCH = {v: k for k, v in _TORCH_TO_NAME.items()}
+
+
+@contextmanager
+def atomic_write_path(path):
+    """Yields a temporary path next to `path` and renames it over `path` on success"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _to_bytes(value):
+    """Returns (dtype name, shape, contiguous numpy view) for a tensor or array"""
+    if torch.is_tensor(value):
+        value = value.detach()
+        if value.device.type != 'cpu':
+            value = value.cpu()
+        dtype_name = _TORCH_TO_NAME.get(value.dtype)
+        if dtype_name is None:
+            raise TypeError(f"Unsupported tensor dtype: {value.dtype}")
+        if value.dtype == torch.bfloat16:
+            value = value.view(torch.int16)
+        array = value.contiguous().numpy()
+    else:
+        array = np.ascontiguousarray(value)
+        dtype_name = str(array.dtype)
+        if dtype_name not in _NAME_TO_TORCH:
+            raise TypeError(f"Unsupported array dtype: {array.dtype}")
+    return dtype_name, list(array.shape), array
+
+
+def save_tensors(tensors, path, metadata=None):
+    """
+    Write a flat {name: tensor or ndarray} dict to a tensor file.
+    `metadata` must be JSON serializable.
+    """
+    entries = {}
+    arrays = []
+    offset = 0
+    for name, value in tensors.items():
+        dtype_name, shape, array = _to_bytes(value)
+        entries[name] = {'dtype': dtype_name, 'shape': shape, 'offset': offset, 'nbytes': array.nbytes}
+        arrays.append(array)
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({'metadata': metadata, 'tensors': entries}).encode('utf-8')
+    data_start = _align(8 + len(header))
+
+    with atomic_write_path(path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (data_start - 8 - len(header)))
+            position = 0
+            for (name, entry), array in zip(entries.items(), arrays):
+                f.write(b'\0' * (entry['offset'] - position))
+                f.write(array.tobytes(order='C'))
+                position = entry['offset'] + entry['nbytes']
+
+
+def read_tensor_header(path):
+    """Read only the header of a tensor file. Returns (header dict, data block offset)"""
+    with open(path, 'rb') as f:
+        (header_len,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _align(8 + header_len)
+
+
+def load_tensors(path, device='cpu', mmap=True, as_numpy=False):
+    """
+    Load a tensor file. Returns ({name: tensor}, metadata).
+
+    With mmap=True the tensors are copy-on-write views of the file, nothing is
+    read from disk until the values are used.
+    """
+    header, data_start = read_tensor_header(path)
+    entries = header['tensors']
+    data_size = max((e['offset'] + e['nbytes'] for e in entries.values()), default=0)
+
+    if data_size == 0:
+        buffer = np.zeros(0, dtype=np.uint8)
+    elif mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start, shape=(data_size,))
+    else:
+        with open(path, 'rb') as f:
+            f.seek(data_start)
+            buffer = np.frombuffer(bytearray(f.read(data_size)), dtype=np.uint8)
+
+    tensors = {}
+    for name, entry in entries.items():
+        dtype_name = entry['dtype']
+        raw = buffer[entry['offset']:entry['offset'] + entry['nbytes']]
+        if dtype_name == 'bfloat16':
+            array = raw.view(np.int16).reshape(entry['shape'])
+        else:
+            array = raw.view(np.dtype(dtype_name)).reshape(entry['shape'])
+
+        if as_numpy:
+            if dtype_name == 'bfloat16':
+                raise TypeError(f"{name} is bfloat16 and cannot be returned as a numpy array")
+            tensors[name] = array
+            continue
+
+        tensor = torch.from_numpy(array)
+        if dtype_name == 'bfloat16':
+            tensor = tensor.view(torch.bfloat16)
+        if device is not None and torch.device(device).type != 'cpu':
+            tensor = tensor.to(device)
+        tensors[name] = tensor
+
+    return tensors, header['metadata']
+
+
+# Nested states (optimizer state dicts, PALM state, ...) are stored as a JSON
+# skeleton in the metadata with every tensor/array replaced by a reference.
+
+def _encode(value, tensors):
+    if torch.is_tensor(value) or isinstance(value, np.ndarray):
+        name = f"t{len(tensors)}"
+        tensors[name] = value
+        return {'__tensor__': name, '__numpy__': isinstance(value, np.ndarray)}
+    if isinstance(value, dict):
+        return {'__dict__': [[_encode_key(k), _encode(v, tensors)] for k, v in value.items()]}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode(v, tensors) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v, tensors) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f"Cannot store value of type {type(value)} in a tensor file")
+
+
+def _encode_key(key):
+    if isinstance(key, np.generic):
+        key = key.item()
+    if torch.is_tensor(key):
+        key = key.item()
+    if key is None or isinstance(key, (bool, int, float, str)):
+        return key
+    raise TypeError(f"Cannot store dict key of type {type(key)} in a tensor file")
+
+
+def _decode(value, tensors):
+    if isinstance(value, list):
+        return [_decode(v, tensors) for v in value]
+    if isinstance(value, dict):
+        if '__tensor__' in value:
+            tensor = tensors[value['__tensor__']]
+            if value.get('__numpy__') and torch.is_tensor(tensor):
+                tensor = tensor.numpy()
+            return tensor
+        if '__dict__' in value:
+            return {k: _decode(v, tensors) for k, v in value['__dict__']}
+        if '__tuple__' in value:
+            return tuple(_decode(v, tensors) for v in value['__tuple__'])
+    return value
+
+
+def save_nested_state(state, path):
+    """Save any nesting of dicts/lists/tuples/scalars holding tensors or arrays"""
+    tensors = {}
+    skeleton = _encode(state, tensors)
+    save_tensors(tensors, path, metadata={'state': skeleton})
+
+
+def load_nested_state(path, device='cpu', mmap=True):
+    """Inverse of save_nested_state"""
+    tensors, metadata = load_tensors(path, device=device, mmap=mmap)
+    return _decode(metadata['state'], tensors)
+
+
+# Legacy checkpoints
+
+class _CPUUnpickler(pickle.Unpickler):
+    """Unpickles pickle.dump'ed CUDA tensors onto the CPU"""
+    def find_class(self, module, name):
+        if module == 'torch.storage' and name == '_load_from_bytes':
+            return lambda b: torch.load(io.BytesIO(b), map_location='cpu')
+        return super().find_class(module, name)
+
+
+def load_legacy_pickle(path):
+    with open(path, 'rb') as f:
+        return _CPUUnpickler(f).load()
+
+
+def load_legacy_torch(path):
+    return torch.load(path, map_location='cpu')
+
+
+def resolve_checkpoint(folder, name):
+    """
+    Returns the path of checkpoint `name` in `folder`, preferring the tensor file
+    over a legacy .pth/.pkl file. Returns None if neither exists.
+    """
+    for ext in (TENSOR_FILE_EXT, '.pth', '.pkl'):
+        path = os.path.join(folder, f"{name}{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_checkpoint(path, device='cpu', mmap=True):
+    """Load a tensor file or a legacy .pth/.pkl checkpoint onto `device`"""
+    if path is None:
+        raise FileNotFoundError("No checkpoint found, resolve_checkpoint() returned None")
+    if path.endswith(TENSOR_FILE_EXT):
+        return load_nested_state(path, device=device, mmap=mmap)
+    if path.endswith('.pkl'):
+        state = load_legacy_pickle(path)
+    else:
+        state = load_legacy_torch(path)
+    if device is not None and torch.device(device).type != 'cpu':
+        state = _move(state, device)
+    return state
+
+
+def _move(value, device):
+    if torch.is_tensor(value):
+        return value.to(device)
+    if isinstance(value, dict):
+        return {k: _move(v, device) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_move(v, device) for v in value)
+    return value